@@ -8,8 +8,16 @@ from telegram.ext import (
     MessageHandler, 
     filters
 )
-from config import TELEGRAM_BOT_TOKEN
+from config import (
+    TELEGRAM_BOT_TOKEN, ARCHIVE_INTERVAL_SECONDS, REAPER_INTERVAL_SECONDS,
+    WG_RECONCILE_INTERVAL_SECONDS, TELEMETRY_INTERVAL_SECONDS, VPN_BACKENDS
+)
 from database import Database
+from services.archiver import archive_job
+from services.reaper import reap_job
+from services.wg_reconcile import reconcile_job
+from services.telemetry import telemetry_job
+from services.vpn_service import VPNService
 from handlers.start import start_command
 from handlers.vpn_setup import (
     setup_vpn_callback, 
@@ -40,11 +48,16 @@ from handlers.help import (
 )
 from handlers.admin import (
     admin_command,
+    rebalance_command,
+    usage_command,
+    admin_traffic_callback,
     admin_stats_callback,
     admin_trial_users_callback,
     admin_paid_users_callback,
+    admin_users_page_callback,
     admin_recent_payments_callback,
-    admin_expiring_soon_callback
+    admin_expiring_soon_callback,
+    admin_back_callback
 )
 
 from handlers.server_selection import (
@@ -65,12 +78,33 @@ def main():
     """
     Главная функция запуска бота
     """
-    # Инициализация базы данных
+    # Инициализация базы данных (соединения открываются в post_init)
     db = Database()
-    logger.info("База данных инициализирована")
+    
+    async def post_init(application: Application) -> None:
+        await db.connect()
+        logger.info("База данных инициализирована")
+        
+        await VPNService.setup(db)
+        logger.info(f"Бэкенды выдачи ключей: {VPN_BACKENDS}")
+        logger.info(f"Серверы WireGuard готовы: {list(VPNService.servers.nodes)}")
+        
+        # Сверка wg0 с БД до приёма обновлений
+        await reconcile_job(None)
+    
+    async def post_shutdown(application: Application) -> None:
+        await VPNService.shutdown()
+        await db.close()
+        logger.info("Соединения с базой данных закрыты")
     
     # Создание приложения
-    application = Application.builder().token(TELEGRAM_BOT_TOKEN).build()
+    application = (
+        Application.builder()
+        .token(TELEGRAM_BOT_TOKEN)
+        .post_init(post_init)
+        .post_shutdown(post_shutdown)
+        .build()
+    )
     logger.info("Приложение создано")
     
     # ========================================
@@ -92,6 +126,16 @@ def main():
         CommandHandler("admin", lambda u, c: admin_command(u, c, db))
     )
     
+    # Команда /rebalance - перенос неактивных клиентов между серверами
+    application.add_handler(
+        CommandHandler("rebalance", lambda u, c: rebalance_command(u, c, db))
+    )
+    
+    # Команда /usage <user_id> - трафик пользователя
+    application.add_handler(
+        CommandHandler("usage", lambda u, c: usage_command(u, c, db))
+    )
+    
     logger.info("Обработчики команд добавлены")
     
     # ========================================
@@ -110,7 +154,7 @@ def main():
     
     # Кнопка "Установить приложение WireGuard"
     application.add_handler(
-        CallbackQueryHandler(install_app_callback, pattern='^install_app$')
+        CallbackQueryHandler(lambda u, c: install_app_callback(u, c, db), pattern='^install_app$')
     )
     
     # Кнопка "Получить ключ"
@@ -218,6 +262,16 @@ def main():
         CallbackQueryHandler(lambda u, c: admin_paid_users_callback(u, c, db), pattern='^admin_paid_users$')
     )
     
+    # Админ панель - листание списков пользователей
+    application.add_handler(
+        CallbackQueryHandler(lambda u, c: admin_users_page_callback(u, c, db), pattern='^admin_users:')
+    )
+    
+    # Админ панель - возврат в меню админки
+    application.add_handler(
+        CallbackQueryHandler(admin_back_callback, pattern='^admin_back$')
+    )
+    
     # Админ панель - последние платежи
     application.add_handler(
         CallbackQueryHandler(lambda u, c: admin_recent_payments_callback(u, c, db), pattern='^admin_recent_payments$')
@@ -228,8 +282,41 @@ def main():
         CallbackQueryHandler(lambda u, c: admin_expiring_soon_callback(u, c, db), pattern='^admin_expiring_soon$')
     )
     
+    # Админ панель - трафик серверов и пользователей
+    application.add_handler(
+        CallbackQueryHandler(lambda u, c: admin_traffic_callback(u, c, db), pattern='^admin_traffic$')
+    )
+    
     logger.info("Обработчики админ-панели добавлены")
     
+    # ========================================
+    # ФОНОВЫЕ ЗАДАЧИ
+    # ========================================
+    
+    # Архивация истёкших подписок и старых платежей
+    application.job_queue.run_repeating(
+        archive_job, interval=ARCHIVE_INTERVAL_SECONDS, first=60, data=db, name='archive'
+    )
+    
+    # Отзыв доступа по истёкшим подпискам
+    application.job_queue.run_repeating(
+        reap_job, interval=REAPER_INTERVAL_SECONDS, first=30, data=db, name='reaper'
+    )
+    
+    # Сверка wg0 с БД (первая - при старте, в post_init)
+    application.job_queue.run_repeating(
+        reconcile_job, interval=WG_RECONCILE_INTERVAL_SECONDS,
+        first=WG_RECONCILE_INTERVAL_SECONDS, name='wg_reconcile'
+    )
+    
+    # Сбор трафика peer'ов WireGuard
+    application.job_queue.run_repeating(
+        telemetry_job, interval=TELEMETRY_INTERVAL_SECONDS, first=TELEMETRY_INTERVAL_SECONDS,
+        data=db, name='telemetry'
+    )
+    
+    logger.info("Фоновые задачи запланированы")
+    
     # ========================================
     # ОБРАБОТЧИК ОШИБОК
     # ========================================
@@ -20,6 +20,36 @@ XUI_PANEL_URL = os.getenv('XUI_PANEL_URL')
 XUI_USERNAME = os.getenv('XUI_USERNAME')
 XUI_PASSWORD = os.getenv('XUI_PASSWORD')
 
+# База данных
+DB_FILE = os.getenv('DB_FILE', 'database.db')
+DB_WAL_MODE = os.getenv('DB_WAL_MODE', '1') == '1'  # WAL + пул читателей
+DB_SYNCHRONOUS = os.getenv('DB_SYNCHRONOUS', 'NORMAL')  # NORMAL безопасен в WAL
+DB_READER_POOL_SIZE = int(os.getenv('DB_READER_POOL_SIZE', '4'))
+DB_BUSY_TIMEOUT_MS = 5000
+DB_GROUP_COMMIT_MS = int(os.getenv('DB_GROUP_COMMIT_MS', '5'))  # 0 - без ожидания
+DB_GROUP_COMMIT_MAX_UNITS = 200
+DB_MIGRATION_BATCH = 1000  # строк за одну единицу работы при миграциях
+
+# Кэш чтений (пользователи, настройки, активные подписки)
+CACHE_MAX_ENTRIES = int(os.getenv('CACHE_MAX_ENTRIES', '10000'))
+CACHE_TTL_SECONDS = int(os.getenv('CACHE_TTL_SECONDS', '300'))
+# Сколько выданный ключ отдаётся повторным запросам без новой выдачи
+KEY_CACHE_SECONDS = int(os.getenv('KEY_CACHE_SECONDS', '10'))
+
+# Архивация истёкших подписок и старых платежей
+ARCHIVE_AFTER_DAYS = int(os.getenv('ARCHIVE_AFTER_DAYS', '30'))
+ARCHIVE_BATCH_SIZE = 500  # строк за одну единицу работы
+ARCHIVE_INTERVAL_SECONDS = 3600
+ARCHIVE_MAX_BATCHES = 20  # пачек за один запуск задачи
+
+# Отзыв доступа по истёкшим подпискам (peer'ы WireGuard, пользователи Marzban)
+REAPER_INTERVAL_SECONDS = int(os.getenv('REAPER_INTERVAL_SECONDS', '300'))
+REAPER_BATCH_SIZE = 200  # подписок за одну единицу работы
+REAPER_MAX_BATCHES = 50  # пачек за один запуск задачи
+
+# Админ-панель
+ADMIN_PAGE_SIZE = 20  # пользователей на странице списка
+
 # Подписка
 SUBSCRIPTION_PRICE = 169
 SUBSCRIPTION_PRICE_STARS = 169
@@ -59,4 +89,91 @@ SERVER_1_WG_ENDPOINT = f"{SERVER_1_IP}:{SERVER_1_WG_PORT}"
 SERVER_2_IP = "72.56.69.53"  # Нидерланды - Скорость
 SERVER_2_WG_PORT = "51820"
 SERVER_2_WG_PUBLIC_KEY = "njg2vVf0idKU2Ifame+QAjR67VlXfpk3shxXHOo4hlU="
-SERVER_2_WG_ENDPOINT = f"{SERVER_2_IP}:{SERVER_2_WG_PORT}"
\ No newline at end of file
+SERVER_2_WG_ENDPOINT = f"{SERVER_2_IP}:{SERVER_2_WG_PORT}"
+
+# Пулы адресов клиентов WireGuard по серверам (выдаются из БД).
+# Несколько IPv4-префиксов через запятую; IPv6 (ULA, fd00::/8) -
+# необязательно, адрес из него выдаётся вместе с IPv4
+SERVER_1_WG_POOLS = os.getenv('SERVER_1_WG_POOLS', '10.66.66.0/24')
+SERVER_1_WG_POOLS_V6 = os.getenv('SERVER_1_WG_POOLS_V6', '')
+SERVER_2_WG_POOLS = os.getenv('SERVER_2_WG_POOLS', '10.66.66.0/24')
+SERVER_2_WG_POOLS_V6 = os.getenv('SERVER_2_WG_POOLS_V6', '')
+
+# Применение peer'ов на wg0 пачками: 'set' (wg set) или 'syncconf'
+WG_SYNC_MODE = os.getenv('WG_SYNC_MODE', 'set')
+WG_SYNC_WINDOW_MS = int(os.getenv('WG_SYNC_WINDOW_MS', '50'))
+WG_SYNC_MAX_BATCH = 100  # peer'ов в одном вызове wg
+
+# Вызовы wg/wg-quick: таймаут и предел одновременных процессов
+WG_COMMAND_TIMEOUT = int(os.getenv('WG_COMMAND_TIMEOUT', '10'))
+WG_MAX_CONCURRENT_COMMANDS = int(os.getenv('WG_MAX_CONCURRENT_COMMANDS', '4'))
+
+# Тёплый пул заранее добавленных peer'ов для мгновенной выдачи (0 - выключен)
+WG_WARM_POOL_SIZE = int(os.getenv('WG_WARM_POOL_SIZE', '20'))
+WG_WARM_POOL_REFILL_BATCH = 10  # peer'ов, готовящихся одновременно
+
+# Сверка wg0 с БД: при старте и периодически; dry-run - только отчёт
+WG_RECONCILE_INTERVAL_SECONDS = int(os.getenv('WG_RECONCILE_INTERVAL_SECONDS', '900'))
+WG_RECONCILE_DRY_RUN = os.getenv('WG_RECONCILE_DRY_RUN', '0') == '1'
+# Сколько секунд выданные адреса без записи peer'а считаются создаваемым peer'ом
+WG_RECONCILE_GRACE_SECONDS = int(os.getenv('WG_RECONCILE_GRACE_SECONDS', '600'))
+
+# Бэкенды выдачи ключей по протоколам: 'wireguard' и 'marzban' - рабочие,
+# 'fake' - в памяти, для нагрузочной проверки бота без root и панели
+WIREGUARD_BACKEND = os.getenv('WIREGUARD_BACKEND', 'wireguard')
+V2RAY_BACKEND = os.getenv('V2RAY_BACKEND', 'marzban')
+VPN_BACKENDS = {'wireguard': WIREGUARD_BACKEND, 'v2ray': V2RAY_BACKEND}
+FAKE_BACKEND_LATENCY_MS = int(os.getenv('FAKE_BACKEND_LATENCY_MS', '50'))  # средняя задержка операции
+FAKE_BACKEND_FAILURE_RATE = float(os.getenv('FAKE_BACKEND_FAILURE_RATE', '0'))  # доля операций с ошибкой
+
+# Узлы WireGuard: как бот управляет wg на сервере ('local' - на этой
+# машине; 'ssh' - по SSH; пусто - сервер не получает новых peer'ов)
+SERVER_1_WG_DRIVER = os.getenv('SERVER_1_WG_DRIVER', 'local')
+SERVER_2_WG_DRIVER = os.getenv('SERVER_2_WG_DRIVER', '')
+WG_NODES = {1: SERVER_1_WG_DRIVER, 2: SERVER_2_WG_DRIVER}
+
+# Доступ по SSH к узлам с драйвером 'ssh' (ключ - путь к приватному ключу)
+SERVER_1_SSH_HOST = os.getenv('SERVER_1_SSH_HOST', SERVER_1_IP)
+SERVER_1_SSH_PORT = int(os.getenv('SERVER_1_SSH_PORT', '22'))
+SERVER_1_SSH_USER = os.getenv('SERVER_1_SSH_USER', 'root')
+SERVER_1_SSH_KEY = os.getenv('SERVER_1_SSH_KEY')
+SERVER_2_SSH_HOST = os.getenv('SERVER_2_SSH_HOST', SERVER_2_IP)
+SERVER_2_SSH_PORT = int(os.getenv('SERVER_2_SSH_PORT', '22'))
+SERVER_2_SSH_USER = os.getenv('SERVER_2_SSH_USER', 'root')
+SERVER_2_SSH_KEY = os.getenv('SERVER_2_SSH_KEY')
+WG_SSH = {
+    1: {'host': SERVER_1_SSH_HOST, 'port': SERVER_1_SSH_PORT,
+        'username': SERVER_1_SSH_USER, 'key_filename': SERVER_1_SSH_KEY},
+    2: {'host': SERVER_2_SSH_HOST, 'port': SERVER_2_SSH_PORT,
+        'username': SERVER_2_SSH_USER, 'key_filename': SERVER_2_SSH_KEY},
+}
+# Ключи хостов: known_hosts (по умолчанию системный); неизвестный хост
+# отклоняется, если не выключить проверку (только для тестового sshd)
+WG_SSH_KNOWN_HOSTS = os.getenv('WG_SSH_KNOWN_HOSTS')
+WG_SSH_STRICT_HOST_KEYS = os.getenv('WG_SSH_STRICT_HOST_KEYS', '1') == '1'
+WG_SSH_POOL_SIZE = int(os.getenv('WG_SSH_POOL_SIZE', '2'))  # соединений на сервер
+
+# Размещение новых peer'ов на наименее загруженном сервере
+PLACEMENT_CACHE_SECONDS = 30  # как долго переиспользуется снимок нагрузки
+PLACEMENT_HANDSHAKE_WINDOW = 180  # peer активен, если рукопожатие не старше, с
+PLACEMENT_HANDSHAKE_WEIGHT = 2  # вес активного peer'а относительно простаивающего
+REBALANCE_IDLE_DAYS = 14  # /rebalance переносит peer'ы без рукопожатий дольше
+REBALANCE_MAX_PEERS = 50  # peer'ов за один запуск /rebalance
+
+# Статистика трафика peer'ов из `wg show dump`: период сбора и глубина
+# кольцевых буферов поминутных, почасовых и посуточных сумм
+TELEMETRY_INTERVAL_SECONDS = int(os.getenv('TELEMETRY_INTERVAL_SECONDS', '30'))
+TELEMETRY_MINUTES = 120
+TELEMETRY_HOURS = 48
+TELEMETRY_DAYS = 60
+
+WG_POOLS = {
+    server: {
+        'ipv4': [prefix.strip() for prefix in ipv4.split(',') if prefix.strip()],
+        'ipv6': [prefix.strip() for prefix in ipv6.split(',') if prefix.strip()],
+    }
+    for server, ipv4, ipv6 in (
+        (1, SERVER_1_WG_POOLS, SERVER_1_WG_POOLS_V6),
+        (2, SERVER_2_WG_POOLS, SERVER_2_WG_POOLS_V6),
+    )
+}
\ No newline at end of file
@@ -1,16 +1,455 @@
-import sqlite3
-from datetime import datetime, timedelta
-from config import TRIAL_DURATION_DAYS, MAX_DEVICES
+import asyncio
+import contextlib
+import contextvars
+import os
+import time
+import aiosqlite
+from datetime import datetime
+from config import (
+    TRIAL_DURATION_DAYS, MAX_DEVICES,
+    DB_FILE, DB_WAL_MODE, DB_SYNCHRONOUS, DB_READER_POOL_SIZE, DB_BUSY_TIMEOUT_MS,
+    DB_GROUP_COMMIT_MS, DB_GROUP_COMMIT_MAX_UNITS, DB_MIGRATION_BATCH,
+    ADMIN_PAGE_SIZE, CACHE_MAX_ENTRIES, CACHE_TTL_SECONDS,
+    ARCHIVE_AFTER_DAYS, ARCHIVE_BATCH_SIZE, REAPER_BATCH_SIZE,
+    TELEMETRY_MINUTES, TELEMETRY_HOURS, TELEMETRY_DAYS
+)
+from utils.cache import TTLCache, MISSING
+from models import User, Subscription, Payment, UserPreferences, WgPeer
+
+DAY = 86400
+
+# Разрешения статистики трафика: (шаг в секундах, ячеек в кольце).
+# Ячейка - bucket_ts // шаг % ячеек; запись нового интервала в занятую
+# ячейку затирает старый, поэтому объём ограничен peer'ами * ячейками
+USAGE_RESOLUTIONS = (
+    (60, TELEMETRY_MINUTES),
+    (3600, TELEMETRY_HOURS),
+    (DAY, TELEMETRY_DAYS),
+)
+
+# Версия схемы (PRAGMA user_version)
+# 1 - даты подписок и платежей хранятся в целых UTC epoch-колонках *_ts
+# 2 - счётчики статистики в таблице stats
+SCHEMA_VERSION = 2
+
+# Открытая единица работы текущей задачи (см. Database.transaction)
+_current_tx = contextvars.ContextVar('current_tx', default=None)
+
+# Колонки, добавленные после первой версии схемы: (таблица, колонка, тип)
+ADDED_COLUMNS = (
+    ('subscriptions', 'start_ts', 'INTEGER'),
+    ('subscriptions', 'end_ts', 'INTEGER'),
+    ('payments', 'created_ts', 'INTEGER'),
+    ('wg_addresses', 'allocated_ts', 'INTEGER'),
+)
+
+# Триггеры, поддерживающие счётчики таблицы stats в тех же транзакциях,
+# что и сами изменения. Удаление строк (архивация) счётчики не уменьшает.
+STATS_TRIGGERS = (
+    '''CREATE TRIGGER IF NOT EXISTS stats_user_insert AFTER INSERT ON users
+    BEGIN
+        INSERT INTO stats (name, value) VALUES ('users', 1)
+        ON CONFLICT (name) DO UPDATE SET value = value + 1;
+    END''',
+    '''CREATE TRIGGER IF NOT EXISTS stats_subscription_insert AFTER INSERT ON subscriptions
+    BEGIN
+        INSERT INTO stats (name, value)
+        VALUES (CASE WHEN NEW.is_trial THEN 'subscriptions:trial' ELSE 'subscriptions:paid' END, 1)
+        ON CONFLICT (name) DO UPDATE SET value = value + 1;
+    END''',
+    # Продление переводит пробную подписку в платную
+    '''CREATE TRIGGER IF NOT EXISTS stats_subscription_type AFTER UPDATE OF is_trial ON subscriptions
+    WHEN OLD.is_trial != NEW.is_trial
+    BEGIN
+        UPDATE stats SET value = value - 1
+        WHERE name = CASE WHEN OLD.is_trial THEN 'subscriptions:trial' ELSE 'subscriptions:paid' END;
+        INSERT INTO stats (name, value)
+        VALUES (CASE WHEN NEW.is_trial THEN 'subscriptions:trial' ELSE 'subscriptions:paid' END, 1)
+        ON CONFLICT (name) DO UPDATE SET value = value + 1;
+    END''',
+    '''CREATE TRIGGER IF NOT EXISTS stats_payment_insert AFTER INSERT ON payments
+    WHEN NEW.status = 'paid'
+    BEGIN
+        INSERT INTO stats (name, value) VALUES ('payments:' || NEW.payment_method, 1)
+        ON CONFLICT (name) DO UPDATE SET value = value + 1;
+        INSERT INTO stats (name, value) VALUES ('revenue:' || NEW.payment_method, NEW.amount)
+        ON CONFLICT (name) DO UPDATE SET value = value + excluded.value;
+    END''',
+    '''CREATE TRIGGER IF NOT EXISTS stats_payment_paid AFTER UPDATE OF status ON payments
+    WHEN (OLD.status = 'paid') != (NEW.status = 'paid')
+    BEGIN
+        INSERT INTO stats (name, value)
+        VALUES ('payments:' || NEW.payment_method, CASE WHEN NEW.status = 'paid' THEN 1 ELSE -1 END)
+        ON CONFLICT (name) DO UPDATE SET value = value + excluded.value;
+        INSERT INTO stats (name, value)
+        VALUES ('revenue:' || NEW.payment_method,
+                CASE WHEN NEW.status = 'paid' THEN NEW.amount ELSE -NEW.amount END)
+        ON CONFLICT (name) DO UPDATE SET value = value + excluded.value;
+    END''',
+)
+
+# Индексы горячих запросов (создаются идемпотентно при старте)
+INDEXES = (
+    'CREATE INDEX IF NOT EXISTS idx_subscriptions_user_end_ts '
+    'ON subscriptions (user_id, is_active, end_ts)',
+    'CREATE INDEX IF NOT EXISTS idx_subscriptions_active_end_trial '
+    'ON subscriptions (is_active, end_ts, is_trial)',
+    'CREATE INDEX IF NOT EXISTS idx_subscriptions_trial_page '
+    'ON subscriptions (is_trial, end_ts, user_id)',
+    'CREATE INDEX IF NOT EXISTS idx_payments_payment_id '
+    'ON payments (payment_id)',
+    'CREATE INDEX IF NOT EXISTS idx_payments_created_ts '
+    'ON payments (created_ts)',
+    'CREATE INDEX IF NOT EXISTS idx_payments_status_method '
+    'ON payments (status, payment_method, amount)',
+    # архивация оплаченных платежей
+    'CREATE INDEX IF NOT EXISTS idx_payments_status_created '
+    'ON payments (status, created_ts)',
+    'CREATE INDEX IF NOT EXISTS idx_payments_user '
+    'ON payments (user_id, created_ts)',
+    'CREATE INDEX IF NOT EXISTS idx_subscriptions_archive_user '
+    'ON subscriptions_archive (user_id, end_ts)',
+    'CREATE INDEX IF NOT EXISTS idx_payments_archive_user '
+    'ON payments_archive (user_id, created_ts)',
+    # Свободные адреса пула - список освобождённых хостов
+    'CREATE INDEX IF NOT EXISTS idx_wg_addresses_free '
+    'ON wg_addresses (pool, host) WHERE allocated = 0',
+    'CREATE INDEX IF NOT EXISTS idx_wg_addresses_key '
+    'ON wg_addresses (public_key)',
+    'CREATE INDEX IF NOT EXISTS idx_wg_pool_peers_server '
+    'ON wg_pool_peers (server, id)',
+    # не больше одного действующего peer'а у пользователя на сервере
+    'CREATE UNIQUE INDEX IF NOT EXISTS idx_wg_peers_user_active '
+    'ON wg_peers (user_id, server) WHERE revoked_ts IS NULL',
+    'CREATE INDEX IF NOT EXISTS idx_wg_peers_server_active '
+    'ON wg_peers (server) WHERE revoked_ts IS NULL',
+    # статистика трафика пользователя - по всем его peer'ам, включая отозванные
+    'CREATE INDEX IF NOT EXISTS idx_wg_peers_user '
+    'ON wg_peers (user_id)',
+    # отозван ли ключ с выданными адресами - для сверки
+    'CREATE INDEX IF NOT EXISTS idx_wg_peers_key '
+    'ON wg_peers (public_key)',
+    # очистка колец трафика и топ пользователей за период
+    'CREATE INDEX IF NOT EXISTS idx_wg_usage_step_bucket '
+    'ON wg_usage (step, bucket_ts)',
+)
+
+# Индексы по старым текстовым датам, заменённые индексами по *_ts
+DROPPED_INDEXES = (
+    'idx_subscriptions_user_active',
+    'idx_subscriptions_active_end',
+    'idx_subscriptions_trial_end',
+    'idx_payments_created_at',
+    'idx_subscriptions_active_end_ts',  # заменён покрывающим (is_active, end_ts, is_trial)
+    'idx_subscriptions_trial_end_ts',  # заменён (is_trial, end_ts, user_id) для постраничного вывода
+)
+
+
+class PoolExhausted(Exception):
+    """В пуле адресов WireGuard не осталось свободных хостов"""
+
+
+class PeerExists(Exception):
+    """У пользователя уже есть действующий peer на сервере"""
+
+
+def now_ts():
+    """Текущее время в UTC epoch-секундах"""
+    return int(time.time())
+
+
+def from_epoch(ts):
+    """epoch -> локальный наивный datetime (для отображения)"""
+    return datetime.fromtimestamp(ts)
 
 class Database:
-    def __init__(self, db_file='database.db'):
-        self.connection = sqlite3.connect(db_file, check_same_thread=False)
-        self.cursor = self.connection.cursor()
-        self.create_tables()
-    
-    def create_tables(self):
+    """
+    Асинхронный слой доступа к SQLite (aiosqlite).
+    Все изменения идут через одно выделенное соединение-писатель,
+    которым владеет фоновая задача: она собирает единицы работы,
+    пришедшие в течение DB_GROUP_COMMIT_MS, и фиксирует их одним
+    COMMIT. Чтения берут соединение из пула: в режиме WAL это
+    несколько read-only соединений, которые не ждут писателя.
+    """
+
+    def __init__(self, db_file=DB_FILE, wal=DB_WAL_MODE, readers=DB_READER_POOL_SIZE):
+        self.db_file = db_file
+        self.wal = wal
+        self.readers_count = readers if wal else 1
+        self.writer = None
+        self.readers = []
+        self._reader_pool = asyncio.Queue()
+        self._write_queue = asyncio.Queue()
+        self._writer_task = None
+
+        # Кэш горячих чтений; сбрасывается после фиксации соответствующих записей
+        self.users_cache = TTLCache(CACHE_MAX_ENTRIES, CACHE_TTL_SECONDS)
+        self.preferences_cache = TTLCache(CACHE_MAX_ENTRIES, CACHE_TTL_SECONDS)
+        self.subscriptions_cache = TTLCache(CACHE_MAX_ENTRIES, CACHE_TTL_SECONDS)
+
+    async def connect(self):
+        """Открывает соединения и создаёт таблицы"""
+        self.writer = await aiosqlite.connect(self.db_file, isolation_level=None)
+        await self.writer.execute(f'PRAGMA busy_timeout = {DB_BUSY_TIMEOUT_MS}')
+        if self.wal:
+            await self.writer.execute('PRAGMA journal_mode = WAL')
+            await self.writer.execute(f'PRAGMA synchronous = {DB_SYNCHRONOUS}')
+        await self.create_tables()
+
+        for _ in range(self.readers_count):
+            reader = await self._open_reader()
+            self.readers.append(reader)
+            self._reader_pool.put_nowait(reader)
+
+        self._writer_task = asyncio.create_task(self._writer_loop())
+
+        await self._migrate()
+
+    async def _open_reader(self):
+        if not self.wal:
+            reader = await aiosqlite.connect(self.db_file)
+        else:
+            path = os.path.abspath(self.db_file)
+            reader = await aiosqlite.connect(f'file:{path}?mode=ro', uri=True)
+            await reader.execute('PRAGMA query_only = 1')
+        await reader.execute(f'PRAGMA busy_timeout = {DB_BUSY_TIMEOUT_MS}')
+        return reader
+
+    @contextlib.asynccontextmanager
+    async def _reader(self):
+        reader = await self._reader_pool.get()
+        try:
+            yield reader
+        finally:
+            self._reader_pool.put_nowait(reader)
+
+    async def _fetchone(self, query, params=(), record=None):
+        """Одна строка: кортеж или, если задан record, запись этого типа"""
+        async with self._reader() as reader:
+            async with reader.execute(query, params) as cursor:
+                if record:
+                    cursor.row_factory = record.row_factory([d[0] for d in cursor.description])
+                return await cursor.fetchone()
+
+    async def _fetchall(self, query, params=(), record=None):
+        """Все строки: кортежи или, если задан record, записи этого типа"""
+        async with self._reader() as reader:
+            async with reader.execute(query, params) as cursor:
+                if record:
+                    cursor.row_factory = record.row_factory([d[0] for d in cursor.description])
+                return await cursor.fetchall()
+
+    async def _write(self, query, params=(), invalidate=()):
+        """
+        Выполняет изменение через писателя. invalidate - пары (кэш, ключ),
+        которые сбрасываются после фиксации изменения.
+        """
+        tx = _current_tx.get()
+        if tx is not None:
+            statements, after_commit = tx
+            statements.append((query, params))
+            after_commit.extend(invalidate)
+            return
+        await self._submit([(query, params)])
+        for cache, key in invalidate:
+            cache.invalidate(key)
+
+    async def _cached(self, cache, key, load):
+        """Чтение через кэш: при промахе вызывает load() и запоминает результат"""
+        value = cache.get(key)
+        if value is MISSING:
+            version = cache.version(key)
+            value = await load()
+            cache.set(key, value, version)
+        return value
+
+    def cache_stats(self):
+        """Счётчики попаданий/промахов кэшей"""
+        return {
+            'users': self.users_cache.stats(),
+            'preferences': self.preferences_cache.stats(),
+            'subscriptions': self.subscriptions_cache.stats(),
+        }
+
+    async def _submit(self, work):
+        """
+        Ставит единицу работы в очередь писателя и ждёт её фиксации.
+        work - список (запрос, параметры) или корутина-функция,
+        получающая соединение писателя; её результат возвращается.
+        """
+        future = asyncio.get_running_loop().create_future()
+        self._write_queue.put_nowait((work, future))
+        return await future
+
+    @contextlib.asynccontextmanager
+    async def transaction(self):
+        """
+        Единица работы: все изменения внутри блока фиксируются одним
+        COMMIT при выходе из него (или не фиксируются вовсе).
+
+            async with db.transaction():
+                await db.add_subscription(...)
+                await db.update_payment_status(...)
+
+        Методы записи внутри блока только накапливают запросы, поэтому
+        ошибка фиксации выбрасывается при выходе из блока.
+        Вложенный блок присоединяется к внешнему.
+        """
+        if _current_tx.get() is not None:
+            yield
+            return
+
+        statements, after_commit = [], []
+        token = _current_tx.set((statements, after_commit))
+        try:
+            yield
+        finally:
+            _current_tx.reset(token)
+
+        if statements:
+            await self._submit(statements)
+        for cache, key in after_commit:
+            cache.invalidate(key)
+
+    async def _writer_loop(self):
+        loop = asyncio.get_running_loop()
+        window = DB_GROUP_COMMIT_MS / 1000
+
+        while True:
+            unit = await self._write_queue.get()
+            if unit is None:
+                return
+            batch = [unit]
+
+            # Групповая фиксация: ждём ещё единицы работы в пределах окна
+            deadline = loop.time() + window
+            while len(batch) < DB_GROUP_COMMIT_MAX_UNITS:
+                if not self._write_queue.empty():
+                    unit = self._write_queue.get_nowait()
+                else:
+                    timeout = deadline - loop.time()
+                    if timeout <= 0:
+                        break
+                    try:
+                        unit = await asyncio.wait_for(self._write_queue.get(), timeout)
+                    except asyncio.TimeoutError:
+                        break
+                if unit is None:
+                    self._write_queue.put_nowait(None)
+                    break
+                batch.append(unit)
+
+            try:
+                await self._apply_batch(batch)
+            except Exception as e:
+                # Например, не удался сам ROLLBACK: писатель продолжает
+                # работу, иначе следующие _submit ждали бы вечно
+                print(f"Error applying batch: {e}")
+                for _, future in batch:
+                    if not future.done():
+                        future.set_exception(e)
+
+    async def _apply_batch(self, batch):
+        """Выполняет пачку единиц работы в одной транзакции"""
+        results = []
+        try:
+            await self.writer.execute('BEGIN IMMEDIATE')
+            for work, future in batch:
+                # Каждая единица в своей точке сохранения: ошибка одной
+                # не откатывает остальные
+                await self.writer.execute('SAVEPOINT unit')
+                try:
+                    if callable(work):
+                        result = await work(self.writer)
+                    else:
+                        for query, params in work:
+                            await self.writer.execute(query, params)
+                        result = True
+                    await self.writer.execute('RELEASE unit')
+                    results.append((future, result, None))
+                except Exception as e:
+                    await self.writer.execute('ROLLBACK TO unit')
+                    await self.writer.execute('RELEASE unit')
+                    results.append((future, None, e))
+            await self.writer.execute('COMMIT')
+        except Exception as e:
+            print(f"Error committing batch: {e}")
+            if self.writer.in_transaction:
+                await self.writer.execute('ROLLBACK')
+            results = [(future, None, e) for _, future in batch]
+
+        for future, result, error in results:
+            if future.done():
+                continue
+            if error is None:
+                future.set_result(result)
+            else:
+                future.set_exception(error)
+
+    # ========================================
+    # МИГРАЦИИ
+    # ========================================
+
+    async def _migrate(self):
+        """Применяет шаги миграции, которых ещё не было в этой базе"""
+        row = await self._fetchone('PRAGMA user_version')
+        version = row[0]
+        if version >= SCHEMA_VERSION:
+            return
+
+        if version < 1:
+            await self._migrate_epochs()
+            print("Migration to epoch timestamps finished")
+        if version < 2:
+            await self._submit(self._rebuild_stats)
+            print("Stats table rebuilt")
+
+        await self._submit([(f'PRAGMA user_version = {SCHEMA_VERSION}', ())])
+
+    async def _migrate_epochs(self):
+        """
+        Онлайн-миграция на целые epoch-колонки: старые текстовые даты
+        переносятся пачками по DB_MIGRATION_BATCH строк обычными единицами
+        работы писателя, поэтому остальные записи не блокируются надолго.
+        """
+        for table, column_from, updates in (
+            ('subscriptions', 'end_date',
+             "start_ts = CAST(strftime('%s', start_date, 'utc') AS INTEGER), "
+             "end_ts = CAST(strftime('%s', end_date, 'utc') AS INTEGER)"),
+            # CURRENT_TIMESTAMP уже в UTC
+            ('payments', 'created_at',
+             "created_ts = CAST(strftime('%s', created_at) AS INTEGER)"),
+        ):
+            row = await self._fetchone(f'SELECT COALESCE(MAX(id), 0) FROM {table}')
+            max_id = row[0]
+            for first_id in range(0, max_id, DB_MIGRATION_BATCH):
+                await self._submit([(f'''
+                    UPDATE {table} SET {updates}
+                    WHERE id > ? AND id <= ? AND {column_from} IS NOT NULL
+                ''', (first_id, first_id + DB_MIGRATION_BATCH))])
+
+    @staticmethod
+    async def _rebuild_stats(connection):
+        """Пересчитывает счётчики stats по текущим данным (один проход)"""
+        await connection.execute('DELETE FROM stats')
+        await connection.execute('''
+            INSERT INTO stats (name, value)
+            SELECT 'users', COUNT(*) FROM users
+            UNION ALL
+            SELECT 'subscriptions:trial', COUNT(*) FROM subscriptions WHERE is_trial = 1
+            UNION ALL
+            SELECT 'subscriptions:paid', COUNT(*) FROM subscriptions WHERE is_trial = 0
+            UNION ALL
+            SELECT 'payments:' || payment_method, COUNT(*) FROM payments
+            WHERE status = 'paid' GROUP BY payment_method
+            UNION ALL
+            SELECT 'revenue:' || payment_method, SUM(amount) FROM payments
+            WHERE status = 'paid' GROUP BY payment_method
+        ''')
+
+    async def create_tables(self):
         # Таблица пользователей
-        self.cursor.execute('''
+        await self.writer.execute('''
             CREATE TABLE IF NOT EXISTS users (
                 user_id INTEGER PRIMARY KEY,
                 username TEXT,
@@ -19,9 +458,9 @@ class Database:
                 created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
             )
         ''')
-        
+
         # Таблица подписок (добавлено поле user_uuid)
-        self.cursor.execute('''
+        await self.writer.execute('''
             CREATE TABLE IF NOT EXISTS subscriptions (
                 id INTEGER PRIMARY KEY AUTOINCREMENT,
                 user_id INTEGER,
@@ -31,12 +470,14 @@ class Database:
                 end_date TIMESTAMP,
                 is_trial BOOLEAN DEFAULT 0,
                 is_active BOOLEAN DEFAULT 1,
+                start_ts INTEGER,
+                end_ts INTEGER,
                 FOREIGN KEY (user_id) REFERENCES users (user_id)
             )
         ''')
-        
+
         # Таблица платежей
-        self.cursor.execute('''
+        await self.writer.execute('''
             CREATE TABLE IF NOT EXISTS payments (
                 id INTEGER PRIMARY KEY AUTOINCREMENT,
                 user_id INTEGER,
@@ -45,11 +486,12 @@ class Database:
                 payment_method TEXT,
                 status TEXT,
                 created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                created_ts INTEGER,
                 FOREIGN KEY (user_id) REFERENCES users (user_id)
             )
         ''')
 
-        self.cursor.execute('''
+        await self.writer.execute('''
             CREATE TABLE IF NOT EXISTS user_preferences (
                 user_id INTEGER PRIMARY KEY,
                 selected_server INTEGER DEFAULT 1,
@@ -57,264 +499,1086 @@ class Database:
                 FOREIGN KEY (user_id) REFERENCES users (user_id)
             )
         ''')
-        
-        self.connection.commit()
-    
-    def add_user(self, user_id, username, referrer_id=None):
+
+        # Счётчики для админ-статистики (см. STATS_TRIGGERS)
+        await self.writer.execute('''
+            CREATE TABLE IF NOT EXISTS stats (
+                name TEXT PRIMARY KEY,
+                value REAL NOT NULL DEFAULT 0
+            )
+        ''')
+
+        # Архив: истёкшие подписки и старые платежи, вынесенные из горячих таблиц
+        await self.writer.execute('''
+            CREATE TABLE IF NOT EXISTS subscriptions_archive (
+                id INTEGER PRIMARY KEY,
+                user_id INTEGER,
+                vpn_key TEXT,
+                user_uuid TEXT,
+                start_ts INTEGER,
+                end_ts INTEGER,
+                is_trial BOOLEAN,
+                is_active BOOLEAN,
+                archived_ts INTEGER
+            )
+        ''')
+
+        await self.writer.execute('''
+            CREATE TABLE IF NOT EXISTS payments_archive (
+                id INTEGER PRIMARY KEY,
+                user_id INTEGER,
+                amount REAL,
+                payment_id TEXT,
+                payment_method TEXT,
+                status TEXT,
+                created_ts INTEGER,
+                archived_ts INTEGER
+            )
+        ''')
+
+        # Пулы адресов WireGuard: next_host - граница ещё не выданных хостов,
+        # ниже неё каждый хост записан в wg_addresses (занят или свободен)
+        await self.writer.execute('''
+            CREATE TABLE IF NOT EXISTS wg_pools (
+                name TEXT PRIMARY KEY,
+                next_host INTEGER NOT NULL,
+                size INTEGER NOT NULL
+            )
+        ''')
+
+        await self.writer.execute('''
+            CREATE TABLE IF NOT EXISTS wg_addresses (
+                pool TEXT NOT NULL,
+                host INTEGER NOT NULL,
+                public_key TEXT,
+                allocated INTEGER NOT NULL DEFAULT 1,
+                allocated_ts INTEGER,
+                PRIMARY KEY (pool, host)
+            ) WITHOUT ROWID
+        ''')
+
+        # Peer'ы WireGuard пользователей: конфиг рендерится из этих полей,
+        # version меняется при любом изменении peer'а
+        await self.writer.execute('''
+            CREATE TABLE IF NOT EXISTS wg_peers (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                user_id INTEGER NOT NULL,
+                server INTEGER NOT NULL,
+                private_key TEXT NOT NULL,
+                public_key TEXT NOT NULL,
+                preshared_key TEXT NOT NULL,
+                addresses TEXT NOT NULL,
+                version INTEGER NOT NULL DEFAULT 1,
+                created_ts INTEGER,
+                revoked_ts INTEGER
+            )
+        ''')
+
+        # Тёплый пул: peer'ы, уже добавленные на wg0, но ещё никому не выданные
+        await self.writer.execute('''
+            CREATE TABLE IF NOT EXISTS wg_pool_peers (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                server INTEGER NOT NULL,
+                private_key TEXT NOT NULL,
+                public_key TEXT NOT NULL,
+                preshared_key TEXT NOT NULL,
+                addresses TEXT NOT NULL,
+                created_ts INTEGER
+            )
+        ''')
+
+        # Кольцевые буферы трафика peer'ов и серверов (см. USAGE_RESOLUTIONS):
+        # step - шаг разрешения, slot - ячейка кольца, bucket_ts - начало
+        # интервала, который сейчас в ячейке
+        await self.writer.execute('''
+            CREATE TABLE IF NOT EXISTS wg_usage (
+                peer_id INTEGER NOT NULL,
+                step INTEGER NOT NULL,
+                slot INTEGER NOT NULL,
+                bucket_ts INTEGER NOT NULL,
+                rx INTEGER NOT NULL,
+                tx INTEGER NOT NULL,
+                handshake_ts INTEGER NOT NULL,
+                PRIMARY KEY (peer_id, step, slot)
+            ) WITHOUT ROWID
+        ''')
+
+        await self.writer.execute('''
+            CREATE TABLE IF NOT EXISTS wg_server_usage (
+                server INTEGER NOT NULL,
+                step INTEGER NOT NULL,
+                slot INTEGER NOT NULL,
+                bucket_ts INTEGER NOT NULL,
+                rx INTEGER NOT NULL,
+                tx INTEGER NOT NULL,
+                active INTEGER NOT NULL,
+                PRIMARY KEY (server, step, slot)
+            ) WITHOUT ROWID
+        ''')
+
+        # Колонки, которых нет в базах, созданных старыми версиями
+        for table, column, column_type in ADDED_COLUMNS:
+            async with self.writer.execute(f'PRAGMA table_info({table})') as cursor:
+                columns = [row[1] for row in await cursor.fetchall()]
+            if column not in columns:
+                await self.writer.execute(f'ALTER TABLE {table} ADD COLUMN {column} {column_type}')
+
+        for index in DROPPED_INDEXES:
+            await self.writer.execute(f'DROP INDEX IF EXISTS {index}')
+        for index in INDEXES:
+            await self.writer.execute(index)
+        for trigger in STATS_TRIGGERS:
+            await self.writer.execute(trigger)
+
+        await self.writer.commit()
+
+    async def add_user(self, user_id, username, referrer_id=None):
         try:
-            self.cursor.execute('''
+            await self._write('''
                 INSERT OR IGNORE INTO users (user_id, username, referrer_id)
                 VALUES (?, ?, ?)
-            ''', (user_id, username, referrer_id))
-            self.connection.commit()
+            ''', (user_id, username, referrer_id), invalidate=[(self.users_cache, user_id)])
             return True
         except Exception as e:
             print(f"Error adding user: {e}")
             return False
-    
-    def get_user(self, user_id):
-        self.cursor.execute('SELECT * FROM users WHERE user_id = ?', (user_id,))
-        return self.cursor.fetchone()
-    
-    def activate_trial(self, user_id, vpn_key, user_uuid):
-        start_date = datetime.now()
-        end_date = start_date + timedelta(days=TRIAL_DURATION_DAYS)
-        
+
+    async def get_user(self, user_id):
+        return await self._cached(
+            self.users_cache, user_id,
+            lambda: self._fetchone('''
+                SELECT user_id, username, referrer_id, balance
+                FROM users WHERE user_id = ?
+            ''', (user_id,), User)
+        )
+
+    async def activate_trial(self, user_id, vpn_key, user_uuid):
+        start_ts = now_ts()
+        end_ts = start_ts + TRIAL_DURATION_DAYS * DAY
+
         try:
-            self.cursor.execute('''
-                INSERT INTO subscriptions (user_id, vpn_key, user_uuid, start_date, end_date, is_trial, is_active)
+            await self._write('''
+                INSERT INTO subscriptions (user_id, vpn_key, user_uuid, start_ts, end_ts, is_trial, is_active)
                 VALUES (?, ?, ?, ?, ?, 1, 1)
-            ''', (user_id, vpn_key, user_uuid, start_date, end_date))
-            self.connection.commit()
+            ''', (user_id, vpn_key, user_uuid, start_ts, end_ts),
+                invalidate=[(self.subscriptions_cache, user_id)])
             return True
         except Exception as e:
             print(f"Error activating trial: {e}")
             return False
-    
-    def get_active_subscription(self, user_id):
-        self.cursor.execute('''
-            SELECT * FROM subscriptions 
-            WHERE user_id = ? AND is_active = 1 AND end_date > ?
-            ORDER BY end_date DESC LIMIT 1
-        ''', (user_id, datetime.now()))
-        return self.cursor.fetchone()
-    
-    def add_subscription(self, user_id, vpn_key, user_uuid, duration_days=30):
-        start_date = datetime.now()
-        end_date = start_date + timedelta(days=duration_days)
-        
+
+    async def get_active_subscription(self, user_id):
+        """Subscription без vpn_key (ключ не нужен для проверок подписки)"""
+        subscription = await self._cached(
+            self.subscriptions_cache, user_id,
+            lambda: self._fetchone('''
+                SELECT id, user_id, user_uuid, start_ts, end_ts, is_trial, is_active
+                FROM subscriptions
+                WHERE user_id = ? AND is_active = 1 AND end_ts > ?
+                ORDER BY end_ts DESC LIMIT 1
+            ''', (user_id, now_ts()), Subscription)
+        )
+        # Закэшированная подписка могла истечь, пока лежала в кэше
+        if subscription and subscription.end_ts <= now_ts():
+            self.subscriptions_cache.invalidate(user_id)
+            return None
+        return subscription
+
+    async def add_subscription(self, user_id, vpn_key, user_uuid, duration_days=30):
+        start_ts = now_ts()
+        end_ts = start_ts + duration_days * DAY
+
         try:
-            self.cursor.execute('''
-                INSERT INTO subscriptions (user_id, vpn_key, user_uuid, start_date, end_date, is_trial, is_active)
+            await self._write('''
+                INSERT INTO subscriptions (user_id, vpn_key, user_uuid, start_ts, end_ts, is_trial, is_active)
                 VALUES (?, ?, ?, ?, ?, 0, 1)
-            ''', (user_id, vpn_key, user_uuid, start_date, end_date))
-            self.connection.commit()
+            ''', (user_id, vpn_key, user_uuid, start_ts, end_ts),
+                invalidate=[(self.subscriptions_cache, user_id)])
             return True
         except Exception as e:
             print(f"Error adding subscription: {e}")
             return False
-    
-    def add_payment(self, user_id, amount, payment_id, payment_method='yoomoney', status='pending'):
+
+    async def renew_subscription(self, user_id, end_ts, vpn_key, user_uuid):
+        """Продлевает активную подписку до end_ts и переводит её в платную"""
         try:
-            self.cursor.execute('''
-                INSERT INTO payments (user_id, amount, payment_id, payment_method, status)
-                VALUES (?, ?, ?, ?, ?)
-            ''', (user_id, amount, payment_id, payment_method, status))
-            self.connection.commit()
+            await self._write('''
+                UPDATE subscriptions
+                SET end_ts = ?, is_trial = 0, vpn_key = ?, user_uuid = ?
+                WHERE user_id = ? AND is_active = 1
+            ''', (end_ts, vpn_key, user_uuid, user_id),
+                invalidate=[(self.subscriptions_cache, user_id)])
+            return True
+        except Exception as e:
+            print(f"Error renewing subscription: {e}")
+            return False
+
+    async def update_subscription_key(self, user_id, vpn_key, user_uuid):
+        """Обновляет ключ в активной подписке пользователя"""
+        try:
+            await self._write('''
+                UPDATE subscriptions
+                SET vpn_key = ?, user_uuid = ?
+                WHERE user_id = ? AND is_active = 1
+            ''', (vpn_key, user_uuid, user_id),
+                invalidate=[(self.subscriptions_cache, user_id)])
+            return True
+        except Exception as e:
+            print(f"Error updating subscription key: {e}")
+            return False
+
+    async def add_payment(self, user_id, amount, payment_id, payment_method='yoomoney', status='pending'):
+        try:
+            await self._write('''
+                INSERT INTO payments (user_id, amount, payment_id, payment_method, status, created_ts)
+                VALUES (?, ?, ?, ?, ?, ?)
+            ''', (user_id, amount, payment_id, payment_method, status, now_ts()))
             return True
         except Exception as e:
             print(f"Error adding payment: {e}")
             return False
-    
-    def update_payment_status(self, payment_id, status):
+
+    async def update_payment_status(self, payment_id, status):
         try:
-            self.cursor.execute('''
+            await self._write('''
                 UPDATE payments SET status = ? WHERE payment_id = ?
             ''', (status, payment_id))
-            self.connection.commit()
             return True
         except Exception as e:
             print(f"Error updating payment status: {e}")
             return False
-    
-    def get_payment(self, payment_id):
-        self.cursor.execute('SELECT * FROM payments WHERE payment_id = ?', (payment_id,))
-        return self.cursor.fetchone()
-    
-    def update_balance(self, user_id, amount):
+
+    async def get_payment(self, payment_id):
+        return await self._fetchone('''
+            SELECT id, user_id, amount, payment_id, payment_method, status
+            FROM payments WHERE payment_id = ?
+        ''', (payment_id,), Payment)
+
+    async def update_balance(self, user_id, amount):
         try:
-            self.cursor.execute('''
+            await self._write('''
                 UPDATE users SET balance = balance + ? WHERE user_id = ?
-            ''', (amount, user_id))
-            self.connection.commit()
+            ''', (amount, user_id), invalidate=[(self.users_cache, user_id)])
             return True
         except Exception as e:
             print(f"Error updating balance: {e}")
             return False
-    
+
     # ========================================
     # АДМИН ФУНКЦИИ
     # ========================================
-    
-    def get_all_users_count(self):
+
+    async def get_stats(self):
+        """
+        Сводная статистика для админ-панели. Итоги берутся из таблицы
+        stats (O(1)), активные подписки считаются по покрывающему индексу
+        только среди активных строк, истёкшие = всего - активные.
+        """
+        counter_rows = await self._fetchall('SELECT name, value FROM stats')
+        active_rows = await self._fetchall('''
+            SELECT is_trial, COUNT(*) FROM subscriptions
+            WHERE is_active = 1 AND end_ts > ?
+            GROUP BY is_trial
+        ''', (now_ts(),))
+        counters = dict(counter_rows)
+        active = dict(active_rows)
+
+        trial_total = int(counters.get('subscriptions:trial', 0))
+        paid_total = int(counters.get('subscriptions:paid', 0))
+        trial_active = active.get(1, 0)
+        paid_active = active.get(0, 0)
+
+        revenue_by_method = [
+            (name.split(':', 1)[1], int(count), counters.get('revenue:' + name.split(':', 1)[1], 0))
+            for name, count in counters.items()
+            if name.startswith('payments:') and count
+        ]
+
+        return {
+            'users': int(counters.get('users', 0)),
+            'active_subscriptions': trial_active + paid_active,
+            'trial_active': trial_active,
+            'trial_expired': trial_total - trial_active,
+            'paid_active': paid_active,
+            'paid_expired': paid_total - paid_active,
+            'total_revenue': sum(total for _, _, total in revenue_by_method),
+            'revenue_by_method': revenue_by_method,
+        }
+
+    async def get_all_users_count(self):
         """Получает общее количество пользователей"""
-        self.cursor.execute('SELECT COUNT(*) FROM users')
-        return self.cursor.fetchone()[0]
-    
-    def get_trial_users(self):
+        row = await self._fetchone("SELECT COALESCE(MAX(value), 0) FROM stats WHERE name = 'users'")
+        return int(row[0])
+
+    async def get_trial_users(self):
         """Получает всех пользователей с пробным периодом"""
-        self.cursor.execute('''
-            SELECT 
+        return await self._fetchall('''
+            SELECT
                 u.user_id,
                 u.username,
-                s.start_date,
-                s.end_date,
+                s.start_ts,
+                s.end_ts,
                 s.is_active
             FROM users u
             JOIN subscriptions s ON u.user_id = s.user_id
             WHERE s.is_trial = 1
-            ORDER BY s.end_date DESC
-        ''')
-        return self.cursor.fetchall()
-    
-    def get_paid_users(self):
+            ORDER BY s.end_ts DESC
+        ''', record=Subscription)
+
+    async def get_paid_users(self):
         """Получает всех пользователей с платной подпиской"""
-        self.cursor.execute('''
-            SELECT 
+        return await self._fetchall('''
+            SELECT
                 u.user_id,
                 u.username,
-                s.start_date,
-                s.end_date,
+                s.start_ts,
+                s.end_ts,
                 s.is_active
             FROM users u
             JOIN subscriptions s ON u.user_id = s.user_id
             WHERE s.is_trial = 0
-            ORDER BY s.end_date DESC
-        ''')
-        return self.cursor.fetchall()
-    
-    def get_active_subscriptions_count(self):
+            ORDER BY s.end_ts DESC
+        ''', record=Subscription)
+
+    async def get_users_page(self, is_trial, cursor=None, direction='next', limit=ADMIN_PAGE_SIZE):
+        """
+        Страница пользователей с пробной (is_trial=1) или платной подпиской,
+        упорядоченная по (end_ts, user_id) по убыванию. Keyset-пагинация:
+        cursor - (end_ts, user_id) граничной строки текущей страницы,
+        direction='next' - строки после неё, 'prev' - перед ней.
+        Возвращает (rows, has_prev, has_next), строки - Subscription
+        с user_id, username, start_ts, end_ts, is_active.
+        """
+        if cursor is None:
+            condition, params, order = '', (), 'DESC'
+        elif direction == 'next':
+            condition, params, order = 'AND (s.end_ts, s.user_id) < (?, ?)', tuple(cursor), 'DESC'
+        else:
+            condition, params, order = 'AND (s.end_ts, s.user_id) > (?, ?)', tuple(cursor), 'ASC'
+
+        rows = await self._fetchall(f'''
+            SELECT
+                u.user_id,
+                u.username,
+                s.start_ts,
+                s.end_ts,
+                s.is_active
+            FROM subscriptions s
+            JOIN users u ON u.user_id = s.user_id
+            WHERE s.is_trial = ? {condition}
+            ORDER BY s.end_ts {order}, s.user_id {order}
+            LIMIT ?
+        ''', (is_trial, *params, limit + 1), Subscription)
+
+        has_more = len(rows) > limit
+        rows = rows[:limit]
+        if cursor is not None and direction != 'next':
+            rows.reverse()
+            return rows, has_more, True
+        return rows, cursor is not None, has_more
+
+    async def get_active_subscriptions_count(self):
         """Получает количество активных подписок"""
-        self.cursor.execute('''
-            SELECT COUNT(*) FROM subscriptions 
-            WHERE is_active = 1 AND end_date > ?
-        ''', (datetime.now(),))
-        return self.cursor.fetchone()[0]
-    
-    def get_expired_subscriptions(self):
+        row = await self._fetchone('''
+            SELECT COUNT(*) FROM subscriptions
+            WHERE is_active = 1 AND end_ts > ?
+        ''', (now_ts(),))
+        return row[0]
+
+    async def get_expired_subscriptions(self):
         """Получает истекшие подписки"""
-        self.cursor.execute('''
-            SELECT 
+        return await self._fetchall('''
+            SELECT
                 u.user_id,
                 u.username,
                 s.user_uuid,
-                s.end_date,
+                s.end_ts,
                 s.is_trial
             FROM users u
             JOIN subscriptions s ON u.user_id = s.user_id
-            WHERE s.is_active = 1 AND s.end_date < ?
-        ''', (datetime.now(),))
-        return self.cursor.fetchall()
-    
-    def deactivate_subscription(self, user_id):
+            WHERE s.is_active = 1 AND s.end_ts < ?
+        ''', (now_ts(),), Subscription)
+
+    async def reap_expired_batch(self, limit=REAPER_BATCH_SIZE):
+        """
+        Деактивирует до limit истёкших подписок одной единицей работы.
+        Пользователям, у которых не осталось другой действующей подписки,
+        в той же транзакции отзываются peer'ы WireGuard.
+        Возвращает (деактивировано подписок, [пользователи без подписки],
+        [(сервер, public_key)] отозванных peer'ов).
+        """
+        now = now_ts()
+
+        async def reap(connection):
+            async with connection.execute('''
+                SELECT id, user_id FROM subscriptions
+                WHERE is_active = 1 AND end_ts < ?
+                LIMIT ?
+            ''', (now, limit)) as cursor:
+                rows = await cursor.fetchall()
+            if not rows:
+                return 0, [], []
+
+            await connection.executemany(
+                'UPDATE subscriptions SET is_active = 0 WHERE id = ?',
+                [(subscription_id,) for subscription_id, _ in rows]
+            )
+
+            expired_users = []
+            peers = []
+            for user_id in dict.fromkeys(user_id for _, user_id in rows):
+                # Продлённая или новая подписка - доступ не отзываем
+                async with connection.execute('''
+                    SELECT 1 FROM subscriptions
+                    WHERE user_id = ? AND end_ts >= ? AND is_active = 1
+                    LIMIT 1
+                ''', (user_id, now)) as cursor:
+                    if await cursor.fetchone():
+                        continue
+                expired_users.append(user_id)
+                async with connection.execute('''
+                    UPDATE wg_peers SET revoked_ts = ?, version = version + 1
+                    WHERE user_id = ? AND revoked_ts IS NULL
+                    RETURNING server, public_key
+                ''', (now, user_id)) as cursor:
+                    peers.extend(await cursor.fetchall())
+
+            return len(rows), expired_users, peers
+
+        deactivated, expired_users, peers = await self._submit(reap)
+        for user_id in expired_users:
+            self.subscriptions_cache.invalidate(user_id)
+        return deactivated, expired_users, [tuple(peer) for peer in peers]
+
+    async def deactivate_subscription(self, user_id):
         """Деактивирует подписку пользователя"""
         try:
-            self.cursor.execute('''
-                UPDATE subscriptions SET is_active = 0 
+            await self._write('''
+                UPDATE subscriptions SET is_active = 0
                 WHERE user_id = ? AND is_active = 1
-            ''', (user_id,))
-            self.connection.commit()
+            ''', (user_id,), invalidate=[(self.subscriptions_cache, user_id)])
             return True
         except Exception as e:
             print(f"Error deactivating subscription: {e}")
             return False
-    
-    def get_total_revenue(self):
+
+    async def get_total_revenue(self):
         """Получает общую сумму платежей"""
-        self.cursor.execute('''
-            SELECT COALESCE(SUM(amount), 0) FROM payments 
-            WHERE status = 'paid'
-        ''')
-        return self.cursor.fetchone()[0]
-    
-    def get_revenue_by_method(self):
-        """Получает статистику по методам оплаты"""
-        self.cursor.execute('''
-            SELECT 
-                payment_method,
-                COUNT(*) as count,
-                SUM(amount) as total
-            FROM payments
-            WHERE status = 'paid'
-            GROUP BY payment_method
-        ''')
-        return self.cursor.fetchall()
-    
-    def get_recent_payments(self, limit=10):
+        return (await self.get_stats())['total_revenue']
+
+    async def get_revenue_by_method(self):
+        """Получает статистику по методам оплаты: [(метод, кол-во, сумма)]"""
+        return (await self.get_stats())['revenue_by_method']
+
+    async def get_recent_payments(self, limit=10):
         """Получает последние платежи"""
-        self.cursor.execute('''
-            SELECT 
+        return await self._fetchall('''
+            SELECT
                 p.user_id,
                 u.username,
                 p.amount,
                 p.payment_method,
                 p.status,
-                p.created_at
+                p.created_ts
             FROM payments p
             JOIN users u ON p.user_id = u.user_id
-            ORDER BY p.created_at DESC
+            ORDER BY p.created_ts DESC
             LIMIT ?
-        ''', (limit,))
-        return self.cursor.fetchall()
-    
-    def get_expiring_subscriptions(self, days=3):
+        ''', (limit,), Payment)
+
+    async def get_expiring_subscriptions(self, days=3):
         """Получает подписки, которые истекают в ближайшие N дней"""
-        now = datetime.now()
-        future = now + timedelta(days=days)
-        
-        self.cursor.execute('''
-            SELECT 
+        now = now_ts()
+        future = now + days * DAY
+
+        return await self._fetchall('''
+            SELECT
                 u.user_id,
                 u.username,
-                s.end_date,
+                s.end_ts,
                 s.is_trial
             FROM users u
             JOIN subscriptions s ON u.user_id = s.user_id
-            WHERE s.is_active = 1 
-              AND s.end_date > ? 
-              AND s.end_date <= ?
-            ORDER BY s.end_date ASC
-        ''', (now, future))
-        
-        return self.cursor.fetchall()
-    
-    def get_user_preferences(self, user_id):
+            WHERE s.is_active = 1
+              AND s.end_ts > ?
+              AND s.end_ts <= ?
+            ORDER BY s.end_ts ASC
+        ''', (now, future), Subscription)
+
+    async def get_user_preferences(self, user_id):
         """Получает настройки сервера и протокола пользователя"""
-        self.cursor.execute('''
-            SELECT selected_server, selected_protocol 
-            FROM user_preferences 
-            WHERE user_id = ?
-        ''', (user_id,))
-        result = self.cursor.fetchone()
+        result = await self._cached(
+            self.preferences_cache, user_id,
+            lambda: self._fetchone('''
+                SELECT user_id, selected_server, selected_protocol
+                FROM user_preferences
+                WHERE user_id = ?
+            ''', (user_id,), UserPreferences)
+        )
         if result:
             return result
         else:
             # По умолчанию: Сервер 1, WireGuard
-            self.set_user_preferences(user_id, 1, 'wireguard')
-            return (1, 'wireguard')
-    
-    def set_user_preferences(self, user_id, server=1, protocol='wireguard'):
+            await self.set_user_preferences(user_id, 1, 'wireguard')
+            return UserPreferences(user_id=user_id, selected_server=1, selected_protocol='wireguard')
+
+    async def set_user_preferences(self, user_id, server=1, protocol='wireguard'):
         """Устанавливает настройки сервера и протокола"""
         try:
-            self.cursor.execute('''
+            await self._write('''
                 INSERT OR REPLACE INTO user_preferences (user_id, selected_server, selected_protocol)
                 VALUES (?, ?, ?)
-            ''', (user_id, server, protocol))
-            self.connection.commit()
+            ''', (user_id, server, protocol), invalidate=[(self.preferences_cache, user_id)])
             return True
         except Exception as e:
             print(f"Error setting preferences: {e}")
             return False
 
-    def close(self):
-        self.connection.close()
\ No newline at end of file
+    # ========================================
+    # АРХИВ
+    # ========================================
+
+    async def archive_batch(self, limit=ARCHIVE_BATCH_SIZE):
+        """
+        Переносит в архив не больше limit подписок и limit платежей
+        одной единицей работы. В архив уходят подписки, истёкшие более
+        ARCHIVE_AFTER_DAYS дней назад, и деактивированные истёкшие, а также
+        оплаченные платежи старше ARCHIVE_AFTER_DAYS. Неоплаченные остаются:
+        get_payment и update_payment_status читают только payments, а счёт
+        Stars может быть оплачен и позже.
+        Счётчики stats при этом не меняются.
+        Возвращает (перенесено подписок, перенесено платежей).
+        """
+        now = now_ts()
+        cutoff = now - ARCHIVE_AFTER_DAYS * DAY
+
+        async def move(connection):
+            async with connection.execute('''
+                SELECT id FROM subscriptions WHERE is_active = 0 AND end_ts < ?
+                UNION ALL
+                SELECT id FROM subscriptions WHERE is_active = 1 AND end_ts < ?
+                LIMIT ?
+            ''', (now, cutoff, limit)) as cursor:
+                subscription_ids = [row[0] for row in await cursor.fetchall()]
+
+            async with connection.execute('''
+                SELECT id FROM payments WHERE status = 'paid' AND created_ts < ? LIMIT ?
+            ''', (cutoff, limit)) as cursor:
+                payment_ids = [row[0] for row in await cursor.fetchall()]
+
+            if subscription_ids:
+                marks = ','.join('?' * len(subscription_ids))
+                await connection.execute(f'''
+                    INSERT OR REPLACE INTO subscriptions_archive
+                        (id, user_id, vpn_key, user_uuid, start_ts, end_ts, is_trial, is_active, archived_ts)
+                    SELECT id, user_id, vpn_key, user_uuid, start_ts, end_ts, is_trial, is_active, ?
+                    FROM subscriptions WHERE id IN ({marks})
+                ''', (now, *subscription_ids))
+                await connection.execute(
+                    f'DELETE FROM subscriptions WHERE id IN ({marks})', subscription_ids
+                )
+
+            if payment_ids:
+                marks = ','.join('?' * len(payment_ids))
+                await connection.execute(f'''
+                    INSERT OR REPLACE INTO payments_archive
+                        (id, user_id, amount, payment_id, payment_method, status, created_ts, archived_ts)
+                    SELECT id, user_id, amount, payment_id, payment_method, status, created_ts, ?
+                    FROM payments WHERE id IN ({marks})
+                ''', (now, *payment_ids))
+                await connection.execute(
+                    f'DELETE FROM payments WHERE id IN ({marks})', payment_ids
+                )
+
+            return len(subscription_ids), len(payment_ids)
+
+        return await self._submit(move)
+
+    async def get_subscription_history(self, user_id):
+        """Все подписки пользователя, включая архивные, от новых к старым"""
+        return await self._fetchall('''
+            SELECT id, user_id, user_uuid, start_ts, end_ts, is_trial, is_active
+            FROM subscriptions WHERE user_id = ?
+            UNION ALL
+            SELECT id, user_id, user_uuid, start_ts, end_ts, is_trial, is_active
+            FROM subscriptions_archive WHERE user_id = ?
+            ORDER BY end_ts DESC
+        ''', (user_id, user_id), Subscription)
+
+    async def get_payment_history(self, user_id):
+        """Все платежи пользователя, включая архивные, от новых к старым"""
+        return await self._fetchall('''
+            SELECT id, user_id, amount, payment_id, payment_method, status, created_ts
+            FROM payments WHERE user_id = ?
+            UNION ALL
+            SELECT id, user_id, amount, payment_id, payment_method, status, created_ts
+            FROM payments_archive WHERE user_id = ?
+            ORDER BY created_ts DESC
+        ''', (user_id, user_id), Payment)
+
+    # ========================================
+    # АДРЕСА WIREGUARD
+    # ========================================
+
+    async def register_wg_pool(self, pool, first_host, size, used=None):
+        """
+        Создаёт пул адресов, если его ещё нет. Хосты пула - номера
+        first_host..size-1 внутри подсети. used - {host: public_key} уже
+        занятых адресов (импорт с интерфейса при первом запуске).
+        Возвращает True, если пул создан сейчас.
+        """
+        used = used or {}
+
+        async def register(connection):
+            async with connection.execute(
+                'SELECT 1 FROM wg_pools WHERE name = ?', (pool,)
+            ) as cursor:
+                if await cursor.fetchone():
+                    return False
+
+            next_host = max([first_host - 1, *used]) + 1
+            await connection.execute(
+                'INSERT INTO wg_pools (name, next_host, size) VALUES (?, ?, ?)',
+                (pool, next_host, size)
+            )
+            # Пропуски ниже next_host сразу попадают в список свободных
+            await connection.executemany(
+                'INSERT INTO wg_addresses (pool, host, public_key, allocated) VALUES (?, ?, ?, ?)',
+                [
+                    (pool, host, used.get(host), 1 if host in used else 0)
+                    for host in range(first_host, next_host)
+                ]
+            )
+            return True
+
+        return await self._submit(register)
+
+    async def allocate_wg_addresses(self, families, public_key):
+        """
+        Выдаёт ключу по одному адресу из каждого семейства пулов
+        (например [[IPv4-пулы], [IPv6-пулы]]) одной единицей работы.
+        Внутри семейства пулы пробуются по порядку, хост берётся за O(1):
+        из списка освобождённых, иначе следующий за next_host.
+        Возвращает [(пул, хост)] или None, если какое-то семейство
+        исчерпано - тогда не выдаётся ничего.
+        """
+        async def allocate_host(connection, pool):
+            async with connection.execute(
+                'SELECT host FROM wg_addresses WHERE pool = ? AND allocated = 0 LIMIT 1', (pool,)
+            ) as cursor:
+                row = await cursor.fetchone()
+            if row:
+                await connection.execute(
+                    '''UPDATE wg_addresses SET allocated = 1, public_key = ?, allocated_ts = ?
+                    WHERE pool = ? AND host = ?''',
+                    (public_key, now_ts(), pool, row[0])
+                )
+                return row[0]
+
+            async with connection.execute('''
+                UPDATE wg_pools SET next_host = next_host + 1
+                WHERE name = ? AND next_host < size
+                RETURNING next_host - 1
+            ''', (pool,)) as cursor:
+                row = await cursor.fetchone()
+            if not row:
+                return None
+            await connection.execute(
+                '''INSERT INTO wg_addresses (pool, host, public_key, allocated, allocated_ts)
+                VALUES (?, ?, ?, 1, ?)''',
+                (pool, row[0], public_key, now_ts())
+            )
+            return row[0]
+
+        async def allocate(connection):
+            addresses = []
+            for pools in families:
+                for pool in pools:
+                    host = await allocate_host(connection, pool)
+                    if host is not None:
+                        addresses.append((pool, host))
+                        break
+                else:
+                    # Откат точки сохранения вернёт уже выданные адреса
+                    raise PoolExhausted()
+            return addresses
+
+        try:
+            return await self._submit(allocate)
+        except PoolExhausted:
+            return None
+
+    async def get_wg_pool_usage(self):
+        """{пул: (занято, next_host, size)} для отчёта о заполненности"""
+        rows = await self._fetchall('''
+            SELECT p.name,
+                   (SELECT COUNT(*) FROM wg_addresses a
+                    WHERE a.pool = p.name AND a.allocated = 1),
+                   p.next_host, p.size
+            FROM wg_pools p
+        ''')
+        return {name: (used, next_host, size) for name, used, next_host, size in rows}
+
+    async def release_wg_addresses(self, public_keys):
+        """Возвращает в пул адреса нескольких ключей одной единицей работы"""
+        try:
+            await self._submit([
+                ('''
+                    UPDATE wg_addresses SET allocated = 0, public_key = NULL
+                    WHERE public_key = ?
+                ''', (public_key,))
+                for public_key in public_keys
+            ])
+            return True
+        except Exception as e:
+            print(f"Error releasing WireGuard addresses: {e}")
+            return False
+
+    async def release_wg_address(self, public_key):
+        """Возвращает адреса ключа в список свободных"""
+        try:
+            await self._write('''
+                UPDATE wg_addresses SET allocated = 0, public_key = NULL
+                WHERE public_key = ?
+            ''', (public_key,))
+            return True
+        except Exception as e:
+            print(f"Error releasing WireGuard address: {e}")
+            return False
+
+    async def add_pool_peer(self, server, private_key, public_key, preshared_key, addresses):
+        """Кладёт подготовленный peer в тёплый пул"""
+        try:
+            await self._write('''
+                INSERT INTO wg_pool_peers
+                    (server, private_key, public_key, preshared_key, addresses, created_ts)
+                VALUES (?, ?, ?, ?, ?, ?)
+            ''', (server, private_key, public_key, preshared_key, addresses, now_ts()))
+            return True
+        except Exception as e:
+            print(f"Error adding pool peer: {e}")
+            return False
+
+    async def claim_pool_peer_for_user(self, user_id, server):
+        """
+        Выдаёт пользователю самый старый peer тёплого пула сервера:
+        DELETE ... RETURNING из wg_pool_peers и запись в wg_peers - одна
+        единица работы, поэтому сверка не застанет ключ ни в одной из
+        таблиц, а два клиента не получат один peer. Возвращает WgPeer;
+        None - пул пуст. Если у пользователя уже есть действующий peer
+        на сервере, пул не трогается и возвращается этот peer.
+        """
+        async def claim(connection):
+            async with connection.execute('''
+                DELETE FROM wg_pool_peers
+                WHERE id = (
+                    SELECT id FROM wg_pool_peers WHERE server = ? ORDER BY id LIMIT 1
+                )
+                RETURNING private_key, public_key, preshared_key, addresses
+            ''', (server,)) as cursor:
+                pooled = await cursor.fetchone()
+            if pooled is None:
+                return None
+
+            async with connection.execute('''
+                INSERT INTO wg_peers
+                    (user_id, server, private_key, public_key, preshared_key, addresses, created_ts)
+                VALUES (?, ?, ?, ?, ?, ?, ?)
+                ON CONFLICT (user_id, server) WHERE revoked_ts IS NULL DO NOTHING
+                RETURNING id, user_id, server, private_key, public_key, preshared_key,
+                          addresses, version
+            ''', (user_id, server, *pooled, now_ts())) as cursor:
+                cursor.row_factory = WgPeer.row_factory([d[0] for d in cursor.description])
+                peer = await cursor.fetchone()
+            if peer is None:
+                # Откат точки сохранения вернёт peer в пул
+                raise PeerExists()
+            return peer
+
+        try:
+            return await self._submit(claim)
+        except PeerExists:
+            return await self.get_wg_peer(user_id, server)
+        except Exception as e:
+            print(f"Error claiming pool peer: {e}")
+            return None
+
+    async def get_pool_peer_count(self, server):
+        row = await self._fetchone(
+            'SELECT COUNT(*) FROM wg_pool_peers WHERE server = ?', (server,)
+        )
+        return row[0]
+
+    async def get_wg_peer(self, user_id, server=None):
+        """
+        Действующий peer пользователя (WgPeer) на сервере или, если
+        server не задан, на любом сервере. None - peer'а нет.
+        """
+        if server is None:
+            return await self._fetchone('''
+                SELECT id, user_id, server, private_key, public_key, preshared_key,
+                       addresses, version
+                FROM wg_peers
+                WHERE user_id = ? AND revoked_ts IS NULL
+                ORDER BY id DESC LIMIT 1
+            ''', (user_id,), record=WgPeer)
+        return await self._fetchone('''
+            SELECT id, user_id, server, private_key, public_key, preshared_key,
+                   addresses, version
+            FROM wg_peers
+            WHERE user_id = ? AND server = ? AND revoked_ts IS NULL
+        ''', (user_id, server), record=WgPeer)
+
+    async def get_wg_peer_counts(self):
+        """{сервер: число действующих peer'ов}"""
+        rows = await self._fetchall('''
+            SELECT server, COUNT(*) FROM wg_peers
+            WHERE revoked_ts IS NULL
+            GROUP BY server
+        ''')
+        return dict(rows)
+
+    async def get_wg_peers_on_server(self, server):
+        """Действующие peer'ы сервера (id, user_id, public_key, created_ts) - для переноса"""
+        return await self._fetchall('''
+            SELECT id, user_id, public_key, created_ts FROM wg_peers
+            WHERE server = ? AND revoked_ts IS NULL
+            ORDER BY id
+        ''', (server,), WgPeer)
+
+    async def move_wg_peer(self, peer_id, user_id, server, private_key, public_key,
+                           preshared_key, addresses):
+        """
+        Переносит пользователя на другой сервер одной единицей работы:
+        старый peer отзывается, новый сохраняется. None - старый peer
+        уже отозван, перенос не выполнен.
+        """
+        async def move(connection):
+            async with connection.execute('''
+                UPDATE wg_peers SET revoked_ts = ?, version = version + 1
+                WHERE id = ? AND revoked_ts IS NULL
+                RETURNING id
+            ''', (now_ts(), peer_id)) as cursor:
+                if not await cursor.fetchone():
+                    return None
+            async with connection.execute('''
+                INSERT INTO wg_peers
+                    (user_id, server, private_key, public_key, preshared_key, addresses, created_ts)
+                VALUES (?, ?, ?, ?, ?, ?, ?)
+                RETURNING id
+            ''', (user_id, server, private_key, public_key, preshared_key, addresses,
+                  now_ts())) as cursor:
+                return (await cursor.fetchone())[0]
+
+        return await self._submit(move)
+
+    async def add_wg_peer(self, user_id, server, private_key, public_key, preshared_key, addresses):
+        """
+        Сохраняет peer пользователя и возвращает его (WgPeer). None -
+        у пользователя уже есть действующий peer на этом сервере.
+        """
+        async def add(connection):
+            async with connection.execute('''
+                INSERT INTO wg_peers
+                    (user_id, server, private_key, public_key, preshared_key, addresses, created_ts)
+                VALUES (?, ?, ?, ?, ?, ?, ?)
+                ON CONFLICT (user_id, server) WHERE revoked_ts IS NULL DO NOTHING
+                RETURNING id, user_id, server, private_key, public_key, preshared_key,
+                          addresses, version
+            ''', (user_id, server, private_key, public_key, preshared_key, addresses,
+                  now_ts())) as cursor:
+                cursor.row_factory = WgPeer.row_factory([d[0] for d in cursor.description])
+                return await cursor.fetchone()
+
+        return await self._submit(add)
+
+    async def import_wg_peers(self, peers):
+        """
+        Импорт peer'ов из старых файлов конфигов: peers - список
+        (user_id, server, private_key, public_key, preshared_key, addresses)
+        """
+        created = now_ts()
+        await self._submit([
+            ('''
+                INSERT INTO wg_peers
+                    (user_id, server, private_key, public_key, preshared_key, addresses, created_ts)
+                VALUES (?, ?, ?, ?, ?, ?, ?)
+                ON CONFLICT (user_id, server) WHERE revoked_ts IS NULL DO NOTHING
+            ''', (*peer, created))
+            for peer in peers
+        ])
+        return len(peers)
+
+    async def get_wg_peer_state(self, server):
+        """
+        Состояние peer'ов сервера для сверки с интерфейсом:
+        ([(public_key, psk, адреса)] действующих и тёплого пула,
+        {отозванные ключи с выданными адресами}, {ключ с выданными
+        адресами: время выдачи}). Отозванные peer'ы ищутся только среди
+        ключей с адресами - их число не растёт с каждым отзывом
+        """
+        rows = await self._fetchall('''
+            SELECT public_key, preshared_key, addresses FROM wg_peers
+            WHERE server = ? AND revoked_ts IS NULL
+            UNION ALL
+            SELECT public_key, preshared_key, addresses FROM wg_pool_peers
+            WHERE server = ?
+        ''', (server, server))
+        # Пулы сервера называются '<сервер>:<префикс>'
+        reserved = await self._fetchall('''
+            SELECT a.public_key, MAX(COALESCE(a.allocated_ts, 0)),
+                   EXISTS (
+                       SELECT 1 FROM wg_peers p
+                       WHERE p.public_key = a.public_key AND p.revoked_ts IS NOT NULL
+                   )
+            FROM wg_addresses a
+            WHERE a.pool >= ? AND a.pool < ? AND a.allocated = 1
+            GROUP BY a.public_key
+        ''', (f'{server}:', f'{server};'))
+        return (
+            rows,
+            {public_key for public_key, _, revoked in reserved if revoked},
+            {public_key: allocated_ts for public_key, allocated_ts, _ in reserved},
+        )
+
+    async def has_wg_peers(self):
+        row = await self._fetchone('SELECT 1 FROM wg_peers LIMIT 1')
+        return row is not None
+
+    async def get_wg_peer_ids(self, server):
+        """{public_key: id} действующих peer'ов сервера - для статистики трафика"""
+        rows = await self._fetchall('''
+            SELECT public_key, id FROM wg_peers
+            WHERE server = ? AND revoked_ts IS NULL
+        ''', (server,))
+        return dict(rows)
+
+    async def record_wg_usage(self, server, timestamp, samples, totals):
+        """
+        Добавляет приращения трафика во все разрешения одной единицей работы.
+        samples - [(peer_id, rx, tx, handshake_ts)], totals - (rx, tx, активных)
+        по серверу. Ячейка с прошлым интервалом перезаписывается.
+        """
+        peer_rows = []
+        server_rows = []
+        for step, slots in USAGE_RESOLUTIONS:
+            bucket_ts = timestamp - timestamp % step
+            slot = timestamp // step % slots
+            peer_rows += [
+                (peer_id, step, slot, bucket_ts, rx, tx, handshake_ts)
+                for peer_id, rx, tx, handshake_ts in samples
+            ]
+            server_rows.append((server, step, slot, bucket_ts, *totals))
+
+        async def record(connection):
+            # В UPDATE справа - значения строки до изменения
+            await connection.executemany('''
+                INSERT INTO wg_usage (peer_id, step, slot, bucket_ts, rx, tx, handshake_ts)
+                VALUES (?, ?, ?, ?, ?, ?, ?)
+                ON CONFLICT (peer_id, step, slot) DO UPDATE SET
+                    rx = CASE WHEN bucket_ts = excluded.bucket_ts
+                         THEN rx + excluded.rx ELSE excluded.rx END,
+                    tx = CASE WHEN bucket_ts = excluded.bucket_ts
+                         THEN tx + excluded.tx ELSE excluded.tx END,
+                    handshake_ts = CASE WHEN bucket_ts = excluded.bucket_ts
+                         THEN MAX(handshake_ts, excluded.handshake_ts) ELSE excluded.handshake_ts END,
+                    bucket_ts = excluded.bucket_ts
+            ''', peer_rows)
+            await connection.executemany('''
+                INSERT INTO wg_server_usage (server, step, slot, bucket_ts, rx, tx, active)
+                VALUES (?, ?, ?, ?, ?, ?, ?)
+                ON CONFLICT (server, step, slot) DO UPDATE SET
+                    rx = CASE WHEN bucket_ts = excluded.bucket_ts
+                         THEN rx + excluded.rx ELSE excluded.rx END,
+                    tx = CASE WHEN bucket_ts = excluded.bucket_ts
+                         THEN tx + excluded.tx ELSE excluded.tx END,
+                    active = CASE WHEN bucket_ts = excluded.bucket_ts
+                         THEN MAX(active, excluded.active) ELSE excluded.active END,
+                    bucket_ts = excluded.bucket_ts
+            ''', server_rows)
+
+        try:
+            await self._submit(record)
+            return True
+        except Exception as e:
+            print(f"Error recording WireGuard usage: {e}")
+            return False
+
+    async def get_user_usage(self, user_id, step, since):
+        """[(bucket_ts, rx, tx, handshake_ts)] пользователя по всем его peer'ам"""
+        return await self._fetchall('''
+            SELECT u.bucket_ts, SUM(u.rx), SUM(u.tx), MAX(u.handshake_ts)
+            FROM wg_peers p
+            JOIN wg_usage u ON u.peer_id = p.id AND u.step = ?
+            WHERE p.user_id = ? AND u.bucket_ts >= ?
+            GROUP BY u.bucket_ts
+            ORDER BY u.bucket_ts
+        ''', (step, user_id, since))
+
+    async def get_server_usage(self, server, step, since):
+        """[(bucket_ts, rx, tx, активных peer'ов)] сервера"""
+        return await self._fetchall('''
+            SELECT bucket_ts, rx, tx, active FROM wg_server_usage
+            WHERE server = ? AND step = ? AND bucket_ts >= ?
+            ORDER BY bucket_ts
+        ''', (server, step, since))
+
+    async def get_top_usage(self, step, since, limit=10):
+        """[(user_id, rx, tx)] пользователей с наибольшим трафиком с момента since"""
+        return await self._fetchall('''
+            SELECT p.user_id, SUM(u.rx) AS rx, SUM(u.tx) AS tx
+            FROM wg_usage u
+            JOIN wg_peers p ON p.id = u.peer_id
+            WHERE u.step = ? AND u.bucket_ts >= ?
+            GROUP BY p.user_id
+            ORDER BY rx + tx DESC
+            LIMIT ?
+        ''', (step, since, limit))
+
+    async def prune_wg_usage(self, timestamp):
+        """
+        Удаляет ячейки трафика старше глубины их кольца - остаются от peer'ов,
+        которые перестали передавать данные (отозваны или перенесены)
+        """
+        try:
+            async with self.transaction():
+                for step, slots in USAGE_RESOLUTIONS:
+                    await self._write('''
+                        DELETE FROM wg_usage WHERE step = ? AND bucket_ts < ?
+                    ''', (step, timestamp - step * slots))
+            return True
+        except Exception as e:
+            print(f"Error pruning WireGuard usage: {e}")
+            return False
+
+    async def revoke_user_wg_peers(self, user_ids):
+        """
+        Отзывает действующие peer'ы пользователей на всех серверах одной
+        единицей работы; [(сервер, public_key)] отозванных
+        """
+        revoked_ts = now_ts()
+
+        async def revoke(connection):
+            peers = []
+            for user_id in user_ids:
+                async with connection.execute('''
+                    UPDATE wg_peers SET revoked_ts = ?, version = version + 1
+                    WHERE user_id = ? AND revoked_ts IS NULL
+                    RETURNING server, public_key
+                ''', (revoked_ts, user_id)) as cursor:
+                    peers += [tuple(row) for row in await cursor.fetchall()]
+            return peers
+
+        return await self._submit(revoke)
+
+    async def close(self):
+        if self._writer_task:
+            # Дожидаемся записи всего, что уже в очереди
+            self._write_queue.put_nowait(None)
+            await self._writer_task
+            self._writer_task = None
+        for reader in self.readers:
+            await reader.close()
+        self.readers = []
+        if self.writer:
+            await self.writer.close()
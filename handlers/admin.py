@@ -1,8 +1,9 @@
 from telegram import Update
 from telegram.ext import ContextTypes
-from keyboards import get_admin_keyboard, get_main_keyboard
+from keyboards import get_admin_keyboard, get_admin_page_keyboard, get_main_keyboard
 from config import ADMIN_ID
-from datetime import datetime
+from database import now_ts, from_epoch
+from services.vpn_service import VPNService
 
 def is_admin(user_id):
     """Проверяет, является ли пользователь администратором"""
@@ -21,6 +22,28 @@ async def admin_command(update: Update, context: ContextTypes.DEFAULT_TYPE, db):
         reply_markup=get_admin_keyboard()
     )
 
+async def rebalance_command(update: Update, context: ContextTypes.DEFAULT_TYPE, db):
+    """Переносит неактивных клиентов WireGuard с перегруженного сервера"""
+    if not is_admin(update.effective_user.id):
+        await update.message.reply_text("❌ У вас нет доступа к админ-панели.")
+        return
+    
+    try:
+        source, target, moved = await VPNService.rebalance()
+    except Exception as e:
+        print(f"Error rebalancing servers: {e}")
+        await update.message.reply_text("❌ Ошибка перебалансировки.")
+        return
+    
+    if not moved:
+        await update.message.reply_text("⚖️ Перебалансировка не нужна или нет неактивных клиентов для переноса.")
+        return
+    
+    await update.message.reply_text(
+        f"⚖️ Перенесено клиентов: {moved} (сервер {source} → сервер {target}).\n"
+        f"Они получат новый конфиг при следующем запросе ключа."
+    )
+
 async def admin_stats_callback(update: Update, context: ContextTypes.DEFAULT_TYPE, db):
     """Показывает общую статистику"""
     query = update.callback_query
@@ -30,45 +53,30 @@ async def admin_stats_callback(update: Update, context: ContextTypes.DEFAULT_TYP
         await query.edit_message_text("❌ У вас нет доступа.")
         return
     
-    # Собираем статистику
-    total_users = db.get_all_users_count()
-    active_subs = db.get_active_subscriptions_count()
-    total_revenue = db.get_total_revenue()
-    
-    trial_users = db.get_trial_users()
-    paid_users = db.get_paid_users()
-    
-    # Разделяем на активные и истёкшие
-    now = datetime.now()
-    active_trial = [u for u in trial_users if u[4] and datetime.fromisoformat(u[3]) > now]
-    expired_trial = [u for u in trial_users if not u[4] or datetime.fromisoformat(u[3]) <= now]
-    
-    active_paid = [u for u in paid_users if u[4] and datetime.fromisoformat(u[3]) > now]
-    expired_paid = [u for u in paid_users if not u[4] or datetime.fromisoformat(u[3]) <= now]
-    
-    revenue_by_method = db.get_revenue_by_method()
+    # Собираем статистику (счётчики, без выгрузки подписок)
+    stats = await db.get_stats()
     
     # Формируем сообщение
     stats_text = f"""
 📊 **Общая статистика**
 
-👥 Всего пользователей: **{total_users}**
-✅ Активных подписок: **{active_subs}**
+👥 Всего пользователей: **{stats['users']}**
+✅ Активных подписок: **{stats['active_subscriptions']}**
 
 **🎁 Пробный период:**
-├ Активных: **{len(active_trial)}**
-└ Истекло: **{len(expired_trial)}**
+├ Активных: **{stats['trial_active']}**
+└ Истекло: **{stats['trial_expired']}**
 
 **💎 Платные подписки:**
-├ Активных: **{len(active_paid)}**
-└ Истекло: **{len(expired_paid)}**
+├ Активных: **{stats['paid_active']}**
+└ Истекло: **{stats['paid_expired']}**
 
-💰 Общая выручка: **{total_revenue:.2f}₽**
+💰 Общая выручка: **{stats['total_revenue']:.2f}₽**
 
 **По методам оплаты:**
 """
     
-    for method, count, total in revenue_by_method:
+    for method, count, total in stats['revenue_by_method']:
         method_name = {
             'yookassa': '💳 ЮКасса',
             'stars': '⭐ Stars',
@@ -76,14 +84,55 @@ async def admin_stats_callback(update: Update, context: ContextTypes.DEFAULT_TYP
         }.get(method, method)
         stats_text += f"{method_name}: {count} платежей, {total:.2f}₽\n"
     
+    stats_text += "\n**Нагрузка серверов WireGuard:**\n"
+    for server, load in (await VPNService.servers.loads()).items():
+        stats_text += (
+            f"Сервер {server}: peer'ов {load['peers']}, активных {load['active']}, "
+            f"адресов {load['used']}/{load['capacity']}\n"
+        )
+    
+    stats_text += "\n**Пулы адресов WireGuard:**\n"
+    for server, pools in (await VPNService.get_pool_usage()).items():
+        for prefix, used, capacity in pools:
+            stats_text += f"Сервер {server}, {prefix}: {used}/{capacity} ({used / capacity:.0%})\n"
+    
+    for server, warm in (await VPNService.get_warm_pool_stats()).items():
+        stats_text += (
+            f"Тёплый пул сервера {server}: {warm['depth']}/{warm['size']}, "
+            f"выдано {warm['claimed']}, промахов {warm['missed']}, "
+            f"пополнено {warm['refilled']} ({warm['refill_rate']:.1f}/с)\n"
+        )
+    
+    stats_text += "\n**Бэкенды выдачи ключей:**\n"
+    for protocol, (name, backend_stats) in (await VPNService.get_backend_stats()).items():
+        details = ', '.join(f"{key} {value}" for key, value in backend_stats.items())
+        stats_text += f"{protocol} ({name}): {details}\n"
+    
+    stats_text += "\n**Кэш (попадания/промахи):**\n"
+    for name, cache in db.cache_stats().items():
+        stats_text += f"{name}: {cache['hits']}/{cache['misses']} ({cache['hit_rate']:.0%})\n"
+    keys = VPNService.key_flights.stats()
+    stats_text += (
+        f"ключи: {keys['hits']}/{keys['misses']} ({keys['hit_rate']:.0%}), "
+        f"выдач {keys['calls']}, объединено запросов {keys['shared']}\n"
+    )
+    
     await query.edit_message_text(
         stats_text,
         parse_mode='Markdown',
         reply_markup=get_admin_keyboard()
     )
 
-async def admin_trial_users_callback(update: Update, context: ContextTypes.DEFAULT_TYPE, db):
-    """Показывает пользователей с пробным периодом"""
+def format_bytes(size):
+    """Объём трафика в читаемом виде"""
+    for unit in ('Б', 'КБ', 'МБ', 'ГБ'):
+        if size < 1024:
+            return f"{size:.0f} {unit}" if unit == 'Б' else f"{size:.1f} {unit}"
+        size /= 1024
+    return f"{size:.1f} ТБ"
+
+async def admin_traffic_callback(update: Update, context: ContextTypes.DEFAULT_TYPE, db):
+    """Трафик серверов WireGuard и самые активные пользователи за сутки"""
     query = update.callback_query
     await query.answer()
     
@@ -91,63 +140,117 @@ async def admin_trial_users_callback(update: Update, context: ContextTypes.DEFAU
         await query.edit_message_text("❌ У вас нет доступа.")
         return
     
-    trial_users = db.get_trial_users()
+    now = now_ts()
+    text = "📈 **Трафик WireGuard** (⬇️ от клиентов / ⬆️ к клиентам)\n\n"
+    for server in VPNService.servers.nodes:
+        hour = await db.get_server_usage(server, 60, now - 3600)
+        day = await db.get_server_usage(server, 3600, now - 86400)
+        active = hour[-1][3] if hour else 0
+        text += (
+            f"**Сервер {server}:** активных сейчас {active}\n"
+            f"├ За час: ⬇️ {format_bytes(sum(row[1] for row in hour))} "
+            f"⬆️ {format_bytes(sum(row[2] for row in hour))}\n"
+            f"└ За сутки: ⬇️ {format_bytes(sum(row[1] for row in day))} "
+            f"⬆️ {format_bytes(sum(row[2] for row in day))}\n\n"
+        )
+    
+    top = await db.get_top_usage(3600, now - 86400)
+    if top:
+        text += "**Больше всех за сутки:**\n"
+        for user_id, rx, tx in top:
+            text += f"`{user_id}`: ⬇️ {format_bytes(rx)} ⬆️ {format_bytes(tx)}\n"
+        text += "\nПодробно по пользователю: `/usage <user_id>`"
+    else:
+        text += "📋 Данных о трафике пока нет"
+    
+    await query.edit_message_text(
+        text,
+        parse_mode='Markdown',
+        reply_markup=get_admin_keyboard()
+    )
+
+async def usage_command(update: Update, context: ContextTypes.DEFAULT_TYPE, db):
+    """Трафик пользователя WireGuard: /usage <user_id>"""
+    if not is_admin(update.effective_user.id):
+        await update.message.reply_text("❌ У вас нет доступа к админ-панели.")
+        return
+    
+    if not context.args or not context.args[0].isdigit():
+        await update.message.reply_text("Использование: /usage <user_id>")
+        return
+    user_id = int(context.args[0])
+    
+    now = now_ts()
+    periods = (
+        ("За час", 60, now - 3600),
+        ("За сутки", 3600, now - 86400),
+        ("За 30 дней", 86400, now - 30 * 86400),
+    )
+    text = f"📈 Трафик пользователя {user_id}\n\n"
+    last_handshake = 0
+    for title, step, since in periods:
+        rows = await db.get_user_usage(user_id, step, since)
+        last_handshake = max([last_handshake] + [row[3] for row in rows])
+        text += (
+            f"{title}: ⬇️ {format_bytes(sum(row[1] for row in rows))} "
+            f"⬆️ {format_bytes(sum(row[2] for row in rows))}\n"
+        )
     
-    if not trial_users:
+    if last_handshake:
+        text += f"\nПоследнее подключение: {from_epoch(last_handshake).strftime('%d.%m.%Y %H:%M')}"
+    else:
+        text += "\nПодключений за 30 дней не было"
+    
+    await update.message.reply_text(text)
+
+USER_LISTS = {
+    't': (1, "🎁 **Пробный период**", "📋 Нет пользователей на пробном периоде"),
+    'p': (0, "💎 **Платные подписки**", "📋 Нет пользователей с платной подпиской"),
+}
+
+async def _show_users_page(query, db, kind, cursor=None, direction='next'):
+    """Выводит одну страницу списка пользователей (keyset по end_ts, user_id)"""
+    is_trial, title, empty_text = USER_LISTS[kind]
+    rows, has_prev, has_next = await db.get_users_page(is_trial, cursor, direction)
+    
+    if not rows:
         await query.edit_message_text(
-            "📋 Нет пользователей на пробном периоде",
+            empty_text,
             reply_markup=get_admin_keyboard()
         )
         return
     
-    # Разделяем на активные и истёкшие
-    now = datetime.now()
-    active = [u for u in trial_users if u[4] and datetime.fromisoformat(u[3]) > now]
-    expired = [u for u in trial_users if not u[4] or datetime.fromisoformat(u[3]) <= now]
-    
-    # Сортируем по дате истечения
-    active.sort(key=lambda x: x[3])
-    expired.sort(key=lambda x: x[3], reverse=True)
+    stats = await db.get_stats()
+    active_key, expired_key = ('trial_active', 'trial_expired') if is_trial else ('paid_active', 'paid_expired')
     
-    text = f"🎁 **Пробный период** (всего: {len(trial_users)})\n\n"
+    text = f"{title}\n"
+    text += f"✅ Активных: {stats[active_key]} | ❌ Истекло: {stats[expired_key]}\n\n"
     
-    # Активные подписки
-    if active:
-        text += f"✅ **АКТИВНЫЕ ({len(active)}):**\n\n"
-        for user_id, username, start_date, end_date, is_active in active:
-            end_dt = datetime.fromisoformat(end_date)
-            days_left = (end_dt - now).days
-            hours_left = (end_dt - now).seconds // 3600
+    now = now_ts()
+    for row in rows:
+        end_formatted = from_epoch(row.end_ts).strftime("%d.%m.%Y %H:%M")
+        
+        text += f"👤 @{row.username or 'Без имени'} (ID: `{row.user_id}`)\n"
+        if row.is_active and row.end_ts > now:
+            days_left, seconds_left = divmod(row.end_ts - now, 86400)
+            hours_left = seconds_left // 3600
             
             time_left = f"{days_left}д {hours_left}ч" if days_left > 0 else f"{hours_left}ч"
-            end_formatted = end_dt.strftime("%d.%m.%Y %H:%M")
-            
-            text += f"👤 @{username or 'Без имени'} (ID: `{user_id}`)\n"
             text += f"   ⏰ До: {end_formatted} (осталось: {time_left})\n\n"
-    
-    # Истёкшие подписки
-    if expired:
-        text += f"\n❌ **ИСТЕКШИЕ ({len(expired)}):**\n\n"
-        for user_id, username, start_date, end_date, is_active in expired[:10]:
-            end_formatted = datetime.fromisoformat(end_date).strftime("%d.%m.%Y %H:%M")
-            
-            text += f"👤 @{username or 'Без имени'} (ID: `{user_id}`)\n"
+        else:
             text += f"   📅 Истекло: {end_formatted}\n\n"
-        
-        if len(expired) > 10:
-            text += f"... и ещё {len(expired) - 10} пользователей\n"
-    
-    if len(text) > 4000:
-        text = text[:4000] + "\n\n... (список обрезан)"
     
+    first, last = rows[0], rows[-1]
     await query.edit_message_text(
         text,
         parse_mode='Markdown',
-        reply_markup=get_admin_keyboard()
+        reply_markup=get_admin_page_keyboard(
+            kind, (first.end_ts, first.user_id), (last.end_ts, last.user_id), has_prev, has_next
+        )
     )
 
-async def admin_paid_users_callback(update: Update, context: ContextTypes.DEFAULT_TYPE, db):
-    """Показывает пользователей с платной подпиской"""
+async def admin_trial_users_callback(update: Update, context: ContextTypes.DEFAULT_TYPE, db):
+    """Показывает пользователей с пробным периодом (первая страница)"""
     query = update.callback_query
     await query.answer()
     
@@ -155,59 +258,33 @@ async def admin_paid_users_callback(update: Update, context: ContextTypes.DEFAUL
         await query.edit_message_text("❌ У вас нет доступа.")
         return
     
-    paid_users = db.get_paid_users()
+    await _show_users_page(query, db, 't')
+
+async def admin_paid_users_callback(update: Update, context: ContextTypes.DEFAULT_TYPE, db):
+    """Показывает пользователей с платной подпиской (первая страница)"""
+    query = update.callback_query
+    await query.answer()
     
-    if not paid_users:
-        await query.edit_message_text(
-            "📋 Нет пользователей с платной подпиской",
-            reply_markup=get_admin_keyboard()
-        )
+    if not is_admin(query.from_user.id):
+        await query.edit_message_text("❌ У вас нет доступа.")
         return
     
-    # Разделяем на активные и истёкшие
-    now = datetime.now()
-    active = [u for u in paid_users if u[4] and datetime.fromisoformat(u[3]) > now]
-    expired = [u for u in paid_users if not u[4] or datetime.fromisoformat(u[3]) <= now]
-    
-    # Сортируем по дате истечения
-    active.sort(key=lambda x: x[3])
-    expired.sort(key=lambda x: x[3], reverse=True)
-    
-    text = f"💎 **Платные подписки** (всего: {len(paid_users)})\n\n"
-    
-    # Активные подписки
-    if active:
-        text += f"✅ **АКТИВНЫЕ ({len(active)}):**\n\n"
-        for user_id, username, start_date, end_date, is_active in active:
-            end_dt = datetime.fromisoformat(end_date)
-            days_left = (end_dt - now).days
-            hours_left = (end_dt - now).seconds // 3600
-            
-            time_left = f"{days_left}д {hours_left}ч" if days_left > 0 else f"{hours_left}ч"
-            end_formatted = end_dt.strftime("%d.%m.%Y %H:%M")
-            
-            text += f"👤 @{username or 'Без имени'} (ID: `{user_id}`)\n"
-            text += f"   ⏰ До: {end_formatted} (осталось: {time_left})\n\n"
-    
-    # Истёкшие подписки
-    if expired:
-        text += f"\n❌ **ИСТЕКШИЕ ({len(expired)}):**\n\n"
-        for user_id, username, start_date, end_date, is_active in expired[:10]:
-            end_formatted = datetime.fromisoformat(end_date).strftime("%d.%m.%Y %H:%M")
-            
-            text += f"👤 @{username or 'Без имени'} (ID: `{user_id}`)\n"
-            text += f"   📅 Истекло: {end_formatted}\n\n"
-        
-        if len(expired) > 10:
-            text += f"... и ещё {len(expired) - 10} пользователей\n"
+    await _show_users_page(query, db, 'p')
+
+async def admin_users_page_callback(update: Update, context: ContextTypes.DEFAULT_TYPE, db):
+    """Листание списков пользователей: admin_users:<t|p>:<n|p>:<end_ts>:<user_id>"""
+    query = update.callback_query
+    await query.answer()
     
-    if len(text) > 4000:
-        text = text[:4000] + "\n\n... (список обрезан)"
+    if not is_admin(query.from_user.id):
+        await query.edit_message_text("❌ У вас нет доступа.")
+        return
     
-    await query.edit_message_text(
-        text,
-        parse_mode='Markdown',
-        reply_markup=get_admin_keyboard()
+    _, kind, direction, end_ts, user_id = query.data.split(':')
+    await _show_users_page(
+        query, db, kind,
+        cursor=(int(end_ts), int(user_id)),
+        direction='next' if direction == 'n' else 'prev'
     )
 
 async def admin_recent_payments_callback(update: Update, context: ContextTypes.DEFAULT_TYPE, db):
@@ -219,7 +296,7 @@ async def admin_recent_payments_callback(update: Update, context: ContextTypes.D
         await query.edit_message_text("❌ У вас нет доступа.")
         return
     
-    recent_payments = db.get_recent_payments(limit=20)
+    recent_payments = await db.get_recent_payments(limit=20)
     
     if not recent_payments:
         await query.edit_message_text(
@@ -230,17 +307,17 @@ async def admin_recent_payments_callback(update: Update, context: ContextTypes.D
     
     text = "💳 **Последние платежи:**\n\n"
     
-    for user_id, username, amount, payment_method, status, created_at in recent_payments:
-        status_emoji = "✅" if status == "paid" else "⏳"
+    for payment in recent_payments:
+        status_emoji = "✅" if payment.status == "paid" else "⏳"
         method_name = {
             'yookassa': '💳',
             'stars': '⭐',
             'cryptobot': '₿'
-        }.get(payment_method, '💰')
+        }.get(payment.payment_method, '💰')
         
-        created_at_formatted = datetime.fromisoformat(created_at).strftime("%d.%m.%Y %H:%M")
+        created_at_formatted = from_epoch(payment.created_ts).strftime("%d.%m.%Y %H:%M")
         
-        text += f"{status_emoji} {method_name} **{amount:.2f}₽** - @{username or 'Без имени'}\n"
+        text += f"{status_emoji} {method_name} **{payment.amount:.2f}₽** - @{payment.username or 'Без имени'}\n"
         text += f"   Дата: {created_at_formatted}\n\n"
     
     await query.edit_message_text(
@@ -258,7 +335,7 @@ async def admin_expiring_soon_callback(update: Update, context: ContextTypes.DEF
         await query.edit_message_text("❌ У вас нет доступа.")
         return
     
-    expiring = db.get_expiring_subscriptions(days=3)
+    expiring = await db.get_expiring_subscriptions(days=3)
     
     if not expiring:
         await query.edit_message_text(
@@ -269,16 +346,15 @@ async def admin_expiring_soon_callback(update: Update, context: ContextTypes.DEF
     
     text = f"⚠️ **Истекают в ближайшие 3 дня** ({len(expiring)}):\n\n"
     
-    now = datetime.now()
-    for user_id, username, end_date, is_trial in expiring:
-        end_dt = datetime.fromisoformat(end_date)
-        hours_left = int((end_dt - now).total_seconds() / 3600)
+    now = now_ts()
+    for subscription in expiring:
+        hours_left = (subscription.end_ts - now) // 3600
         days_left = hours_left // 24
         
-        sub_type = "🎁 Trial" if is_trial else "💎 Платная"
+        sub_type = "🎁 Trial" if subscription.is_trial else "💎 Платная"
         time_left = f"{days_left}д {hours_left % 24}ч" if days_left > 0 else f"{hours_left}ч"
         
-        text += f"👤 @{username or 'Без имени'} (ID: `{user_id}`)\n"
+        text += f"👤 @{subscription.username or 'Без имени'} (ID: `{subscription.user_id}`)\n"
         text += f"   {sub_type} | Осталось: {time_left}\n\n"
     
     if len(text) > 4000:
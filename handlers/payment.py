@@ -5,6 +5,7 @@ from services.yookassa_service import YooKassaService
 from services.vpn_service import VPNService
 from utils.referral import calculate_referral_bonus
 from config import SUBSCRIPTION_PRICE, SUBSCRIPTION_DURATION_DAYS
+from database import now_ts
 
 async def payment_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
@@ -33,7 +34,7 @@ async def pay_yookassa_callback(update: Update, context: ContextTypes.DEFAULT_TY
             return
         
         # Сохраняем платеж в базу
-        db.add_payment(user_id, SUBSCRIPTION_PRICE, payment_id, 'yookassa', 'pending')
+        await db.add_payment(user_id, SUBSCRIPTION_PRICE, payment_id, 'yookassa', 'pending')
         
         # Сохраняем payment_id в контекст для проверки
         context.user_data['pending_payment_id'] = payment_id
@@ -69,24 +70,32 @@ async def check_payment_command(update: Update, context: ContextTypes.DEFAULT_TY
         
         if is_paid:
             # Получаем настройки пользователя
-            _, protocol = db.get_user_preferences(user_id)
+            protocol = (await db.get_user_preferences(user_id)).selected_protocol
             
-            # Генерируем ключ (всегда сервер 1)
-            vpn_key, user_uuid = await VPNService.generate_vpn_key(user_id, 1, protocol, is_trial=False)
+            # Генерируем ключ (сервер - наименее загруженный) со сроком новой подписки;
+            # ключ, выданный до оплаты (пробный, со старым сроком), не переиспользуется
+            VPNService.forget_keys([user_id])
+            vpn_key, user_uuid = await VPNService.generate_vpn_key(
+                user_id, None, protocol, is_trial=False,
+                expire_ts=now_ts() + SUBSCRIPTION_DURATION_DAYS * 86400
+            )
             
             if vpn_key and user_uuid:
-                # Активируем подписку
-                db.add_subscription(user_id, vpn_key, user_uuid, SUBSCRIPTION_DURATION_DAYS)
-                
-                # Обновляем статус платежа
-                db.update_payment_status(payment_id, 'paid')
+                user_data = await db.get_user(user_id)
                 
-                # Начисляем бонус рефереру
-                user_data = db.get_user(user_id)
-                if user_data and user_data[2]:
-                    referrer_id = user_data[2]
-                    bonus = calculate_referral_bonus(SUBSCRIPTION_PRICE)
-                    db.update_balance(referrer_id, bonus)
+                # Подписка, статус платежа и бонус - одной транзакцией
+                async with db.transaction():
+                    # Активируем подписку
+                    await db.add_subscription(user_id, VPNService.stored_key(protocol, vpn_key), user_uuid, SUBSCRIPTION_DURATION_DAYS)
+                    
+                    # Обновляем статус платежа
+                    await db.update_payment_status(payment_id, 'paid')
+                    
+                    # Начисляем бонус рефереру
+                    if user_data and user_data.referrer_id:
+                        referrer_id = user_data.referrer_id
+                        bonus = calculate_referral_bonus(SUBSCRIPTION_PRICE)
+                        await db.update_balance(referrer_id, bonus)
                 
                 context.user_data.pop('pending_payment_id', None)
                 
@@ -8,7 +8,7 @@ async def choose_protocol_callback(update: Update, context: ContextTypes.DEFAULT
     await query.answer()
     
     user_id = query.from_user.id
-    _, protocol = db.get_user_preferences(user_id)
+    protocol = (await db.get_user_preferences(user_id)).selected_protocol
     
     protocol_names = {
         'wireguard': '🔷 WireGuard',
@@ -34,7 +34,7 @@ async def select_protocol_callback(update: Update, context: ContextTypes.DEFAULT
     protocol = query.data.split('_')[-1]  # select_protocol_wireguard -> wireguard
     
     # Всегда сервер 1
-    db.set_user_preferences(user_id, 1, protocol)
+    await db.set_user_preferences(user_id, 1, protocol)
     
     protocol_names = {
         'wireguard': '🔷 WireGuard',
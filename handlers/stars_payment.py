@@ -4,6 +4,7 @@ from keyboards import get_main_keyboard
 from services.vpn_service import VPNService
 from utils.referral import calculate_referral_bonus
 from config import SUBSCRIPTION_DURATION_DAYS, SUBSCRIPTION_PRICE_STARS
+from database import now_ts
 import uuid
 
 async def stars_payment_callback(update: Update, context: ContextTypes.DEFAULT_TYPE, db):
@@ -17,7 +18,7 @@ async def stars_payment_callback(update: Update, context: ContextTypes.DEFAULT_T
     context.user_data['pending_stars_payment'] = payment_id
     
     # Сохраняем платеж в базу
-    db.add_payment(user_id, SUBSCRIPTION_PRICE_STARS, payment_id, 'stars', 'pending')
+    await db.add_payment(user_id, SUBSCRIPTION_PRICE_STARS, payment_id, 'stars', 'pending')
     
     # Создаем инвойс для оплаты Stars
     title = "Подписка VPN на 30 дней"
@@ -47,49 +48,60 @@ async def successful_payment_callback(update: Update, context: ContextTypes.DEFA
     payment_info = update.message.successful_payment
     payload = payment_info.invoice_payload
     
-    payment = db.get_payment(payload)
+    payment = await db.get_payment(payload)
     
-    if payment and payment[5] == 'pending':
+    if payment and payment.status == 'pending':
         # Получаем настройки пользователя
-        _, protocol = db.get_user_preferences(user_id)
+        protocol = (await db.get_user_preferences(user_id)).selected_protocol
         
-        existing_sub = db.get_active_subscription(user_id)
+        existing_sub = await db.get_active_subscription(user_id)
+        user_data = await db.get_user(user_id)
         
-        if existing_sub:
-            # Продлеваем
-            from datetime import datetime, timedelta
-            current_end_str = existing_sub[5]
-            current_end = datetime.fromisoformat(current_end_str)
-            
-            if current_end < datetime.now():
-                new_end = datetime.now() + timedelta(days=SUBSCRIPTION_DURATION_DAYS)
-            else:
-                new_end = current_end + timedelta(days=SUBSCRIPTION_DURATION_DAYS)
-            
-            # Генерируем ключ (всегда сервер 1)
-            vpn_key, user_uuid = await VPNService.generate_vpn_key(user_id, 1, protocol, is_trial=False)
-            
-            if vpn_key and user_uuid:
-                db.cursor.execute('''
-                    UPDATE subscriptions
-                    SET end_date = ?, is_trial = 0, vpn_key = ?, user_uuid = ?
-                    WHERE user_id = ? AND is_active = 1
-                ''', (new_end.isoformat(), vpn_key, user_uuid, user_id))
-                db.connection.commit()
+        # Конец подписки: продление - от текущего конца, если он ещё не наступил
+        now = now_ts()
+        if existing_sub and existing_sub.end_ts >= now:
+            new_end = existing_sub.end_ts + SUBSCRIPTION_DURATION_DAYS * 86400
         else:
-            # Создаем новую
-            vpn_key, user_uuid = await VPNService.generate_vpn_key(user_id, 1, protocol, is_trial=False)
-            if vpn_key and user_uuid:
-                db.add_subscription(user_id, vpn_key, user_uuid, SUBSCRIPTION_DURATION_DAYS)
+            new_end = now + SUBSCRIPTION_DURATION_DAYS * 86400
         
-        db.update_payment_status(payload, 'paid')
+        # Генерируем ключ (сервер - наименее загруженный) со сроком подписки;
+        # ключ, выданный до оплаты (пробный, со старым сроком), не переиспользуется
+        VPNService.forget_keys([user_id])
+        vpn_key, user_uuid = await VPNService.generate_vpn_key(
+            user_id, None, protocol, is_trial=False, expire_ts=new_end
+        )
+        
+        # Подписка, статус платежа и бонус - одной транзакцией
+        success = False
+        try:
+            async with db.transaction():
+                if existing_sub:
+                    # Продлеваем
+                    if vpn_key and user_uuid:
+                        await db.renew_subscription(user_id, new_end, VPNService.stored_key(protocol, vpn_key), user_uuid)
+                else:
+                    # Создаем новую
+                    if vpn_key and user_uuid:
+                        await db.add_subscription(user_id, VPNService.stored_key(protocol, vpn_key), user_uuid, SUBSCRIPTION_DURATION_DAYS)
+            
+                await db.update_payment_status(payload, 'paid')
+            
+                # Бонус рефереру
+                if user_data and user_data.referrer_id:
+                    referrer_id = user_data.referrer_id
+                    bonus = calculate_referral_bonus(150)
+                    await db.update_balance(referrer_id, bonus)
+            success = True
+        except Exception as e:
+            # Платёж остаётся pending - его можно провести вручную
+            print(f"Error processing Stars payment {payload}: {e}")
         
-        # Бонус рефереру
-        user_data = db.get_user(user_id)
-        if user_data and user_data[2]:
-            referrer_id = user_data[2]
-            bonus = calculate_referral_bonus(150)
-            db.update_balance(referrer_id, bonus)
+        if not success:
+            await update.message.reply_text(
+                "Ошибка обработки платежа. Обратитесь в поддержку.",
+                reply_markup=get_main_keyboard()
+            )
+            return
         
         context.user_data.pop('pending_stars_payment', None)
         
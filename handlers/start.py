@@ -16,26 +16,29 @@ async def start_command(update: Update, context: ContextTypes.DEFAULT_TYPE, db):
         referrer_id = extract_referrer_id(context.args[0])
     
     # Проверяем, есть ли пользователь в базе
-    existing_user = db.get_user(user_id)
+    existing_user = await db.get_user(user_id)
     
     if not existing_user:
-        # Новый пользователь - добавляем в базу
-        db.add_user(user_id, username, referrer_id)
-        print(f"Новый пользователь добавлен: {user_id}")
-        
-        # Устанавливаем настройки по умолчанию (WireGuard)
-        db.set_user_preferences(user_id, 1, 'wireguard')
-        
         # Генерируем VPN ключ для trial (WireGuard по умолчанию)
-        vpn_key, user_uuid = await VPNService.generate_vpn_key(user_id, 1, 'wireguard', is_trial=True)
+        vpn_key, user_uuid = await VPNService.generate_vpn_key(user_id, None, 'wireguard', is_trial=True)
         print(f"VPN ключ сгенерирован")
         print(f"UUID: {user_uuid}")
         
-        if vpn_key and user_uuid:
-            # Активируем пробный период
-            success = db.activate_trial(user_id, vpn_key, user_uuid)
-            print(f"Trial активация: {success}")
-            
+        # Новый пользователь, настройки по умолчанию (WireGuard) и trial - одним коммитом
+        success = False
+        try:
+            async with db.transaction():
+                await db.add_user(user_id, username, referrer_id)
+                await db.set_user_preferences(user_id, 1, 'wireguard')
+                if vpn_key and user_uuid:
+                    await db.activate_trial(user_id, VPNService.stored_key('wireguard', vpn_key), user_uuid)
+            success = bool(vpn_key and user_uuid)
+            print(f"Новый пользователь добавлен: {user_id}")
+        except Exception as e:
+            print(f"Error registering user: {e}")
+        print(f"Trial активация: {success}")
+        
+        if success:
             # Генерируем реферальную ссылку
             bot_username = context.bot.username
             ref_link = generate_referral_link(bot_username, user_id)
@@ -65,14 +68,14 @@ async def start_command(update: Update, context: ContextTypes.DEFAULT_TYPE, db):
             """
     else:
         # Существующий пользователь - проверяем подписку
-        subscription = db.get_active_subscription(user_id)
+        subscription = await db.get_active_subscription(user_id)
         
         bot_username = context.bot.username
         ref_link = generate_referral_link(bot_username, user_id)
         
         if subscription:
             # Получаем настройки пользователя
-            _, protocol = db.get_user_preferences(user_id)
+            protocol = (await db.get_user_preferences(user_id)).selected_protocol
             protocol_name = "WireGuard" if protocol == 'wireguard' else "V2Ray"
             
             message = f"""
@@ -1,4 +1,4 @@
-import os
+import io
 from telegram import Update
 from telegram.ext import ContextTypes
 from keyboards import get_device_keyboard, get_device_options_keyboard, get_main_keyboard
@@ -43,7 +43,7 @@ async def install_app_callback(update: Update, context: ContextTypes.DEFAULT_TYP
     device = context.user_data.get('selected_device', 'other')
     
     # Получаем выбранный протокол
-    _, protocol = db.get_user_preferences(user_id)
+    protocol = (await db.get_user_preferences(user_id)).selected_protocol
     
     download_link = VPNService.get_app_download_link(device, protocol)
     
@@ -60,7 +60,7 @@ async def get_key_callback(update: Update, context: ContextTypes.DEFAULT_TYPE, d
     await query.answer()
     
     user_id = query.from_user.id
-    subscription = db.get_active_subscription(user_id)
+    subscription = await db.get_active_subscription(user_id)
     
     if not subscription:
         await query.edit_message_text(
@@ -70,11 +70,13 @@ async def get_key_callback(update: Update, context: ContextTypes.DEFAULT_TYPE, d
         return
     
     # Получаем настройки пользователя
-    _, protocol = db.get_user_preferences(user_id)
+    protocol = (await db.get_user_preferences(user_id)).selected_protocol
     
-    # Генерируем ключ (всегда сервер 1)
-    is_trial = subscription[6]
-    vpn_key, user_uuid = await VPNService.generate_vpn_key(user_id, 1, protocol, is_trial)
+    # Генерируем ключ (сервер - наименее загруженный)
+    is_trial = subscription.is_trial
+    vpn_key, user_uuid = await VPNService.generate_vpn_key(
+        user_id, None, protocol, is_trial, subscription.end_ts
+    )
     
     if not vpn_key:
         await query.edit_message_text(
@@ -84,12 +86,7 @@ async def get_key_callback(update: Update, context: ContextTypes.DEFAULT_TYPE, d
         return
     
     # Обновляем ключ в БД
-    db.cursor.execute('''
-        UPDATE subscriptions 
-        SET vpn_key = ?, user_uuid = ?
-        WHERE user_id = ? AND is_active = 1
-    ''', (vpn_key, user_uuid, user_id))
-    db.connection.commit()
+    await db.update_subscription_key(user_id, VPNService.stored_key(protocol, vpn_key), user_uuid)
     
     protocol_name = "V2Ray" if protocol == 'v2ray' else "WireGuard"
     
@@ -116,22 +113,17 @@ async def get_key_callback(update: Update, context: ContextTypes.DEFAULT_TYPE, d
         # WireGuard
         config_filename = f"wireguard_user_{user_id}.conf"
         
-        with open(f"/tmp/{config_filename}", "w") as f:
-            f.write(vpn_key)
-        
         try:
-            with open(f"/tmp/{config_filename}", "rb") as f:
-                await context.bot.send_document(
-                    chat_id=query.message.chat_id,
-                    document=f,
-                    filename=config_filename,
-                    caption=f"Ваш конфиг WireGuard\n\n"
-                        f"Протокол: {protocol_name}\n\n"
-                        f"Приложение: WireGuard\n\n"
-                        f"Импортируйте этот файл в приложение WireGuard"
-                )
-            
-            os.remove(f"/tmp/{config_filename}")
+            # Документ из памяти, без временного файла
+            await context.bot.send_document(
+                chat_id=query.message.chat_id,
+                document=io.BytesIO(vpn_key.encode()),
+                filename=config_filename,
+                caption=f"Ваш конфиг WireGuard\n\n"
+                    f"Протокол: {protocol_name}\n\n"
+                    f"Приложение: WireGuard\n\n"
+                    f"Импортируйте этот файл в приложение WireGuard"
+            )
             
         except Exception as e:
             print(f"Ошибка: {e}")
@@ -51,10 +51,33 @@ def get_admin_keyboard():
         [InlineKeyboardButton("💎 Платные пользователи", callback_data='admin_paid_users')],
         [InlineKeyboardButton("⚠️ Истекают скоро", callback_data='admin_expiring_soon')],
         [InlineKeyboardButton("💳 Последние платежи", callback_data='admin_recent_payments')],
+        [InlineKeyboardButton("📈 Трафик", callback_data='admin_traffic')],
         [InlineKeyboardButton("🏠 Главное меню", callback_data='main_menu')]
     ]
     return InlineKeyboardMarkup(keyboard)
 
+def get_admin_page_keyboard(kind, first, last, has_prev, has_next):
+    """
+    Навигация по списку пользователей админки.
+    kind: 't' - пробные, 'p' - платные; first/last - (end_ts, user_id)
+    первой и последней строки страницы
+    """
+    navigation = []
+    if has_prev:
+        navigation.append(InlineKeyboardButton(
+            "⬅️ Назад", callback_data=f'admin_users:{kind}:p:{first[0]}:{first[1]}'
+        ))
+    if has_next:
+        navigation.append(InlineKeyboardButton(
+            "Вперёд ➡️", callback_data=f'admin_users:{kind}:n:{last[0]}:{last[1]}'
+        ))
+    
+    keyboard = []
+    if navigation:
+        keyboard.append(navigation)
+    keyboard.append([InlineKeyboardButton("🔐 Админ-панель", callback_data='admin_back')])
+    return InlineKeyboardMarkup(keyboard)
+
 def get_protocol_selection_keyboard():
     """Выбор протокола"""
     keyboard = [
@@ -0,0 +1,59 @@
+class Record:
+    """
+    Компактная запись строки БД. Атрибуты хранятся в __slots__, без
+    словаря на каждый объект. Заполняются только колонки, выбранные
+    запросом: обращение к невыбранной колонке - AttributeError.
+    """
+    __slots__ = ()
+
+    def __init__(self, **fields):
+        for name, value in fields.items():
+            setattr(self, name, value)
+
+    @classmethod
+    def row_factory(cls, names):
+        """row_factory для sqlite3-курсора с колонками names"""
+        def make(cursor, row):
+            record = cls.__new__(cls)
+            for name, value in zip(names, row):
+                setattr(record, name, value)
+            return record
+        return make
+
+    def __repr__(self):
+        fields = ', '.join(
+            f"{name}={getattr(self, name)!r}"
+            for name in self.__slots__ if hasattr(self, name)
+        )
+        return f"{type(self).__name__}({fields})"
+
+
+class User(Record):
+    __slots__ = ('user_id', 'username', 'referrer_id', 'balance', 'created_at')
+
+
+class Subscription(Record):
+    # username - из JOIN с users в админских выборках
+    __slots__ = (
+        'id', 'user_id', 'username', 'vpn_key', 'user_uuid',
+        'start_ts', 'end_ts', 'is_trial', 'is_active'
+    )
+
+
+class Payment(Record):
+    # username - из JOIN с users в админских выборках
+    __slots__ = (
+        'id', 'user_id', 'username', 'amount', 'payment_id',
+        'payment_method', 'status', 'created_ts'
+    )
+
+
+class UserPreferences(Record):
+    __slots__ = ('user_id', 'selected_server', 'selected_protocol')
+
+
+class WgPeer(Record):
+    __slots__ = (
+        'id', 'user_id', 'server', 'private_key', 'public_key', 'preshared_key',
+        'addresses', 'version', 'created_ts', 'revoked_ts'
+    )
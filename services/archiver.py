@@ -0,0 +1,39 @@
+import asyncio
+import logging
+import time
+from telegram.ext import ContextTypes
+from config import ARCHIVE_MAX_BATCHES
+
+logger = logging.getLogger(__name__)
+
+
+async def archive_job(context: ContextTypes.DEFAULT_TYPE):
+    """
+    Периодическая задача JobQueue: переносит истёкшие подписки и старые
+    платежи в архивные таблицы пачками, пока есть что переносить
+    (не больше ARCHIVE_MAX_BATCHES пачек за запуск).
+    """
+    db = context.job.data
+    started = time.monotonic()
+    moved_subscriptions = moved_payments = 0
+
+    for _ in range(ARCHIVE_MAX_BATCHES):
+        try:
+            subscriptions, payments = await db.archive_batch()
+        except Exception as e:
+            logger.error(f"Ошибка архивации: {e}")
+            break
+
+        moved_subscriptions += subscriptions
+        moved_payments += payments
+        if not subscriptions and not payments:
+            break
+
+        # Отдаём очередь писателя обработчикам между пачками
+        await asyncio.sleep(0)
+
+    if moved_subscriptions or moved_payments:
+        logger.info(
+            f"Архивация: подписок {moved_subscriptions}, платежей {moved_payments} "
+            f"за {time.monotonic() - started:.2f}с"
+        )
@@ -0,0 +1,317 @@
+import asyncio
+import base64
+from abc import ABC, abstractmethod
+import glob
+import os
+import random
+import secrets
+from config import (
+    MARZBAN_API_URL, MARZBAN_API_USERNAME, MARZBAN_API_PASSWORD,
+    FAKE_BACKEND_LATENCY_MS, FAKE_BACKEND_FAILURE_RATE
+)
+from services.marzban_service import MarzbanService
+from services.servers import ServerRegistry
+from services.wg_config import render_client_config, parse_client_config, CLIENT_CONFIG_TEMPLATE
+from utils import wg_keys
+from utils.wg_keys import generate_keypair, generate_preshared_key
+
+CLIENT_CONFIG_DIR = "/root"
+
+
+class BackendError(Exception):
+    """Бэкенд не смог выдать или отозвать доступ"""
+
+
+def make_backend(protocol, name, db):
+    """Бэкенд протокола по его имени из VPN_BACKENDS"""
+    if name == 'wireguard' and protocol == 'wireguard':
+        return WireGuardBackend(db)
+    if name == 'marzban' and protocol == 'v2ray':
+        return MarzbanBackend()
+    if name == 'fake':
+        return FakeBackend(protocol)
+    raise ValueError(f"Unknown {protocol} backend: {name}")
+
+
+class VPNBackend(ABC):
+    """
+    Бэкенд выдачи VPN-доступа по одному протоколу. VPNService работает
+    с протоколами только через эти методы; ошибки - исключения,
+    VPNService превращает их в (None, None).
+    """
+
+    protocol = None
+
+    async def setup(self):
+        """Подготовка при старте бота"""
+
+    async def shutdown(self):
+        """Остановка фоновой работы перед выходом"""
+
+    @abstractmethod
+    async def provision(self, user_id, is_trial=False, server=None, expire_ts=None):
+        """
+        (ключ, имя клиента); уже выданный ключ возвращается повторно.
+        expire_ts - конец подписки (epoch) для бэкендов со своим сроком доступа
+        """
+
+    @abstractmethod
+    async def revoke(self, user_ids):
+        """Отзыв доступа пользователей; возвращает число отозванных"""
+
+    @abstractmethod
+    async def stats(self):
+        """Метрики для админки"""
+
+
+def _read_legacy_configs():
+    """[(user_id, текст)] старых файлов wg0-client-user_{id}.conf"""
+    configs = []
+    for path in glob.glob(f"{CLIENT_CONFIG_DIR}/wg0-client-user_*.conf"):
+        name = os.path.basename(path)[len('wg0-client-user_'):-len('.conf')]
+        if not name.isdigit():
+            continue
+        with open(path, 'r') as f:
+            configs.append((int(name), f.read()))
+    return configs
+
+
+class WireGuardBackend(VPNBackend):
+    """
+    Peer'ы WireGuard на серверах WG_NODES: записи в wg_peers, конфиг
+    рендерится из них, на интерфейс peer'ы попадают пачками
+    """
+
+    protocol = 'wireguard'
+
+    def __init__(self, db):
+        self.db = db
+        self.servers = ServerRegistry(db)
+
+    async def setup(self):
+        await self.servers.setup(self._provision_peer)
+        if not await self.db.has_wg_peers():
+            await self._import_legacy_configs()
+
+    async def shutdown(self):
+        """Останавливает пополнение пулов и дожидается применения peer'ов"""
+        await self.servers.stop()
+
+    async def _import_legacy_configs(self):
+        """Однократный перенос старых файлов конфигов в wg_peers"""
+        peers = []
+        for user_id, config_text in await asyncio.to_thread(_read_legacy_configs):
+            fields = parse_client_config(config_text)
+            try:
+                peers.append((
+                    user_id, 1, fields['PrivateKey'], wg_keys.public_key(fields['PrivateKey']),
+                    fields['PresharedKey'], fields['Address']
+                ))
+            except (KeyError, ValueError) as e:
+                print(f"Пропущен конфиг пользователя {user_id}: {e}")
+        if peers:
+            await self.db.import_wg_peers(peers)
+            print(f"Импортировано конфигов WireGuard из файлов: {len(peers)}")
+
+    @staticmethod
+    async def _provision_peer(node):
+        """
+        Создаёт peer на сервере node: ключи, адреса из пула, добавление пачкой.
+        Возвращает (private_key, public_key, preshared_key, addresses)
+        или None, если пул адресов исчерпан.
+        """
+        # Генерируем ключи в процессе, без запуска wg genkey/pubkey/genpsk
+        private_key, public_key = generate_keypair()
+        preshared_key = generate_preshared_key()
+
+        # Адреса из пулов в БД, без разбора вывода wg show
+        client_ips = await node.allocator.allocate(public_key)
+        if client_ips is None:
+            print("❌ Пул адресов WireGuard исчерпан")
+            return None
+
+        addresses = ', '.join(f"{ip}/{ip.max_prefixlen}" for ip in client_ips)
+        print(f"Создаю WireGuard клиента с адресами {addresses}")
+
+        # Добавляем peer: применяется одной пачкой с другими клиентами
+        try:
+            await node.peer_sync.add_peer(public_key, preshared_key, addresses.split(', '))
+        except Exception:
+            # Peer не добавлен - адреса возвращаются в пул
+            await node.allocator.release(public_key)
+            raise
+
+        return private_key, public_key, preshared_key, addresses
+
+    async def provision(self, user_id, is_trial=False, server=None, expire_ts=None):
+        """
+        Конфиг клиента из wg_peers; peer создаётся, если его ещё нет, -
+        из тёплого пула сервера (по умолчанию наименее загруженного)
+        или заново
+        """
+        client_name = f"user_{user_id}"
+        peer = await self.db.get_wg_peer(user_id, server)
+        if peer:
+            return render_client_config(peer), client_name
+
+        if server is None:
+            server = await self.servers.place()
+        node = self.servers.get(server)
+        if node is None:
+            raise BackendError("нет доступного сервера WireGuard со свободными адресами")
+
+        # Peer пула переходит к пользователю одной единицей работы
+        peer = await node.warm_pool.claim(user_id) if node.warm_pool else None
+        if peer is None:
+            keys = await self._provision_peer(node)
+            if keys is None:
+                raise BackendError(f"пул адресов WireGuard сервера {server} исчерпан")
+            peer = await self.db.add_wg_peer(user_id, server, *keys)
+            if peer is None:
+                # Параллельный запрос уже выдал peer - лишний отзываем
+                await self._remove_peer(node, keys[1])
+                peer = await self.db.get_wg_peer(user_id, server)
+                if peer is None:
+                    raise BackendError(f"peer пользователя {user_id} не сохранён")
+
+        print(f"✅ WireGuard клиент создан: {client_name}, адреса: {peer.addresses}")
+        return render_client_config(peer), client_name
+
+    @staticmethod
+    async def _remove_peer(node, public_key):
+        """Убирает peer с интерфейса сервера и возвращает его адреса в пул"""
+        await node.peer_sync.remove_peer(public_key)
+        await node.allocator.release(public_key)
+
+    async def remove_peers(self, peers):
+        """
+        Убирает уже отозванные в БД peer'ы [(сервер, public_key)] с wg0
+        одной пачкой и возвращает их адреса в пул
+        """
+        removals = []
+        for server, public_key in peers:
+            node = self.servers.get(server)
+            if node:
+                removals.append(node.peer_sync.remove_peer(public_key))
+        await asyncio.gather(*removals)
+        await self.db.release_wg_addresses([public_key for _, public_key in peers])
+
+    async def revoke(self, user_ids):
+        """Отзывает действующие peer'ы пользователей на всех серверах"""
+        peers = await self.db.revoke_user_wg_peers(user_ids)
+        if peers:
+            await self.remove_peers(peers)
+        return len(peers)
+
+    async def stats(self):
+        counts = await self.db.get_wg_peer_counts()
+        return {'peers': sum(counts.values()), 'servers': len(self.servers.nodes)}
+
+
+class MarzbanBackend(VPNBackend):
+    """Пользователи V2Ray в панели Marzban; HTTP-запросы - вне цикла событий"""
+
+    protocol = 'v2ray'
+
+    @staticmethod
+    def _marzban():
+        return MarzbanService(
+            MARZBAN_API_URL,
+            MARZBAN_API_USERNAME,
+            MARZBAN_API_PASSWORD
+        )
+
+    async def provision(self, user_id, is_trial=False, server=None, expire_ts=None):
+        """
+        Ссылка подписки; существующему пользователю - его текущая. Срок
+        пользователя в Marzban - expire_ts (конец подписки)
+        """
+        duration = 3 if is_trial else 30
+        subscription_url, username = await asyncio.to_thread(
+            self._marzban().create_user, user_id, duration, expire_ts
+        )
+        if not subscription_url:
+            raise BackendError(f"Marzban не выдал подписку пользователю {user_id}")
+        return subscription_url, username
+
+    async def revoke(self, user_ids):
+        """Отключает пользователей (одна HTTP-сессия на пачку)"""
+        return await asyncio.to_thread(
+            self._marzban().disable_users, [f"user_{user_id}" for user_id in user_ids]
+        )
+
+    async def stats(self):
+        _, total = await asyncio.to_thread(self._marzban().get_users, 'active', 0, 1)
+        return {'users': total}
+
+
+class FakeBackend(VPNBackend):
+    """
+    Бэкенд в памяти для нагрузочной проверки бота: каждая операция
+    ждёт latency_ms (±50%) и с вероятностью failure_rate завершается
+    BackendError. Выданные ключи живут до перезапуска.
+    """
+
+    def __init__(self, protocol, latency_ms=FAKE_BACKEND_LATENCY_MS,
+                 failure_rate=FAKE_BACKEND_FAILURE_RATE, seed=None):
+        self.protocol = protocol
+        self.latency = latency_ms / 1000
+        self.failure_rate = failure_rate
+        self.clients = {}
+        self.calls = 0
+        self.failures = 0
+        self._next_host = 2
+        self._random = random.Random(seed)
+
+    async def _operation(self, name):
+        self.calls += 1
+        if self.latency:
+            await asyncio.sleep(self.latency * self._random.uniform(0.5, 1.5))
+        if self._random.random() < self.failure_rate:
+            self.failures += 1
+            raise BackendError(f"fake {self.protocol} backend: {name} failed")
+
+    def _next_address(self):
+        host = self._next_host
+        self._next_host += 1
+        return f"10.{host >> 16 & 255}.{host >> 8 & 255}.{host & 255}"
+
+    async def provision(self, user_id, is_trial=False, server=None, expire_ts=None):
+        await self._operation('provision')
+        client = self.clients.get(user_id)
+        if client:
+            return client
+
+        address = self._next_address()
+        client_name = f"user_{user_id}"
+        if self.protocol == 'wireguard':
+            key = CLIENT_CONFIG_TEMPLATE.format(
+                private_key=_fake_key(),
+                addresses=f"{address}/32",
+                server_public_key=_fake_key(),
+                preshared_key=_fake_key(),
+                endpoint='fake.invalid:51820',
+                allowed_ips='0.0.0.0/0'
+            )
+        else:
+            key = f"https://fake.invalid/sub/{client_name}"
+        # Одновременный provision мог успеть раньше - ключ остаётся первым
+        return self.clients.setdefault(user_id, (key, client_name))
+
+    async def revoke(self, user_ids):
+        await self._operation('revoke')
+        return sum(1 for user_id in user_ids if self.clients.pop(user_id, None))
+
+    async def stats(self):
+        return {
+            'clients': len(self.clients),
+            'calls': self.calls,
+            'failures': self.failures,
+            'latency_ms': round(self.latency * 1000),
+            'failure_rate': self.failure_rate,
+        }
+
+
+def _fake_key():
+    """Случайная строка в формате ключа WireGuard (не ключ X25519)"""
+    return base64.b64encode(secrets.token_bytes(32)).decode()
@@ -0,0 +1,107 @@
+import ipaddress
+
+# Хосты 0 (адрес сети) и 1 (сервер) в каждом префиксе не выдаются
+FIRST_HOST = 2
+# Верхняя граница номеров хостов: IPv6-префикс /64 не помещается
+# в INTEGER SQLite, а столько клиентов всё равно не бывает
+MAX_POOL_HOSTS = 2 ** 32
+
+
+class IPAllocator:
+    """
+    Адреса клиентов WireGuard одного сервера. Состояние пулов хранится
+    в БД (wg_pools/wg_addresses), выдача и освобождение атомарны - они
+    выполняются единицами работы писателя базы.
+
+    ipv4 - префиксы, которые заполняются по порядку; ipv6 - необязательные
+    префиксы, из которых клиент получает второй адрес (dual-stack).
+    """
+
+    def __init__(self, db, server, ipv4, ipv6=(), interface=None, runner=None):
+        self.db = db
+        self.server = server
+        # interface и runner - wg-интерфейс сервера для первичного импорта
+        self.interface = interface
+        self.runner = runner
+        self.networks = {}
+        self.families = []
+        for prefixes in (ipv4, ipv6):
+            family = []
+            for prefix in prefixes:
+                network = ipaddress.ip_network(prefix)
+                pool = f"{server}:{network}"
+                self.networks[pool] = network
+                family.append(pool)
+            if family:
+                self.families.append(family)
+
+    @property
+    def dual_stack(self):
+        return len(self.families) > 1
+
+    @staticmethod
+    def _pool_size(network):
+        """Граница номеров хостов (исключая её саму)"""
+        if network.version == 4:
+            # последний адрес IPv4 - broadcast
+            return min(network.num_addresses - 1, MAX_POOL_HOSTS)
+        return min(network.num_addresses, MAX_POOL_HOSTS)
+
+    async def setup(self):
+        """Регистрирует пулы; при первом запуске импортирует занятые адреса с интерфейса"""
+        peers = await self._interface_addresses()
+        for pool, network in self.networks.items():
+            size = self._pool_size(network)
+            used = {}
+            for address, public_key in peers:
+                if address.version == network.version and address in network:
+                    host = int(address) - int(network.network_address)
+                    if FIRST_HOST <= host < size:
+                        used[host] = public_key
+            if await self.db.register_wg_pool(pool, FIRST_HOST, size, used):
+                print(f"Пул адресов {pool} зарегистрирован")
+
+    async def _interface_addresses(self):
+        """[(адрес, public_key)] адресов, уже выданных на интерфейсе"""
+        if not self.interface or not self.runner:
+            return []
+        try:
+            output = await self.runner.run(['wg', 'show', self.interface, 'allowed-ips'])
+        except Exception as e:
+            print(f"Не удалось прочитать адреса {self.interface}: {e}")
+            return []
+
+        peers = []
+        for line in output.splitlines():
+            public_key, _, allowed_ips = line.partition('\t')
+            for allowed_ip in allowed_ips.split():
+                try:
+                    peers.append((ipaddress.ip_interface(allowed_ip).ip, public_key))
+                except ValueError:
+                    continue
+        return peers
+
+    async def allocate(self, public_key):
+        """
+        Выдаёт ключу адрес из каждого семейства (IPv4, затем IPv6).
+        Возвращает список адресов или None, если пулы исчерпаны.
+        """
+        addresses = await self.db.allocate_wg_addresses(self.families, public_key)
+        if addresses is None:
+            return None
+        return [
+            self.networks[pool].network_address + host
+            for pool, host in addresses
+        ]
+
+    async def release(self, public_key):
+        return await self.db.release_wg_address(public_key)
+
+    async def usage(self):
+        """[(префикс, занято, ёмкость)] по пулам сервера"""
+        usage = await self.db.get_wg_pool_usage()
+        report = []
+        for pool, network in self.networks.items():
+            used = usage.get(pool, (0,))[0]
+            report.append((str(network), used, self._pool_size(network) - FIRST_HOST))
+        return report
@@ -28,8 +28,12 @@ class MarzbanService:
         else:
             raise Exception(f"Failed to get token: {response.text}")
     
-    def create_user(self, user_id: int, duration_days: int = 30) -> Tuple[Optional[str], Optional[str]]:
-        """Создать пользователя V2Ray в Marzban"""
+    def create_user(self, user_id: int, duration_days: int = 30,
+                    expire_ts: Optional[int] = None) -> Tuple[Optional[str], Optional[str]]:
+        """
+        Создать пользователя V2Ray в Marzban (существующего - включить).
+        expire_ts - конец подписки (epoch); без него - duration_days от текущего момента
+        """
         try:
             token = self._get_token()
             headers = {
@@ -38,7 +42,7 @@ class MarzbanService:
             }
             
             username = f"user_{user_id}"
-            expire_timestamp = int((datetime.now() + timedelta(days=duration_days)).timestamp())
+            expire_timestamp = expire_ts or int((datetime.now() + timedelta(days=duration_days)).timestamp())
             
             # Проверяем существует ли пользователь
             check_response = requests.get(
@@ -47,9 +51,21 @@ class MarzbanService:
             )
             
             if check_response.status_code == 200:
-                # Пользователь существует - возвращаем subscription URL
-                user_info = check_response.json()
-                subscription_url = user_info.get('subscription_url', '')
+                # Пользователь существует (возможно, отключён reaper'ом) -
+                # включаем его до конца подписки и возвращаем subscription URL
+                response = requests.put(
+                    f"{self.base_url}/api/user/{username}",
+                    headers=headers,
+                    json={"status": "active", "expire": expire_timestamp}
+                )
+
+                if response.status_code != 200:
+                    print(f"Error reactivating user: {response.text}")
+                    return None, None
+
+                user_info = response.json()
+                subscription_url = user_info.get('subscription_url') or \
+                    check_response.json().get('subscription_url', '')
                 
                 if subscription_url:
                     return subscription_url, username
@@ -95,4 +111,58 @@ class MarzbanService:
             print(f"Error in create_user: {e}")
             import traceback
             traceback.print_exc()
-            return None, None
\ No newline at end of file
+            return None, None
+    
+    def disable_users(self, usernames) -> int:
+        """Отключить пользователей Marzban (одна сессия на всю пачку)"""
+        disabled = 0
+        try:
+            token = self._get_token()
+            headers = {
+                "Authorization": f"Bearer {token}",
+                "Content-Type": "application/json"
+            }
+            
+            with requests.Session() as session:
+                session.headers.update(headers)
+                for username in usernames:
+                    response = session.put(
+                        f"{self.base_url}/api/user/{username}",
+                        json={"status": "disabled"}
+                    )
+                    if response.status_code == 200:
+                        disabled += 1
+                    elif response.status_code != 404:
+                        # 404 - у пользователя не было V2Ray
+                        print(f"Error disabling {username}: {response.text}")
+            
+            return disabled
+                
+        except Exception as e:
+            print(f"Error in disable_users: {e}")
+            return disabled
+    
+    def get_users(self, status='active', offset=0, limit=None) -> Tuple[list, int]:
+        """Имена пользователей Marzban со статусом status и их общее число"""
+        try:
+            token = self._get_token()
+            params = {"status": status, "offset": offset}
+            if limit is not None:
+                params["limit"] = limit
+            
+            response = requests.get(
+                f"{self.base_url}/api/users",
+                headers={"Authorization": f"Bearer {token}"},
+                params=params
+            )
+            
+            if response.status_code != 200:
+                print(f"Error listing users: {response.text}")
+                return [], 0
+            
+            data = response.json()
+            return [user['username'] for user in data.get('users', [])], data.get('total', 0)
+                
+        except Exception as e:
+            print(f"Error in get_users: {e}")
+            return [], 0
@@ -0,0 +1,49 @@
+import logging
+import time
+from telegram.ext import ContextTypes
+from config import REAPER_MAX_BATCHES
+from services.vpn_service import VPNService
+
+logger = logging.getLogger(__name__)
+
+
+async def reap_job(context: ContextTypes.DEFAULT_TYPE):
+    """
+    Периодическая задача JobQueue: деактивирует истёкшие подписки пачками
+    и отзывает доступ у пользователей, оставшихся без подписки - peer'ы
+    WireGuard убираются одним вызовом wg на пачку, доступ в бэкендах
+    протоколов отзывается (не больше REAPER_MAX_BATCHES пачек за запуск).
+    """
+    db = context.job.data
+    started = time.monotonic()
+    deactivated = revoked_peers = revoked_users = 0
+
+    for _ in range(REAPER_MAX_BATCHES):
+        try:
+            count, expired_users, peers = await db.reap_expired_batch()
+        except Exception as e:
+            logger.error(f"Ошибка отзыва истёкших подписок: {e}")
+            break
+        if not count:
+            break
+        deactivated += count
+
+        if peers:
+            try:
+                await VPNService.revoke_peers(peers)
+                revoked_peers += len(peers)
+            except Exception as e:
+                # Peer'ы уже отозваны в БД - с интерфейса их уберёт сверка
+                logger.error(f"Ошибка удаления peer'ов WireGuard: {e}")
+        if expired_users:
+            # WireGuard-peer'ы уже отозваны в той же единице работы, что и
+            # подписки; бэкенды отключают остальное (пользователей Marzban)
+            revoked_users += await VPNService.revoke_users(expired_users)
+
+    if deactivated:
+        elapsed = time.monotonic() - started
+        logger.info(
+            f"Истёкшие подписки: деактивировано {deactivated}, peer'ов убрано {revoked_peers}, "
+            f"отозвано доступов в бэкендах {revoked_users} за {elapsed:.2f}с "
+            f"({deactivated / max(elapsed, 1e-6):.0f} подписок/с)"
+        )
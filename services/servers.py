@@ -0,0 +1,222 @@
+import asyncio
+import time
+from config import (
+    WG_NODES, WG_POOLS, WG_SSH, WG_WARM_POOL_SIZE,
+    PLACEMENT_CACHE_SECONDS, PLACEMENT_HANDSHAKE_WINDOW, PLACEMENT_HANDSHAKE_WEIGHT,
+    REBALANCE_IDLE_DAYS, REBALANCE_MAX_PEERS
+)
+from services.ip_allocator import IPAllocator
+from services.wg_sync import PeerSyncEngine
+from services.wg_reconcile import Reconciler
+from services.warm_pool import WarmPool
+from services.telemetry import UsageCollector
+from services.wg_command import LocalRunner, SSHRunner
+
+WG_INTERFACE = "wg0"
+DAY = 86400
+
+
+def make_runner(server, driver):
+    """Исполнитель команд wg для сервера по его драйверу из WG_NODES"""
+    if driver == 'local':
+        return LocalRunner()
+    if driver == 'ssh':
+        return SSHRunner(**WG_SSH[server])
+    raise ValueError(f"Unknown WireGuard driver for server {server}: {driver}")
+
+
+class Node:
+    """
+    Сервер WireGuard: пул адресов, пакетное применение peer'ов, сверка
+    интерфейса с БД, тёплый пул и сбор трафика - всё через исполнитель
+    команд runner
+    """
+
+    def __init__(self, server, runner, pools, interface=WG_INTERFACE):
+        self.server = server
+        self.runner = runner
+        self.pools = pools
+        self.interface = interface
+        self.allocator = None
+        self.peer_sync = None
+        self.reconciler = None
+        self.warm_pool = None
+        self.usage = None
+
+    async def setup(self, db, provision):
+        """provision(node) - корутина, создающая peer на этом сервере"""
+        self.allocator = IPAllocator(
+            db, self.server, self.pools['ipv4'], self.pools['ipv6'],
+            interface=self.interface, runner=self.runner
+        )
+        await self.allocator.setup()
+
+        self.peer_sync = PeerSyncEngine(self.runner, self.interface)
+        self.peer_sync.start()
+        self.reconciler = Reconciler(db, self.runner, self.peer_sync, self.server, self.interface)
+        self.usage = UsageCollector(db, self.runner, self.server, self.interface)
+
+        if WG_WARM_POOL_SIZE > 0:
+            self.warm_pool = WarmPool(db, self.server, lambda: provision(self))
+            self.warm_pool.start()
+
+    async def stop(self):
+        if self.warm_pool:
+            await self.warm_pool.stop()
+        if self.peer_sync:
+            await self.peer_sync.stop()
+        self.runner.close()
+
+    async def handshakes(self):
+        """{public_key: время последнего рукопожатия (0 - не было)}"""
+        output = await self.runner.run(['wg', 'show', self.interface, 'latest-handshakes'])
+        handshakes = {}
+        for line in output.splitlines():
+            public_key, _, timestamp = line.partition('\t')
+            if timestamp.strip().isdigit():
+                handshakes[public_key] = int(timestamp)
+        return handshakes
+
+    async def capacity(self):
+        """(занято, ёмкость) IPv4-пулов - IPv6 в ULA не ограничивает"""
+        usage = [row for row in await self.allocator.usage() if ':' not in row[0]]
+        return sum(used for _, used, _ in usage), sum(size for _, _, size in usage)
+
+
+class ServerRegistry:
+    """
+    Реестр серверов WireGuard (WG_NODES) и размещение новых peer'ов на
+    наименее загруженном.
+
+    Нагрузка сервера - score = (peer'ы + PLACEMENT_HANDSHAKE_WEIGHT *
+    активные за PLACEMENT_HANDSHAKE_WINDOW) / доля свободных адресов:
+    активные клиенты весят больше, почти заполненный пул - дороже.
+    Сервер без свободных адресов не выбирается.
+    """
+
+    def __init__(self, db):
+        self.db = db
+        self.nodes = {}
+        self.provision = None
+        self._loads = None
+        self._loads_ts = 0
+
+    async def setup(self, provision):
+        self.provision = provision
+        for server, driver in WG_NODES.items():
+            if not driver:
+                continue
+            node = Node(server, make_runner(server, driver), WG_POOLS[server])
+            await node.setup(self.db, provision)
+            self.nodes[server] = node
+
+    async def stop(self):
+        for node in self.nodes.values():
+            await node.stop()
+        self.nodes = {}
+
+    def get(self, server):
+        return self.nodes.get(server)
+
+    async def loads(self, fresh=False):
+        """{сервер: {'peers', 'active', 'used', 'capacity', 'score'}}"""
+        if not fresh and self._loads and time.monotonic() - self._loads_ts < PLACEMENT_CACHE_SECONDS:
+            return self._loads
+
+        counts = await self.db.get_wg_peer_counts()
+        since = int(time.time()) - PLACEMENT_HANDSHAKE_WINDOW
+        loads = {}
+        for server, node in self.nodes.items():
+            try:
+                handshakes = await node.handshakes()
+            except Exception as e:
+                # Сервер недоступен - новых peer'ов на него не ставим
+                print(f"Error reading handshakes of server {server}: {e}")
+                continue
+            used, capacity = await node.capacity()
+            loads[server] = {
+                'peers': counts.get(server, 0),
+                'active': sum(1 for timestamp in handshakes.values() if timestamp >= since),
+                'used': used,
+                'capacity': capacity,
+            }
+            loads[server]['score'] = self._score(loads[server])
+
+        self._loads = loads
+        self._loads_ts = time.monotonic()
+        return loads
+
+    @staticmethod
+    def _score(load):
+        free = (load['capacity'] - load['used']) / max(load['capacity'], 1)
+        if free <= 0:
+            return None
+        return (load['peers'] + PLACEMENT_HANDSHAKE_WEIGHT * load['active']) / free
+
+    async def place(self):
+        """Сервер для нового peer'а или None, если свободных адресов нет нигде"""
+        loads = await self.loads()
+        candidates = [
+            (load['score'], server) for server, load in loads.items()
+            if load['score'] is not None
+        ]
+        if not candidates:
+            return None
+        _, server = min(candidates)
+
+        # Снимок нагрузки кэширован: учитываем выданный peer сразу, чтобы
+        # всплеск регистраций не ушёл целиком на один сервер
+        loads[server]['peers'] += 1
+        loads[server]['used'] += 1
+        loads[server]['score'] = self._score(loads[server])
+        return server
+
+    async def rebalance(self, max_peers=REBALANCE_MAX_PEERS):
+        """
+        Переносит неактивные peer'ы (созданные и без рукопожатий больше
+        REBALANCE_IDLE_DAYS дней назад) с самого загруженного сервера на
+        наименее загруженный. Peer без рукопожатий, выданный недавно, не
+        переносится: клиент мог ещё не импортировать конфиг.
+        Перенесённый пользователь получит новый конфиг при следующем
+        запросе ключа. Возвращает (откуда, куда, [перенесённые user_id]).
+        """
+        loads = await self.loads(fresh=True)
+        targets = [(load['score'], server) for server, load in loads.items() if load['score'] is not None]
+        if len(loads) < 2 or not targets:
+            return None, None, []
+        source = max(loads, key=lambda server: loads[server]['peers'])
+        _, target = min(targets)
+        count = min((loads[source]['peers'] - loads[target]['peers']) // 2, max_peers)
+        if source == target or count <= 0:
+            return source, target, []
+
+        source_node, target_node = self.nodes[source], self.nodes[target]
+        handshakes = await source_node.handshakes()
+        idle_before = int(time.time()) - REBALANCE_IDLE_DAYS * DAY
+        idle = [
+            peer for peer in await self.db.get_wg_peers_on_server(source)
+            if (peer.created_ts or 0) < idle_before
+            and handshakes.get(peer.public_key, 0) < idle_before
+        ][:count]
+
+        # Новые peer'ы на целевом сервере создаются одной пачкой wg
+        provisioned = await asyncio.gather(
+            *[self.provision(target_node) for _ in idle], return_exceptions=True
+        )
+        moved = []
+        for peer, keys in zip(idle, provisioned):
+            if keys is None or isinstance(keys, Exception):
+                continue
+            if await self.db.move_wg_peer(peer.id, peer.user_id, target, *keys):
+                moved.append(peer)
+            else:
+                # Peer успели отозвать (истекла подписка) - отменяем перенос
+                await target_node.peer_sync.remove_peer(keys[1])
+                await target_node.allocator.release(keys[1])
+
+        if moved:
+            # Старые peer'ы уходят с исходного сервера одной пачкой
+            await asyncio.gather(*[source_node.peer_sync.remove_peer(peer.public_key) for peer in moved])
+            await self.db.release_wg_addresses([peer.public_key for peer in moved])
+            self._loads = None
+        return source, target, [peer.user_id for peer in moved]
@@ -1,147 +1,154 @@
-import subprocess
-import os
-import asyncio
-from config import (
-    SERVER_1_IP, SERVER_1_WG_PORT, SERVER_1_WG_PUBLIC_KEY, SERVER_1_WG_ENDPOINT,
-    SERVER_2_IP, SERVER_2_WG_PORT, SERVER_2_WG_PUBLIC_KEY, SERVER_2_WG_ENDPOINT,
-    MARZBAN_API_URL, MARZBAN_API_USERNAME, MARZBAN_API_PASSWORD
-)
-from services.marzban_service import MarzbanService
+from config import VPN_BACKENDS, CACHE_MAX_ENTRIES, KEY_CACHE_SECONDS
+from services.backends import make_backend, WireGuardBackend
+from services.servers import ServerRegistry
+from utils.single_flight import SingleFlight
 
-CLIENT_CONFIG_DIR = "/root"
-WG_INTERFACE = "wg0"
 
 class VPNService:
+    # Бэкенды выдачи ключей по протоколам (VPN_BACKENDS), создаются в
+    # setup() при старте бота
+    db = None
+    backends = {}
+    # Реестр серверов WireGuard (пулы адресов, применение peer'ов, сверка,
+    # тёплые пулы); у поддельного бэкенда - пустой
+    servers = None
+    # Выдача ключей: одна на (пользователь, протокол, сервер) одновременно,
+    # удачный результат кэшируется на KEY_CACHE_SECONDS
+    key_flights = SingleFlight(
+        KEY_CACHE_SECONDS, CACHE_MAX_ENTRIES, cache_if=lambda result: result[0] is not None
+    )
+
+    @classmethod
+    async def setup(cls, db):
+        """Создаёт и подготавливает бэкенды протоколов"""
+        cls.db = db
+        cls.backends = {
+            protocol: make_backend(protocol, name, db)
+            for protocol, name in VPN_BACKENDS.items()
+        }
+        for backend in cls.backends.values():
+            await backend.setup()
+        
+        wireguard = cls.backends['wireguard']
+        cls.servers = wireguard.servers if isinstance(wireguard, WireGuardBackend) else ServerRegistry(db)
+
+    @classmethod
+    async def shutdown(cls):
+        """Останавливает бэкенды (пополнение пулов, применение peer'ов)"""
+        for backend in cls.backends.values():
+            await backend.shutdown()
+
+    @classmethod
+    async def get_backend_stats(cls):
+        """{протокол: (имя бэкенда, метрики)}"""
+        stats = {}
+        for protocol, backend in cls.backends.items():
+            try:
+                stats[protocol] = (VPN_BACKENDS[protocol], await backend.stats())
+            except Exception as e:
+                print(f"Error reading {protocol} backend stats: {e}")
+        return stats
+
+    @classmethod
+    async def get_warm_pool_stats(cls):
+        """{сервер: метрики тёплого пула}"""
+        return {
+            server: await node.warm_pool.stats()
+            for server, node in cls.servers.nodes.items() if node.warm_pool
+        }
+
+    @classmethod
+    async def get_pool_usage(cls):
+        """{сервер: [(префикс, занято, ёмкость)]}"""
+        return {
+            server: await node.allocator.usage()
+            for server, node in cls.servers.nodes.items()
+        }
+
+    @classmethod
+    async def rebalance(cls):
+        """Перенос неактивных peer'ов между серверами; (откуда, куда, перенесено)"""
+        source, target, moved_users = await cls.servers.rebalance()
+        cls.forget_keys(moved_users)
+        return source, target, len(moved_users)
+
     @staticmethod
-    async def generate_vpn_key(user_id, server=1, protocol='wireguard', is_trial=False):
+    def forget_keys(user_ids, server=None):
+        """Сбрасывает кэш выданных ключей пользователей (ключ отозван, перенесён или подписка оплачена)"""
+        for user_id in user_ids:
+            for protocol in ('wireguard', 'v2ray'):
+                VPNService.key_flights.forget((user_id, protocol, None))
+                if server is not None:
+                    VPNService.key_flights.forget((user_id, protocol, server))
+
+    @staticmethod
+    async def generate_vpn_key(user_id, server=None, protocol='wireguard', is_trial=False, expire_ts=None):
         """
-        Генерирует VPN ключ (только Сервер 1)
+        Генерирует VPN ключ
+        server: сервер WireGuard; None - наименее загруженный
         protocol: 'wireguard' или 'v2ray'
+        expire_ts: конец подписки (epoch) - срок доступа в Marzban
+        Одновременные запросы одного пользователя (двойное нажатие, повторный
+        /start) ждут одну выдачу вместо того, чтобы запускать свою
         """
-        if protocol == 'v2ray':
-            return await VPNService._generate_v2ray_key(user_id, is_trial)
-        else:
-            return await VPNService._generate_wireguard_key(user_id, is_trial)
+        return await VPNService.key_flights.do(
+            (user_id, protocol, server),
+            VPNService._issue_vpn_key, user_id, server, protocol, is_trial, expire_ts
+        )
 
     @staticmethod
-    async def _generate_v2ray_key(user_id, is_trial):
-        """Генерирует V2Ray ключ через Marzban API"""
+    async def _issue_vpn_key(user_id, server, protocol, is_trial, expire_ts):
         try:
-            marzban = MarzbanService(
-                MARZBAN_API_URL,
-                MARZBAN_API_USERNAME,
-                MARZBAN_API_PASSWORD
-            )
-            
-            duration = 3 if is_trial else 30
-            subscription_url, username = marzban.create_user(user_id, duration)
-            
-            if subscription_url:
-                return subscription_url, username
-            else:
-                return None, None
-                
+            return await VPNService.backends[protocol].provision(user_id, is_trial, server, expire_ts)
         except Exception as e:
-            print(f"Error generating V2Ray key: {e}")
+            print(f"❌ Ошибка выдачи ключа {protocol} пользователю {user_id}: {e}")
             return None, None
     
     @staticmethod
-    async def _generate_wireguard_key(user_id, is_trial):
-        """Генерирует WireGuard конфиг (локально на сервере 1)"""
-        client_name = f"user_{user_id}"
-        config_path = f"/root/wg0-client-{client_name}.conf"
-        
-        # Проверяем существующий конфиг
-        if os.path.exists(config_path):
-            with open(config_path, 'r') as f:
-                return f.read(), client_name
-        
-        try:
-            # Получаем занятые IP
-            result = subprocess.run(['wg', 'show', 'wg0', 'allowed-ips'], 
-                                capture_output=True, text=True, check=True)
-            
-            used_ips = []
-            import re
-            for line in result.stdout.strip().split('\n'):
-                if '10.66.66.' in line:
-                    match = re.search(r'10\.66\.66\.(\d+)', line)
-                    if match:
-                        used_ips.append(int(match.group(1)))
-            
-            next_ip = 2
-            while next_ip in used_ips:
-                next_ip += 1
-            
-            print(f"Создаю WireGuard клиента с IP 10.66.66.{next_ip}")
-            
-            # Генерируем ключи
-            private_key_result = subprocess.run(['wg', 'genkey'], capture_output=True, text=True, check=True)
-            private_key = private_key_result.stdout.strip()
-            
-            public_key_result = subprocess.run(['wg', 'pubkey'], input=private_key, capture_output=True, text=True, check=True)
-            public_key = public_key_result.stdout.strip()
-            
-            preshared_key_result = subprocess.run(['wg', 'genpsk'], capture_output=True, text=True, check=True)
-            preshared_key = preshared_key_result.stdout.strip()
-            
-            # Добавляем peer
-            with open('/tmp/psk.tmp', 'w') as f:
-                f.write(preshared_key)
-            
-            subprocess.run([
-                'wg', 'set', 'wg0',
-                'peer', public_key,
-                'preshared-key', '/tmp/psk.tmp',
-                'allowed-ips', f'10.66.66.{next_ip}/32'
-            ], check=True)
-            
-            os.remove('/tmp/psk.tmp')
-            
-            subprocess.run(['wg-quick', 'save', 'wg0'], check=True)
-            
-            # Создаем конфиг
-            config_text = f"""[Interface]
-PrivateKey = {private_key}
-Address = 10.66.66.{next_ip}/32
-DNS = 1.1.1.1, 1.0.0.1
-
-[Peer]
-PublicKey = {SERVER_1_WG_PUBLIC_KEY}
-PresharedKey = {preshared_key}
-Endpoint = {SERVER_1_WG_ENDPOINT}
-AllowedIPs = 0.0.0.0/0
-PersistentKeepalive = 25
-"""
-        
-            # Сохраняем
-            with open(config_path, 'w') as f:
-                f.write(config_text)
-            
-            print(f"✅ WireGuard клиент создан: {client_name}, IP: 10.66.66.{next_ip}")
-            return config_text, client_name
-            
-        except Exception as e:
-            print(f"❌ Ошибка WireGuard: {e}")
-            import traceback
-            traceback.print_exc()
-            return None, None
-        
-    @staticmethod
-    async def delete_vpn_key(user_id, user_uuid):
-        """Удаляет клиента из WireGuard"""
+    async def delete_vpn_key(user_id, user_uuid, protocol='wireguard'):
+        """Отзывает ключ пользователя в бэкенде протокола"""
+        VPNService.forget_keys([user_id])
         try:
-            config_path = f"{CLIENT_CONFIG_DIR}/wg0-client-{user_uuid}.conf"
-            
-            if os.path.exists(config_path):
-                os.remove(config_path)
-            
-            print(f"🗑️ Deleted config for {user_uuid}")
+            await VPNService.backends[protocol].revoke([user_id])
+            print(f"🗑️ Revoked {protocol} access for {user_uuid}")
             return True
         except Exception as e:
             print(f"❌ Error deleting: {e}")
             return False
     
+    @staticmethod
+    async def revoke_peers(peers):
+        """
+        Убирает уже отозванные в БД peer'ы [(сервер, public_key)] с wg0
+        одной пачкой и возвращает их адреса в пул
+        """
+        backend = VPNService.backends['wireguard']
+        if isinstance(backend, WireGuardBackend):
+            await backend.remove_peers(peers)
+    
+    @staticmethod
+    async def revoke_users(user_ids):
+        """
+        Отзывает доступ пользователей во всех бэкендах; возвращает число
+        отозванных. Ошибка одного бэкенда не мешает остальным
+        """
+        VPNService.forget_keys(user_ids)
+        revoked = 0
+        for protocol, backend in VPNService.backends.items():
+            try:
+                revoked += await backend.revoke(user_ids)
+            except Exception as e:
+                print(f"Error revoking {protocol} access: {e}")
+        return revoked
+    
+    @staticmethod
+    def stored_key(protocol, vpn_key):
+        """
+        Что хранить в subscriptions.vpn_key: конфиг WireGuard рендерится
+        из wg_peers, в подписке остаётся только ссылка V2Ray
+        """
+        return vpn_key if protocol == 'v2ray' else None
+    
     @staticmethod
     def get_app_download_link(device_type, protocol='wireguard'):
         """Ссылки на приложения"""
@@ -0,0 +1,102 @@
+import asyncio
+import time
+from config import WG_WARM_POOL_SIZE, WG_WARM_POOL_REFILL_BATCH
+
+# Проверка глубины пула, даже если выдач не было
+REFILL_INTERVAL_SECONDS = 60
+
+
+class WarmPool:
+    """
+    Тёплый пул WireGuard peer'ов одного сервера: ключи, PSK и адреса
+    готовы заранее, peer уже добавлен на интерфейс. Новый клиент
+    забирает готовый peer, пул пополняется в фоне.
+
+    provision - корутина-функция, создающая peer и возвращающая
+    (private_key, public_key, preshared_key, addresses) или None.
+    """
+
+    def __init__(self, db, server, provision, size=WG_WARM_POOL_SIZE,
+                 batch=WG_WARM_POOL_REFILL_BATCH):
+        self.db = db
+        self.server = server
+        self.provision = provision
+        self.size = size
+        self.batch = batch
+        self.claimed = 0
+        self.missed = 0
+        self.refilled = 0
+        self.refill_rate = 0.0  # peer'ов в секунду за последнее пополнение
+        self._wakeup = asyncio.Event()
+        self._task = None
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._loop())
+
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    async def claim(self, user_id):
+        """Выдаёт готовый peer пользователю: WgPeer или None, если пул пуст"""
+        peer = await self.db.claim_pool_peer_for_user(user_id, self.server)
+        if peer:
+            self.claimed += 1
+        else:
+            self.missed += 1
+        self._wakeup.set()
+        return peer
+
+    async def _loop(self):
+        while True:
+            try:
+                await self._refill()
+            except Exception as e:
+                print(f"Error refilling warm pool: {e}")
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), REFILL_INTERVAL_SECONDS)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+
+    async def _refill(self):
+        depth = await self.db.get_pool_peer_count(self.server)
+        started = time.monotonic()
+        added = 0
+        while depth < self.size:
+            count = min(self.batch, self.size - depth)
+            # Peer'ы пачки попадают в один вызов wg через PeerSyncEngine
+            results = await asyncio.gather(
+                *[self.provision() for _ in range(count)],
+                return_exceptions=True
+            )
+            ready = [peer for peer in results if peer and not isinstance(peer, Exception)]
+            for private_key, public_key, preshared_key, addresses in ready:
+                if await self.db.add_pool_peer(self.server, private_key, public_key,
+                                               preshared_key, addresses):
+                    added += 1
+            if not ready:
+                # Пул адресов исчерпан или wg недоступен - до следующей проверки
+                break
+            depth += len(ready)
+
+        if added:
+            self.refilled += added
+            self.refill_rate = added / max(time.monotonic() - started, 1e-6)
+            print(f"Тёплый пул сервера {self.server}: +{added}, {self.refill_rate:.1f} peer/с")
+
+    async def stats(self):
+        return {
+            'depth': await self.db.get_pool_peer_count(self.server),
+            'size': self.size,
+            'claimed': self.claimed,
+            'missed': self.missed,
+            'refilled': self.refilled,
+            'refill_rate': self.refill_rate,
+        }
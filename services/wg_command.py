@@ -0,0 +1,235 @@
+import asyncio
+import itertools
+import os
+import shlex
+import socket
+import threading
+import paramiko
+from config import (
+    WG_COMMAND_TIMEOUT, WG_MAX_CONCURRENT_COMMANDS,
+    WG_SSH_KNOWN_HOSTS, WG_SSH_STRICT_HOST_KEYS, WG_SSH_POOL_SIZE
+)
+
+
+class CommandError(Exception):
+    """Команда завершилась с ошибкой или не уложилась в таймаут"""
+
+
+class LocalRunner:
+    """
+    Запуск wg/wg-quick на этом сервере через asyncio-подпроцессы:
+    цикл событий не блокируется, число одновременных вызовов
+    ограничено семафором, каждый вызов - таймаутом.
+    """
+
+    def __init__(self, max_concurrent=WG_MAX_CONCURRENT_COMMANDS, timeout=WG_COMMAND_TIMEOUT):
+        self.timeout = timeout
+        self._semaphore = asyncio.Semaphore(max_concurrent)
+
+    async def run(self, args, input=None, timeout=None, pass_fds=()):
+        """
+        Выполняет команду и возвращает её stdout (str). pass_fds -
+        дескрипторы, доступные процессу как /dev/fd/N
+        """
+        timeout = timeout or self.timeout
+        async with self._semaphore:
+            try:
+                process = await asyncio.create_subprocess_exec(
+                    *args,
+                    stdin=asyncio.subprocess.PIPE if input is not None else asyncio.subprocess.DEVNULL,
+                    stdout=asyncio.subprocess.PIPE,
+                    stderr=asyncio.subprocess.PIPE,
+                    pass_fds=pass_fds
+                )
+            except OSError as e:
+                raise CommandError(f"{args[0]}: {e}") from e
+
+            try:
+                stdout, stderr = await asyncio.wait_for(
+                    process.communicate(input.encode() if input is not None else None),
+                    timeout
+                )
+            except asyncio.TimeoutError:
+                process.kill()
+                await process.wait()
+                raise CommandError(f"{' '.join(args[:3])}: timed out after {timeout}s")
+            except asyncio.CancelledError:
+                process.kill()
+                raise
+
+        if process.returncode != 0:
+            raise CommandError(
+                f"{' '.join(args[:3])}: exit code {process.returncode}: {stderr.decode().strip()}"
+            )
+        return stdout.decode()
+
+    async def run_many(self, commands, timeout=None):
+        """
+        Выполняет команды (args, input, pass_fds) по очереди до первой
+        ошибки; возвращает их общий stdout
+        """
+        output = []
+        for args, input, pass_fds in commands:
+            output.append(await self.run(args, input=input, timeout=timeout, pass_fds=pass_fds))
+        return ''.join(output)
+
+    def close(self):
+        pass
+
+
+class SSHRunner:
+    """
+    Запуск wg/wg-quick на удалённом сервере по SSH (paramiko) с тем же
+    интерфейсом, что у LocalRunner.
+
+    Держит WG_SSH_POOL_SIZE постоянных соединений: команда - это новый
+    канал в уже открытом соединении, без TCP- и SSH-рукопожатия.
+    Разорванное соединение переоткрывается при следующем вызове.
+    run_many отправляет несколько команд одним скриптом - один обмен
+    с сервером.
+
+    Дескрипторы pass_fds на удалённую машину не передать: их данные
+    (PSK) уходят в скрипте через stdin, записываются во временный
+    каталог в /dev/shm (память, права 0700) и удаляются по выходе,
+    а /dev/fd/N в аргументах заменяется путём к файлу. Ключи не
+    попадают ни в командную строку, ни на диск.
+    """
+
+    def __init__(self, host, port=22, username='root', key_filename=None,
+                 pool_size=WG_SSH_POOL_SIZE, max_concurrent=WG_MAX_CONCURRENT_COMMANDS,
+                 timeout=WG_COMMAND_TIMEOUT, known_hosts=WG_SSH_KNOWN_HOSTS,
+                 strict_host_keys=WG_SSH_STRICT_HOST_KEYS):
+        self.host = host
+        self.port = port
+        self.username = username
+        self.key_filename = key_filename
+        self.timeout = timeout
+        self.known_hosts = known_hosts
+        self.strict_host_keys = strict_host_keys
+        self._clients = [None] * max(pool_size, 1)
+        self._locks = [threading.Lock() for _ in self._clients]
+        self._next = itertools.cycle(range(len(self._clients)))
+        self._semaphore = asyncio.Semaphore(max_concurrent)
+
+    async def run(self, args, input=None, timeout=None, pass_fds=()):
+        """Выполняет команду на сервере и возвращает её stdout (str)"""
+        return await self.run_many([(args, input, pass_fds)], timeout=timeout)
+
+    async def run_many(self, commands, timeout=None):
+        """
+        Выполняет команды (args, input, pass_fds) одним обменом с
+        сервером до первой ошибки; возвращает их общий stdout
+        """
+        timeout = timeout or self.timeout
+        command, stdin = _remote_script(commands)
+        label = ' '.join(commands[-1][0][:3])
+        async with self._semaphore:
+            return await asyncio.to_thread(self._execute, next(self._next), command, stdin, timeout, label)
+
+    def close(self):
+        for slot, lock in enumerate(self._locks):
+            with lock:
+                if self._clients[slot]:
+                    self._clients[slot].close()
+                    self._clients[slot] = None
+
+    def _connect(self):
+        client = paramiko.SSHClient()
+        if self.known_hosts:
+            client.load_host_keys(self.known_hosts)
+        else:
+            client.load_system_host_keys()
+        client.set_missing_host_key_policy(
+            paramiko.RejectPolicy() if self.strict_host_keys else paramiko.AutoAddPolicy()
+        )
+        client.connect(
+            self.host, port=self.port, username=self.username,
+            key_filename=self.key_filename, timeout=self.timeout,
+            banner_timeout=self.timeout, auth_timeout=self.timeout
+        )
+        # Keepalive не даёт NAT и файрволам закрыть простаивающее соединение
+        client.get_transport().set_keepalive(30)
+        return client
+
+    def _transport(self, slot):
+        """Открытое соединение ячейки пула, при необходимости переподключается"""
+        with self._locks[slot]:
+            client = self._clients[slot]
+            if client is None or not client.get_transport() or not client.get_transport().is_active():
+                if client:
+                    client.close()
+                self._clients[slot] = None
+                self._clients[slot] = client = self._connect()
+            return client.get_transport()
+
+    def _execute(self, slot, command, stdin, timeout, label):
+        try:
+            channel = self._transport(slot).open_session(timeout=timeout)
+        except (paramiko.SSHException, OSError) as e:
+            raise CommandError(f"{label}: ssh {self.host}: {e}") from e
+
+        try:
+            channel.settimeout(timeout)
+            channel.exec_command(command)
+            if stdin is not None:
+                channel.sendall(stdin.encode())
+            channel.shutdown_write()
+            stdout = channel.makefile('rb').read()
+            stderr = channel.makefile_stderr('rb').read()
+            returncode = channel.recv_exit_status()
+        except socket.timeout:
+            raise CommandError(f"{label}: timed out after {timeout}s")
+        except (paramiko.SSHException, OSError) as e:
+            raise CommandError(f"{label}: ssh {self.host}: {e}") from e
+        finally:
+            channel.close()
+
+        if returncode != 0:
+            raise CommandError(f"{label}: exit code {returncode}: {stderr.decode().strip()}")
+        return stdout.decode()
+
+
+def _remote_script(commands):
+    """
+    (команда, stdin) для выполнения commands на сервере. Одна команда
+    без pass_fds выполняется напрямую, остальное - скриптом `sh -s`,
+    в котором данные дескрипторов и stdin команд записаны в файлы
+    """
+    if len(commands) == 1 and not commands[0][2]:
+        args, input, _ = commands[0]
+        return shlex.join(args), input
+
+    lines = [
+        'set -e',
+        'umask 077',
+        'dir=$(mktemp -d /dev/shm/wg.XXXXXX)',
+        'trap \'rm -rf "$dir"\' EXIT',
+    ]
+    files = itertools.count()
+    for args, input, pass_fds in commands:
+        paths = {}
+        for fd in pass_fds:
+            paths[f'/dev/fd/{fd}'] = _write_file(lines, next(files), _read_fd(fd))
+        line = ' '.join(paths.get(arg) or shlex.quote(arg) for arg in args)
+        if input is not None:
+            line += ' < ' + _write_file(lines, next(files), input)
+        lines.append(line)
+    return 'sh -s', '\n'.join(lines) + '\n'
+
+
+def _write_file(lines, number, data):
+    """Добавляет в скрипт запись data во временный файл; возвращает путь к нему"""
+    path = f'"$dir/{number}"'
+    # printf - встроенная команда: данные не видны в списке процессов
+    lines.append(f"printf '%s' {shlex.quote(data)} > {path}")
+    return path
+
+
+def _read_fd(fd):
+    """Всё содержимое канала (запись уже закрыта)"""
+    chunks = []
+    while True:
+        chunk = os.read(fd, 4096)
+        if not chunk:
+            return b''.join(chunks).decode()
+        chunks.append(chunk)
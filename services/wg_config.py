@@ -0,0 +1,63 @@
+from collections import OrderedDict
+from config import (
+    SERVER_1_WG_PUBLIC_KEY, SERVER_1_WG_ENDPOINT,
+    SERVER_2_WG_PUBLIC_KEY, SERVER_2_WG_ENDPOINT,
+    CACHE_MAX_ENTRIES
+)
+
+# Открытый ключ и endpoint WireGuard каждого сервера
+WG_SERVERS = {
+    1: (SERVER_1_WG_PUBLIC_KEY, SERVER_1_WG_ENDPOINT),
+    2: (SERVER_2_WG_PUBLIC_KEY, SERVER_2_WG_ENDPOINT),
+}
+
+CLIENT_CONFIG_TEMPLATE = """[Interface]
+PrivateKey = {private_key}
+Address = {addresses}
+DNS = 1.1.1.1, 1.0.0.1
+
+[Peer]
+PublicKey = {server_public_key}
+PresharedKey = {preshared_key}
+Endpoint = {endpoint}
+AllowedIPs = {allowed_ips}
+PersistentKeepalive = 25
+"""
+
+# (id peer'а, версия) -> текст конфига; версия меняется при любом
+# изменении peer'а, поэтому устаревших записей в кэше не бывает
+_rendered = OrderedDict()
+
+
+def render_client_config(peer):
+    """Клиентский конфиг peer'а (WgPeer) из шаблона"""
+    key = (peer.id, peer.version)
+    config_text = _rendered.get(key)
+    if config_text is not None:
+        _rendered.move_to_end(key)
+        return config_text
+
+    server_public_key, endpoint = WG_SERVERS[peer.server]
+    config_text = CLIENT_CONFIG_TEMPLATE.format(
+        private_key=peer.private_key,
+        addresses=peer.addresses,
+        server_public_key=server_public_key,
+        preshared_key=peer.preshared_key,
+        endpoint=endpoint,
+        allowed_ips='0.0.0.0/0, ::/0' if ':' in peer.addresses else '0.0.0.0/0'
+    )
+    _rendered[key] = config_text
+    if len(_rendered) > CACHE_MAX_ENTRIES:
+        _rendered.popitem(last=False)
+    return config_text
+
+
+def parse_client_config(config_text):
+    """{поле: значение} из клиентского конфига (для импорта старых файлов)"""
+    fields = {}
+    for line in config_text.splitlines():
+        name, separator, value = line.partition('=')
+        if separator and not line.lstrip().startswith('#'):
+            # Значение может оканчиваться на '=' (base64)
+            fields.setdefault(name.strip(), value.strip())
+    return fields
@@ -0,0 +1,149 @@
+import asyncio
+import ipaddress
+import logging
+import time
+from telegram.ext import ContextTypes
+from config import WG_RECONCILE_DRY_RUN, WG_RECONCILE_GRACE_SECONDS
+
+logger = logging.getLogger(__name__)
+
+WG_INTERFACE = "wg0"
+
+
+def _networks(allowed_ips):
+    """Нормализованное множество адресов из списка через запятую"""
+    return frozenset(
+        str(ipaddress.ip_network(address.strip(), strict=False))
+        for address in allowed_ips.split(',')
+        if address.strip() and address.strip() != '(none)'
+    )
+
+
+def parse_dump(dump):
+    """
+    {public_key: (preshared_key, адреса)} из `wg show <if> dump`.
+    Первая строка - сам интерфейс, дальше по строке на peer:
+    ключ, PSK, endpoint, allowed-ips, handshake, rx, tx, keepalive
+    """
+    peers = {}
+    for line in dump.splitlines()[1:]:
+        fields = line.split('\t')
+        if len(fields) < 4:
+            continue
+        peers[fields[0]] = (fields[1], _networks(fields[3]))
+    return peers
+
+
+class Reconciler:
+    """
+    Сверка wg-интерфейса с БД. Нужное состояние - действующие peer'ы
+    пользователей и тёплого пула; расхождения:
+    orphans    - peer на интерфейсе, которого нет в БД (или он отозван)
+    missing    - peer из БД, которого нет на интерфейсе
+    mismatched - peer есть, но адреса или PSK отличаются
+    stale      - адреса выданы ключу больше grace секунд назад, но peer'а
+                 нет ни в БД, ни на интерфейсе (возвращаются в пул)
+    collisions - один адрес у нескольких peer'ов в БД (только отчёт)
+    Исправления применяются через PeerSyncEngine минимальной пачкой.
+    """
+
+    def __init__(self, db, runner, peer_sync, server=1, interface=WG_INTERFACE,
+                 grace=WG_RECONCILE_GRACE_SECONDS):
+        self.db = db
+        self.runner = runner
+        self.peer_sync = peer_sync
+        self.server = server
+        self.interface = interface
+        self.grace = grace
+
+    async def diff(self):
+        dump = await self.runner.run(['wg', 'show', self.interface, 'dump'])
+        actual = parse_dump(dump)
+        rows, revoked, reserved = await self.db.get_wg_peer_state(self.server)
+
+        desired = {}
+        owners = {}
+        collisions = set()
+        for public_key, preshared_key, addresses in rows:
+            networks = _networks(addresses)
+            desired[public_key] = (preshared_key, networks)
+            for network in networks:
+                if owners.setdefault(network, public_key) != public_key:
+                    collisions.add(network)
+
+        # Ключ, получивший адреса меньше grace секунд назад, но ещё без записи
+        # в БД, - peer в процессе создания: его не трогаем. Более старый -
+        # создание не завершилось (запись peer'а не сохранилась), он лишний
+        recent = int(time.time()) - self.grace
+        in_flight = {
+            public_key for public_key, allocated_ts in reserved.items()
+            if allocated_ts >= recent
+        } - revoked - desired.keys()
+        orphans = actual.keys() - desired.keys() - in_flight
+        stale = reserved.keys() - desired.keys() - in_flight - actual.keys()
+        missing = desired.keys() - actual.keys()
+        mismatched = {
+            public_key for public_key in desired.keys() & actual.keys()
+            if desired[public_key] != actual[public_key]
+        }
+        return {
+            'actual': len(actual),
+            'desired': len(desired),
+            'orphans': orphans,
+            'missing': missing,
+            'mismatched': mismatched,
+            'stale': stale,
+            'collisions': collisions,
+            'desired_peers': desired,
+        }
+
+    async def reconcile(self, dry_run=WG_RECONCILE_DRY_RUN):
+        """Сверяет и (если не dry_run) исправляет; возвращает отчёт"""
+        report = await self.diff()
+        desired = report.pop('desired_peers')
+        report['dry_run'] = dry_run
+        if dry_run:
+            return report
+
+        changes = [self.peer_sync.remove_peer(public_key) for public_key in report['orphans']]
+        for public_key in report['missing'] | report['mismatched']:
+            preshared_key, networks = desired[public_key]
+            changes.append(self.peer_sync.add_peer(public_key, preshared_key, sorted(networks)))
+        # Операции одной сверки попадают в одну пачку wg
+        await asyncio.gather(*changes)
+        if report['orphans'] or report['stale']:
+            await self.db.release_wg_addresses(report['orphans'] | report['stale'])
+        return report
+
+
+async def reconcile_job(context: ContextTypes.DEFAULT_TYPE):
+    """Периодическая задача JobQueue: сверка интерфейсов всех серверов с БД"""
+    from services.vpn_service import VPNService
+    for server, node in VPNService.servers.nodes.items():
+        started = time.monotonic()
+        try:
+            report = await node.reconciler.reconcile()
+        except Exception as e:
+            logger.error(f"Ошибка сверки WireGuard сервера {server}: {e}")
+            continue
+        log_report(server, report, time.monotonic() - started)
+
+
+def log_report(server, report, elapsed):
+    drift = (
+        len(report['orphans']) + len(report['missing']) + len(report['mismatched'])
+        + len(report['stale'])
+    )
+    message = (
+        f"Сверка WireGuard сервера {server}{' (dry-run)' if report['dry_run'] else ''}: "
+        f"на интерфейсе {report['actual']}, в БД {report['desired']}, "
+        f"лишних {len(report['orphans'])}, недостающих {len(report['missing'])}, "
+        f"расходящихся {len(report['mismatched'])}, зависших адресов {len(report['stale'])}, "
+        f"коллизий адресов {len(report['collisions'])} за {elapsed:.2f}с"
+    )
+    if drift or report['collisions']:
+        logger.warning(message)
+        for network in report['collisions']:
+            logger.warning(f"Адрес {network} выдан нескольким peer'ам")
+    else:
+        logger.info(message)
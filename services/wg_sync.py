@@ -0,0 +1,198 @@
+import asyncio
+import os
+from config import WG_SYNC_MODE, WG_SYNC_WINDOW_MS, WG_SYNC_MAX_BATCH
+
+WG_INTERFACE = "wg0"
+
+
+class PeerSyncEngine:
+    """
+    Применяет добавления и удаления peer'ов на wg-интерфейсе пачками.
+    Операции копятся в очереди в пределах окна WG_SYNC_WINDOW_MS и
+    применяются одним вызовом wg, состояние интерфейса сохраняется
+    один раз на пачку - в том же run_many, т.е. за один обмен с
+    удалённым сервером. Вызывающий ждёт применения своей операции.
+
+    Режимы:
+    set      - один `wg set` со всеми peer'ами пачки
+    syncconf - текущий конфиг (`wg showconf`) дополняется пачкой и
+               применяется целиком через `wg syncconf`
+    """
+
+    def __init__(self, runner, interface=WG_INTERFACE, mode=WG_SYNC_MODE):
+        if mode not in ('set', 'syncconf'):
+            raise ValueError(f"Unknown WireGuard sync mode: {mode}")
+        self.runner = runner
+        self.interface = interface
+        self.mode = mode
+        self._queue = asyncio.Queue()
+        self._task = None
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._loop())
+
+    async def stop(self):
+        if self._task:
+            # Дожидаемся применения всего, что уже в очереди
+            self._queue.put_nowait(None)
+            await self._task
+            self._task = None
+
+    async def add_peer(self, public_key, preshared_key, allowed_ips):
+        """Добавляет peer (allowed_ips - список адресов с префиксом)"""
+        await self._submit(public_key, (preshared_key, list(allowed_ips)))
+
+    async def remove_peer(self, public_key):
+        await self._submit(public_key, None)
+
+    async def _submit(self, public_key, peer):
+        future = asyncio.get_running_loop().create_future()
+        self._queue.put_nowait((public_key, peer, future))
+        return await future
+
+    async def _loop(self):
+        loop = asyncio.get_running_loop()
+        window = WG_SYNC_WINDOW_MS / 1000
+
+        while True:
+            operation = await self._queue.get()
+            if operation is None:
+                return
+            batch = [operation]
+
+            deadline = loop.time() + window
+            while len(batch) < WG_SYNC_MAX_BATCH:
+                if not self._queue.empty():
+                    operation = self._queue.get_nowait()
+                else:
+                    timeout = deadline - loop.time()
+                    if timeout <= 0:
+                        break
+                    try:
+                        operation = await asyncio.wait_for(self._queue.get(), timeout)
+                    except asyncio.TimeoutError:
+                        break
+                if operation is None:
+                    self._queue.put_nowait(None)
+                    break
+                batch.append(operation)
+
+            await self._apply_batch(batch)
+
+    async def _apply_batch(self, batch):
+        # Для одного ключа действует последняя операция пачки
+        changes = {}
+        for public_key, peer, _ in batch:
+            changes[public_key] = peer
+
+        error = None
+        try:
+            if self.mode == 'set':
+                await self._apply_set(changes)
+            else:
+                await self._apply_syncconf(changes)
+            print(f"WireGuard: применено {len(changes)} изменений peer'ов одной пачкой")
+        except Exception as e:
+            print(f"Error applying WireGuard peers: {e}")
+            error = e
+
+        for _, _, future in batch:
+            if future.done():
+                continue
+            if error is None:
+                future.set_result(True)
+            else:
+                future.set_exception(error)
+
+    async def _apply_set(self, changes):
+        """
+        Один `wg set` на всю пачку. PSK передаются через каналы (pipe):
+        wg читает их из /dev/fd/N, ключи не попадают на диск
+        """
+        command = ['wg', 'set', self.interface]
+        psk_fds = []
+        try:
+            for public_key, peer in changes.items():
+                if peer is None:
+                    command += ['peer', public_key, 'remove']
+                    continue
+                preshared_key, allowed_ips = peer
+                psk_fds.append(_pipe_with(preshared_key))
+                command += [
+                    'peer', public_key,
+                    'preshared-key', f'/dev/fd/{psk_fds[-1]}',
+                    'allowed-ips', ','.join(allowed_ips)
+                ]
+            await self.runner.run_many([
+                (command, None, psk_fds),
+                (self._save_command(), None, ()),
+            ])
+        finally:
+            for fd in psk_fds:
+                os.close(fd)
+
+    async def _apply_syncconf(self, changes):
+        """Текущий конфиг интерфейса с изменениями пачки - в `wg syncconf`"""
+        current = await self.runner.run(['wg', 'showconf', self.interface])
+        config = patch_config(current, changes)
+        await self.runner.run_many([
+            (['wg', 'syncconf', self.interface, '/dev/stdin'], config, ()),
+            (self._save_command(), None, ()),
+        ])
+
+    def _save_command(self):
+        return ['wg-quick', 'save', self.interface]
+
+
+def _pipe_with(data):
+    """
+    Канал с уже записанными данными; возвращает дескриптор чтения.
+    Ключ (44 байта) помещается в буфер канала, запись не блокирует
+    """
+    read_fd, write_fd = os.pipe()
+    try:
+        os.write(write_fd, data.encode())
+    except OSError:
+        os.close(read_fd)
+        raise
+    finally:
+        os.close(write_fd)
+    return read_fd
+
+
+def patch_config(config, changes):
+    """
+    Возвращает конфиг wg (формат `wg showconf`), в котором peer'ы из
+    changes заменены: None - удалить, (psk, allowed_ips) - добавить
+    """
+    sections = []
+    for line in config.splitlines():
+        if line.strip().startswith('['):
+            sections.append([line])
+        elif sections:
+            sections[-1].append(line)
+
+    kept = []
+    for section in sections:
+        if section[0].strip() == '[Peer]' and _peer_key(section) in changes:
+            continue
+        kept.append('\n'.join(section).strip())
+
+    for public_key, peer in changes.items():
+        if peer is None:
+            continue
+        preshared_key, allowed_ips = peer
+        kept.append(
+            f"[Peer]\nPublicKey = {public_key}\nPresharedKey = {preshared_key}\n"
+            f"AllowedIPs = {', '.join(allowed_ips)}"
+        )
+    return '\n\n'.join(kept) + '\n'
+
+
+def _peer_key(section):
+    for line in section[1:]:
+        name, _, value = line.partition('=')
+        if name.strip() == 'PublicKey':
+            return value.strip()
+    return None
@@ -0,0 +1,26 @@
+import asyncio
+import os
+import sys
+import pytest
+
+# config.py требует ADMIN_ID; модули бота импортируются из корня репозитория
+os.environ.setdefault('ADMIN_ID', '1')
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+@pytest.fixture
+def run():
+    """Выполняет корутину в цикле событий теста (один цикл на тест)"""
+    loop = asyncio.new_event_loop()
+    yield loop.run_until_complete
+    loop.close()
+
+
+@pytest.fixture
+def db(run, tmp_path):
+    """Database на временном файле; закрывается после теста"""
+    from database import Database
+    database = Database(str(tmp_path / 'bot.db'))
+    run(database.connect())
+    yield database
+    run(database.close())
@@ -0,0 +1,24 @@
+from database import now_ts, DAY
+from config import ARCHIVE_AFTER_DAYS
+
+
+async def _archive(db):
+    await db.add_user(1, 'one')
+    await db.add_payment(1, 100, 'paid-old', 'stars', 'paid')
+    await db.add_payment(1, 100, 'pending-old', 'stars', 'pending')
+    old = now_ts() - (ARCHIVE_AFTER_DAYS + 1) * DAY
+    await db._submit([('UPDATE payments SET created_ts = ?', (old,))])
+
+    moved = await db.archive_batch()
+    # Счёт, оплаченный после ARCHIVE_AFTER_DAYS, находится и проводится
+    pending = await db.get_payment('pending-old')
+    updated = await db.update_payment_status('pending-old', 'paid')
+    return moved, await db.get_payment('paid-old'), pending, updated
+
+
+def test_archive_keeps_pending_payments(db, run):
+    moved, paid, pending, updated = run(_archive(db))
+    assert moved == (0, 1)
+    assert paid is None
+    assert pending is not None
+    assert updated
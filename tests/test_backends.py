@@ -0,0 +1,30 @@
+import asyncio
+import pytest
+from services.backends import VPNBackend, FakeBackend, BackendError
+
+
+def test_backend_protocol_is_abstract():
+    with pytest.raises(TypeError):
+        VPNBackend()
+
+
+def test_fake_provision_is_one_operation():
+    backend = FakeBackend('wireguard', latency_ms=0, failure_rate=0, seed=1)
+
+    async def provision():
+        first = await backend.provision(1)
+        again = await backend.provision(1)
+        other = await backend.provision(2)
+        return first, again, other
+
+    first, again, other = asyncio.run(provision())
+    assert first == again
+    assert first[0] != other[0]
+    assert backend.calls == 3
+
+
+def test_fake_failures_are_counted():
+    backend = FakeBackend('v2ray', latency_ms=0, failure_rate=1, seed=1)
+    with pytest.raises(BackendError):
+        asyncio.run(backend.provision(1))
+    assert asyncio.run(backend.stats())['failures'] == 1
@@ -0,0 +1,34 @@
+from utils.cache import TTLCache, MISSING
+
+
+def test_invalidate_cancels_only_that_key():
+    cache = TTLCache(10, 60)
+    version_a = cache.version('a')
+    version_b = cache.version('b')
+    cache.invalidate('b')
+
+    cache.set('a', 1, version_a)
+    cache.set('b', 2, version_b)
+    assert cache.get('a') == 1
+    assert cache.get('b') is MISSING
+
+
+def test_load_after_invalidate_is_cached():
+    cache = TTLCache(10, 60)
+    cache.invalidate('a')
+    version = cache.version('a')
+    cache.set('a', 1, version)
+    assert cache.get('a') == 1
+
+
+def test_forgotten_invalidations_stay_conservative():
+    cache = TTLCache(2, 60)
+    version = cache.version('a')
+    for key in ('a', 'b', 'c'):
+        cache.invalidate(key)
+
+    # Сброс 'a' вытеснен из истории, но загрузка до него не сохраняется
+    cache.set('a', 1, version)
+    assert cache.get('a') is MISSING
+    cache.set('d', 1, cache.version('d'))
+    assert cache.get('d') == 1
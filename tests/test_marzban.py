@@ -0,0 +1,50 @@
+from services import marzban_service
+from services.marzban_service import MarzbanService
+
+
+class Response:
+    def __init__(self, status_code, data=None):
+        self.status_code = status_code
+        self._data = data or {}
+        self.text = str(self._data)
+
+    def json(self):
+        return self._data
+
+
+def _panel(monkeypatch, user_exists):
+    """Подменяет HTTP-запросы к панели; возвращает список отправленных"""
+    sent = []
+
+    def get(url, **kwargs):
+        return Response(200, {'subscription_url': 'https://panel/sub/old'}) if user_exists else Response(404)
+
+    def put(url, json=None, **kwargs):
+        sent.append(('PUT', json))
+        return Response(200, {'subscription_url': 'https://panel/sub/user_1'})
+
+    def post(url, json=None, data=None, **kwargs):
+        if url.endswith('/api/admin/token'):
+            return Response(200, {'access_token': 'token'})
+        sent.append(('POST', json))
+        return Response(200, {'subscription_url': 'https://panel/sub/user_1'})
+
+    monkeypatch.setattr(marzban_service.requests, 'get', get)
+    monkeypatch.setattr(marzban_service.requests, 'put', put)
+    monkeypatch.setattr(marzban_service.requests, 'post', post)
+    return sent
+
+
+def test_existing_user_is_reactivated_until_subscription_end(monkeypatch):
+    sent = _panel(monkeypatch, user_exists=True)
+    url, username = MarzbanService('https://panel', 'admin', 'pw').create_user(1, 30, 2_000_000_000)
+    assert (url, username) == ('https://panel/sub/user_1', 'user_1')
+    assert sent == [('PUT', {'status': 'active', 'expire': 2_000_000_000})]
+
+
+def test_new_user_expires_at_subscription_end(monkeypatch):
+    sent = _panel(monkeypatch, user_exists=False)
+    MarzbanService('https://panel', 'admin', 'pw').create_user(1, 30, 2_000_000_000)
+    [(method, body)] = sent
+    assert method == 'POST'
+    assert body['expire'] == 2_000_000_000
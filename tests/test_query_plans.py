@@ -0,0 +1,173 @@
+"""
+Планы запросов Database: каждый выполненный запрос (включая единицы
+работы, переданные писателю корутиной) прогоняется через EXPLAIN QUERY
+PLAN; полный проход по таблице (SCAN) допустим только в ALLOWED_SCANS.
+Запросы перехватываются trace-callback'ом SQLite на всех соединениях.
+"""
+import asyncio
+import sqlite3
+import pytest
+from database import Database, now_ts, DAY
+from config import ARCHIVE_AFTER_DAYS
+
+# Методы, которым полный проход по таблице разрешён
+ALLOWED_SCANS = {
+    # таблица stats - несколько строк счётчиков
+    'get_stats',
+    'get_total_revenue',
+    'get_revenue_by_method',
+    'get_recent_payments',  # обход индекса по created_ts, ограниченный LIMIT
+    'get_wg_pool_usage',  # wg_pools - по строке на пул
+    'has_wg_peers',  # LIMIT 1 - первая же запись индекса
+    'get_wg_peer_counts',  # покрывающий индекс действующих peer'ов, раз в PLACEMENT_CACHE_SECONDS
+}
+
+# Единицы работы, которые писатель выполняет корутиной, - их запросы
+# тоже должны попасть в проверку
+UNITS = (
+    'reap_expired_batch', 'archive_batch', 'allocate_wg_addresses', 'claim_pool_peer_for_user',
+    'add_wg_peer', 'move_wg_peer', 'register_wg_pool', 'record_wg_usage',
+    'revoke_user_wg_peers',
+)
+
+SKIPPED_PREFIXES = ('BEGIN', 'COMMIT', 'ROLLBACK', 'SAVEPOINT', 'RELEASE', 'PRAGMA', '--')
+
+POOL = '1:10.0.0.0/24'
+
+
+def _calls(now):
+    """[(метод, аргументы)] в порядке выполнения; 'seed' - подготовка данных"""
+    old = now - (ARCHIVE_AFTER_DAYS + 1) * DAY
+    return [
+        ('add_user', (1, 'one')),
+        ('add_user', (2, 'two', 1)),
+        ('add_user', (3, 'three')),
+        ('get_user', (1,)),
+        ('activate_trial', (1, 'key', 'uuid1')),
+        ('get_active_subscription', (1,)),
+        ('add_subscription', (2, 'key', 'uuid2')),
+        ('renew_subscription', (2, now + 60 * DAY, 'key', 'uuid2')),
+        ('update_subscription_key', (2, 'key2', 'uuid2')),
+        ('add_payment', (2, 100, 'pay1')),
+        ('update_payment_status', ('pay1', 'paid')),
+        ('get_payment', ('pay1',)),
+        ('update_balance', (2, 10)),
+        ('get_stats', ()),
+        ('get_all_users_count', ()),
+        ('get_trial_users', ()),
+        ('get_users_page', (1,)),
+        ('get_users_page', (1, (0, 0), 'next')),
+        ('get_users_page', (1, (now + DAY, 0), 'prev')),
+        ('get_paid_users', ()),
+        ('get_active_subscriptions_count', ()),
+        ('get_expired_subscriptions', ()),
+        ('get_total_revenue', ()),
+        ('get_revenue_by_method', ()),
+        ('get_recent_payments', ()),
+        ('get_expiring_subscriptions', ()),
+        ('get_user_preferences', (1,)),
+        ('set_user_preferences', (1,)),
+        ('get_subscription_history', (1,)),
+        ('get_payment_history', (2,)),
+        # истёкшая подписка для reaper'а, старые - для архивации
+        ('add_subscription', (3, 'key', 'uuid3', -1)),
+        ('add_payment', (3, 100, 'pay-old', 'stars', 'paid')),
+        ('seed', (f'UPDATE payments SET created_ts = {old} WHERE payment_id = \'pay-old\'',)),
+        ('add_wg_peer', (3, 1, 'priv', 'key-3', 'psk', '10.0.0.3/32')),
+        ('reap_expired_batch', ()),
+        ('deactivate_subscription', (1,)),
+        ('seed', (f'UPDATE subscriptions SET end_ts = {old} WHERE user_id = 3',)),
+        ('archive_batch', ()),
+        ('register_wg_pool', (POOL, 1, 254)),
+        ('allocate_wg_addresses', ([[POOL]], 'key-a')),
+        ('release_wg_address', ('key-a',)),
+        ('allocate_wg_addresses', ([[POOL]], 'key-b')),
+        ('release_wg_addresses', (['key-b'],)),
+        ('get_wg_pool_usage', ()),
+        ('add_pool_peer', (1, 'priv', 'key-pool', 'psk', '10.0.0.9/32')),
+        ('get_pool_peer_count', (1,)),
+        ('claim_pool_peer_for_user', (6, 1)),
+        ('add_wg_peer', (4, 1, 'priv', 'key-4', 'psk', '10.0.0.4/32')),
+        ('get_wg_peer', (4, 1)),
+        ('get_wg_peer', (4,)),
+        ('get_wg_peer_counts', ()),
+        ('get_wg_peers_on_server', (1,)),
+        ('move_wg_peer', (2, 4, 2, 'priv', 'key-4b', 'psk', '10.1.0.4/32')),
+        ('import_wg_peers', ([(5, 1, 'priv', 'key-5', 'psk', '10.0.0.5/32')],)),
+        ('get_wg_peer_state', (1,)),
+        ('has_wg_peers', ()),
+        ('get_wg_peer_ids', (1,)),
+        ('record_wg_usage', (1, now, [(3, 100, 200, now)], (100, 200, 1))),
+        ('record_wg_usage', (1, now, [(3, 100, 200, now)], (100, 200, 1))),
+        ('get_user_usage', (5, 60, 0)),
+        ('get_server_usage', (1, 60, 0)),
+        ('get_top_usage', (3600, 0)),
+        ('prune_wg_usage', (now,)),
+        ('revoke_user_wg_peers', ([5],)),
+    ]
+
+
+async def _trace(db_file):
+    """{метод: [выполненные запросы с подставленными параметрами]}"""
+    db = Database(db_file)
+    await db.connect()
+    traced = {}
+    current = [None]
+
+    def record(statement):
+        traced.setdefault(current[0], []).append(statement)
+
+    for connection in (db.writer, *db.readers):
+        await connection.set_trace_callback(record)
+
+    try:
+        for name, args in _calls(now_ts()):
+            current[0] = name
+            if name == 'seed':
+                await db._submit([(args[0], ())])
+            else:
+                await getattr(db, name)(*args)
+    finally:
+        current[0] = None
+        await db.close()
+    return traced
+
+
+@pytest.fixture(scope='module')
+def plans(tmp_path_factory):
+    """[(метод, запрос, [шаги плана])]"""
+    db_file = str(tmp_path_factory.mktemp('plans') / 'bot.db')
+    traced = asyncio.run(_trace(db_file))
+
+    connection = sqlite3.connect(db_file)
+    explained = []
+    for name, statements in traced.items():
+        if name in (None, 'seed'):
+            continue
+        for statement in statements:
+            if statement.lstrip().upper().startswith(SKIPPED_PREFIXES):
+                continue
+            steps = [row[3] for row in connection.execute('EXPLAIN QUERY PLAN ' + statement)]
+            explained.append((name, ' '.join(statement.split()), steps))
+    connection.close()
+    return explained
+
+
+def test_every_method_was_explained(plans):
+    explained = {name for name, _, _ in plans}
+    missing = {name for name, _ in _calls(0)} - explained - {'seed'}
+    assert not missing
+
+
+@pytest.mark.parametrize('unit', UNITS)
+def test_writer_units_are_explained(plans, unit):
+    assert any(name == unit for name, _, _ in plans)
+
+
+def test_no_full_scans(plans):
+    scans = [
+        (name, step, statement)
+        for name, statement, steps in plans if name not in ALLOWED_SCANS
+        for step in steps if step.startswith('SCAN') and not step.startswith('SCAN CONSTANT')
+    ]
+    assert not scans
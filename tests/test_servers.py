@@ -0,0 +1,70 @@
+from database import now_ts, DAY
+from config import REBALANCE_IDLE_DAYS
+from services.servers import ServerRegistry
+
+
+class FakeSync:
+    def __init__(self):
+        self.removed = []
+
+    async def remove_peer(self, public_key):
+        self.removed.append(public_key)
+
+
+class FakeAllocator:
+    async def release(self, public_key):
+        pass
+
+
+class FakeNode:
+    def __init__(self, handshakes=None):
+        self._handshakes = handshakes or {}
+        self.peer_sync = FakeSync()
+        self.allocator = FakeAllocator()
+
+    async def handshakes(self):
+        return self._handshakes
+
+
+async def _rebalance(db):
+    now = now_ts()
+    old = now - (REBALANCE_IDLE_DAYS + 1) * DAY
+    # (user_id, public_key, выдан давно, последнее рукопожатие)
+    peers = [
+        (1, 'idle', True, 0),
+        (2, 'fresh-unused', False, 0),
+        (3, 'active', True, now),
+        (4, 'stale-handshake', True, old),
+    ]
+    for user_id, public_key, _, _ in peers:
+        await db.add_wg_peer(user_id, 1, 'priv', public_key, 'psk', f'10.0.0.{user_id}/32')
+    await db._submit([(
+        "UPDATE wg_peers SET created_ts = ? WHERE public_key != 'fresh-unused'", (old,)
+    )])
+
+    registry = ServerRegistry(db)
+    registry.nodes = {
+        1: FakeNode({key: handshake for _, key, _, handshake in peers if handshake}),
+        2: FakeNode(),
+    }
+
+    async def loads(fresh=False):
+        return {1: {'peers': 8, 'score': 8}, 2: {'peers': 0, 'score': 0}}
+
+    created = iter(range(100))
+
+    async def provision(node):
+        number = next(created)
+        return 'priv', f'new-{number}', 'psk', f'10.1.0.{number}/32'
+
+    registry.loads = loads
+    registry.provision = provision
+    result = await registry.rebalance()
+    return result, registry.nodes[1].peer_sync.removed
+
+
+def test_rebalance_skips_recent_peers_without_handshake(db, run):
+    (source, target, moved), removed = run(_rebalance(db))
+    assert (source, target) == (1, 2)
+    assert sorted(moved) == [1, 4]
+    assert sorted(removed) == ['idle', 'stale-handshake']
@@ -0,0 +1,87 @@
+import base64
+import shutil
+import subprocess
+import pytest
+from utils.wg_keys import (
+    x25519, generate_private_key, public_key, generate_preshared_key, generate_keypair,
+    BASE_POINT
+)
+
+h = bytes.fromhex
+
+
+def b64(data):
+    return base64.b64encode(data).decode()
+
+
+# RFC 7748, раздел 5.2
+@pytest.mark.parametrize('scalar, u, expected', [
+    ('a546e36bf0527c9d3b16154b82465edd62144c0ac1fc5a18506a2244ba449ac4',
+     'e6db6867583030db3594c1a424b15f7c726624ec26b3353b10a903a6d0ab1c4c',
+     'c3da55379de9c6908e94ea4df28d084f32eccf03491c71f754b4075577a28552'),
+])
+def test_x25519_rfc7748_vector(scalar, u, expected):
+    assert x25519(h(scalar), h(u)) == h(expected)
+
+
+def test_x25519_rfc7748_iterated():
+    k = u = BASE_POINT
+    k, u = x25519(k, u), k
+    assert k == h('422c8e7a6227d7bca1350b3e2bb7279f7897b87bb6854b783c60e80311ae3079')
+    for _ in range(999):
+        k, u = x25519(k, u), k
+    assert k == h('684cf59ba83309552800ef566f2f4d3c1c3887c49360e3875f2eb94d99532c51')
+
+
+# RFC 7748, раздел 6.1
+ALICE_PRIVATE = '77076d0a7318a57d3c16c17251b26645df4c2f87ebc0992ab177fba51db92c2a'
+ALICE_PUBLIC = '8520f0098930a754748b7ddcb43ef75a0dbf3a0d26381af4eba4a98eaa9b4e6a'
+BOB_PRIVATE = '5dab087e624a8a4b79e17f8b83800ee66f3bb1292618b6fd1c2f8b27ff88e0eb'
+BOB_PUBLIC = 'de9edb7d7b7dc1b4d35b61c2ece435373f8343c85b78674dadfc7e146f882b4f'
+SHARED = '4a5d9d5ba4ce2de1728e3bf480350f25e07e21c947d19e3376f09b3c1e161742'
+
+
+def test_public_key_rfc7748_diffie_hellman():
+    assert public_key(b64(h(ALICE_PRIVATE))) == b64(h(ALICE_PUBLIC))
+    assert public_key(b64(h(BOB_PRIVATE))) == b64(h(BOB_PUBLIC))
+    assert x25519(h(ALICE_PRIVATE), h(BOB_PUBLIC)) == h(SHARED)
+    assert x25519(h(BOB_PRIVATE), h(ALICE_PUBLIC)) == h(SHARED)
+
+
+def test_keys_are_base64_of_32_bytes():
+    private_key, public = generate_keypair()
+    for key in (private_key, public, generate_preshared_key()):
+        assert len(key) == 44 and key.endswith('=')
+        assert len(base64.b64decode(key, validate=True)) == 32
+
+
+def test_private_key_is_clamped():
+    for _ in range(20):
+        scalar = base64.b64decode(generate_private_key())
+        assert scalar[0] & 7 == 0
+        assert scalar[31] & 128 == 0
+        assert scalar[31] & 64 == 64
+
+
+def test_keys_are_random():
+    assert len({generate_private_key() for _ in range(20)}) == 20
+    assert len({generate_preshared_key() for _ in range(20)}) == 20
+
+
+@pytest.mark.skipif(shutil.which('wg') is None, reason="wg не установлен")
+def test_public_key_matches_wg_pubkey():
+    for _ in range(5):
+        private_key, public = generate_keypair()
+        result = subprocess.run(
+            ['wg', 'pubkey'], input=private_key + '\n', capture_output=True, text=True, check=True
+        )
+        assert result.stdout.strip() == public
+
+
+@pytest.mark.skipif(shutil.which('wg') is None, reason="wg не установлен")
+def test_wg_genkey_accepted_by_public_key():
+    private_key = subprocess.run(['wg', 'genkey'], capture_output=True, text=True, check=True).stdout.strip()
+    result = subprocess.run(
+        ['wg', 'pubkey'], input=private_key + '\n', capture_output=True, text=True, check=True
+    )
+    assert public_key(private_key) == result.stdout.strip()
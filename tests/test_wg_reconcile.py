@@ -0,0 +1,106 @@
+from database import now_ts
+from services.wg_reconcile import Reconciler
+
+POOL = '1:10.0.0.0/24'
+
+
+class DumpRunner:
+    def __init__(self, peers):
+        self.peers = peers
+
+    async def run(self, args):
+        lines = ['private\tpublic\t51820\toff']
+        for public_key, address in self.peers.items():
+            lines.append(f"{public_key}\tpsk\t(none)\t{address}\t0\t0\t0\toff")
+        return '\n'.join(lines)
+
+
+class RecordingSync:
+    def __init__(self):
+        self.removed = []
+
+    async def remove_peer(self, public_key):
+        self.removed.append(public_key)
+
+    async def add_peer(self, public_key, preshared_key, addresses):
+        pass
+
+
+async def _reconcile(db):
+    await db.register_wg_pool(POOL, 1, 254)
+    for public_key in ('fresh', 'failed', 'crashed'):
+        await db.allocate_wg_addresses([[POOL]], public_key)
+    # 'failed' добавлен на wg0, но запись peer'а не сохранилась;
+    # 'crashed' - бот упал до добавления на wg0
+    old = now_ts() - 3600
+    await db._submit([(
+        "UPDATE wg_addresses SET allocated_ts = ? WHERE public_key IN ('failed', 'crashed')",
+        (old,)
+    )])
+
+    sync = RecordingSync()
+    runner = DumpRunner({'fresh': '10.0.0.1/32', 'failed': '10.0.0.2/32'})
+    report = await Reconciler(db, runner, sync, grace=600).reconcile(dry_run=False)
+    _, _, reserved = await db.get_wg_peer_state(1)
+    return report, sync.removed, reserved
+
+
+def test_stale_reservations_are_reclaimed(db, run):
+    report, removed, reserved = run(_reconcile(db))
+    assert report['orphans'] == {'failed'}
+    assert report['stale'] == {'crashed'}
+    assert removed == ['failed']
+    assert reserved.keys() == {'fresh'}
+
+
+async def _claim_then_reconcile(db):
+    await db.register_wg_pool(POOL, 1, 254)
+    await db.allocate_wg_addresses([[POOL]], 'pooled')
+    await db.add_pool_peer(1, 'priv', 'pooled', 'psk', '10.0.0.1/32')
+    # Peer тёплого пула обычно старше grace
+    await db._submit([('UPDATE wg_addresses SET allocated_ts = ?', (now_ts() - 3600,))])
+
+    sync = RecordingSync()
+    reconciler = Reconciler(db, DumpRunner({'pooled': '10.0.0.1/32'}), sync, grace=600)
+    peer = await db.claim_pool_peer_for_user(7, 1)
+    report = await reconciler.reconcile(dry_run=False)
+    _, _, reserved = await db.get_wg_peer_state(1)
+    return peer, report, sync.removed, reserved
+
+
+def test_claimed_pool_peer_is_not_orphaned(db, run):
+    peer, report, removed, reserved = run(_claim_then_reconcile(db))
+    assert (peer.user_id, peer.public_key) == (7, 'pooled')
+    assert not report['orphans'] and not report['stale'] and not report['missing']
+    assert removed == []
+    assert 'pooled' in reserved
+
+
+async def _claim_with_existing_peer(db):
+    await db.add_wg_peer(7, 1, 'priv', 'own', 'psk', '10.0.0.2/32')
+    await db.add_pool_peer(1, 'priv', 'pooled', 'psk', '10.0.0.1/32')
+    peer = await db.claim_pool_peer_for_user(7, 1)
+    return peer, await db.get_pool_peer_count(1)
+
+
+def test_claim_keeps_pool_peer_for_user_with_peer(db, run):
+    peer, depth = run(_claim_with_existing_peer(db))
+    assert peer.public_key == 'own'
+    assert depth == 1
+
+
+async def _revoked_state(db):
+    await db.register_wg_pool(POOL, 1, 254)
+    for user_id, public_key in ((1, 'kept'), (2, 'released')):
+        await db.allocate_wg_addresses([[POOL]], public_key)
+        await db.add_wg_peer(user_id, 1, 'priv', public_key, 'psk', '10.0.0.1/32')
+    await db.revoke_user_wg_peers([1, 2])
+    await db.release_wg_addresses(['released'])
+    return await db.get_wg_peer_state(1)
+
+
+def test_peer_state_reports_only_revoked_keys_with_addresses(db, run):
+    rows, revoked, reserved = run(_revoked_state(db))
+    assert rows == []
+    assert revoked == {'kept'}
+    assert reserved.keys() == {'kept'}
@@ -0,0 +1,104 @@
+"""
+SSHRunner против sshd на этой машине. Адрес и доступ - из окружения
+(WG_TEST_SSH_HOST, WG_TEST_SSH_PORT, WG_TEST_SSH_USER, WG_TEST_SSH_KEY);
+без доступного sshd тесты пропускаются. Скрипт run_many проверяется
+и без sshd - локальным `sh -s`.
+"""
+import asyncio
+import getpass
+import os
+import socket
+import subprocess
+import pytest
+from services.wg_command import SSHRunner, CommandError, _remote_script
+from services.wg_sync import _pipe_with
+
+SSH_HOST = os.getenv('WG_TEST_SSH_HOST', 'localhost')
+SSH_PORT = int(os.getenv('WG_TEST_SSH_PORT', '22'))
+SSH_USER = os.getenv('WG_TEST_SSH_USER', getpass.getuser())
+SSH_KEY = os.getenv('WG_TEST_SSH_KEY')
+
+
+def _run_script(commands):
+    command, stdin = _remote_script(commands)
+    result = subprocess.run(command, shell=True, input=stdin, capture_output=True, text=True)
+    assert result.returncode == 0, result.stderr
+    return result.stdout
+
+
+def test_single_command_runs_directly():
+    assert _remote_script([(['wg', 'show', 'wg 0'], None, ())]) == ("wg show 'wg 0'", None)
+
+
+def test_script_passes_fds_through_files():
+    first, second = _pipe_with('secret-psk'), _pipe_with("it's")
+    try:
+        command, stdin = _remote_script([(['cat', f'/dev/fd/{first}'], None, (first,))])
+        assert command == 'sh -s'
+        assert f'/dev/fd/{first}' not in stdin
+
+        output = _run_script([
+            (['cat', f'/dev/fd/{second}'], None, (second,)),
+            (['cat', '-'], ' stdin', ()),
+        ])
+        assert output == "it's stdin"
+    finally:
+        os.close(first)
+        os.close(second)
+
+
+@pytest.fixture
+def runner():
+    try:
+        socket.create_connection((SSH_HOST, SSH_PORT), timeout=2).close()
+    except OSError:
+        pytest.skip(f"sshd недоступен на {SSH_HOST}:{SSH_PORT}")
+
+    runner = SSHRunner(
+        SSH_HOST, port=SSH_PORT, username=SSH_USER, key_filename=SSH_KEY,
+        pool_size=2, timeout=10, strict_host_keys=False
+    )
+    try:
+        asyncio.run(runner.run(['true']))
+    except CommandError as e:
+        runner.close()
+        pytest.skip(f"нет доступа по SSH: {e}")
+    yield runner
+    runner.close()
+
+
+def test_run(runner):
+    async def run():
+        return (
+            await runner.run(['echo', 'hello world']),
+            await runner.run(['cat'], input='stdin data'),
+        )
+
+    assert asyncio.run(run()) == ('hello world\n', 'stdin data')
+    with pytest.raises(CommandError):
+        asyncio.run(runner.run(['false']))
+
+
+def test_run_many_with_pass_fds(runner):
+    first, second = _pipe_with('psk-one'), _pipe_with('psk-two')
+    try:
+        output = asyncio.run(runner.run_many([
+            (['cat', f'/dev/fd/{first}'], None, (first,)),
+            (['cat', f'/dev/fd/{second}', '-'], '|stdin', (second,)),
+        ]))
+    finally:
+        os.close(first)
+        os.close(second)
+    assert output == 'psk-onepsk-two|stdin'
+
+
+def test_reconnects_after_transport_drops(runner):
+    async def run_on_every_slot():
+        return await asyncio.gather(*(runner.run(['echo', 'up']) for _ in runner._clients))
+
+    asyncio.run(run_on_every_slot())
+    for client in runner._clients:
+        if client:
+            client.get_transport().close()
+
+    assert asyncio.run(run_on_every_slot()) == ['up\n'] * len(runner._clients)
@@ -0,0 +1,23 @@
+import asyncio
+import pytest
+
+
+async def _broken_batch(db):
+    apply_batch = db._apply_batch
+
+    async def broken(batch):
+        db._apply_batch = apply_batch
+        raise RuntimeError('rollback failed')
+
+    db._apply_batch = broken
+    with pytest.raises(RuntimeError):
+        await asyncio.wait_for(db._submit([('SELECT 1', ())]), 5)
+    # Писатель жив: следующие единицы работы фиксируются
+    added = await asyncio.wait_for(db.add_user(2, 'two'), 5)
+    return added, await db.get_user(2)
+
+
+def test_writer_survives_failed_batch(db, run):
+    added, user = run(_broken_batch(db))
+    assert added
+    assert user is not None
@@ -0,0 +1,72 @@
+import time
+from collections import OrderedDict
+
+# Отличает отсутствие записи от закэшированного None
+MISSING = object()
+
+
+class TTLCache:
+    """
+    Ограниченный LRU-кэш с временем жизни записей и счётчиками
+    попаданий/промахов.
+
+    Защита от гонки чтения с записью: перед загрузкой значения берётся
+    version(key), и set() сохраняет значение, только если с тех пор не
+    было invalidate() этого ключа - иначе загруженное значение могло
+    устареть. Сброс одного ключа не мешает кэшировать остальные.
+
+    Время сбросов помнится для последних maxsize ключей; для более старых -
+    время самого позднего забытого сброса (set() может лишний раз не
+    сохранить значение, но не сохранит устаревшее).
+    """
+
+    def __init__(self, maxsize, ttl):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()
+        self._clock = 0
+        self._invalidated = OrderedDict()
+        self._forgotten = 0
+
+    def version(self, key):
+        """Отметка перед загрузкой значения key для set()"""
+        return self._clock
+
+    def get(self, key):
+        item = self._data.get(key)
+        if item is None or item[1] < time.monotonic():
+            if item is not None:
+                del self._data[key]
+            self.misses += 1
+            return MISSING
+
+        self._data.move_to_end(key)
+        self.hits += 1
+        return item[0]
+
+    def set(self, key, value, version=None):
+        if version is not None and self._invalidated.get(key, self._forgotten) > version:
+            return
+        self._data[key] = (value, time.monotonic() + self.ttl)
+        self._data.move_to_end(key)
+        if len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+
+    def invalidate(self, key):
+        self._clock += 1
+        self._invalidated[key] = self._clock
+        self._invalidated.move_to_end(key)
+        if len(self._invalidated) > self.maxsize:
+            _, self._forgotten = self._invalidated.popitem(last=False)
+        self._data.pop(key, None)
+
+    def stats(self):
+        total = self.hits + self.misses
+        return {
+            'size': len(self._data),
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': self.hits / total if total else 0.0,
+        }
@@ -0,0 +1,54 @@
+import asyncio
+from utils.cache import TTLCache, MISSING
+
+
+class SingleFlight:
+    """
+    Объединение одновременных вызовов по ключу: пока вызов для ключа
+    выполняется, остальные вызывающие ждут его результата, а не
+    запускают свой. Успешный результат ещё ttl секунд отдаётся из кэша.
+
+    Вызов выполняется отдельной задачей: отмена одного из ждущих не
+    прерывает его для остальных. Исключение получают все ждущие, в кэш
+    оно не попадает; результат, для которого cache_if вернул False, -
+    тоже.
+    """
+
+    def __init__(self, ttl, maxsize, cache_if=None):
+        self.cache = TTLCache(maxsize, ttl)
+        self.cache_if = cache_if
+        self.calls = 0
+        self.shared = 0
+        self._inflight = {}
+
+    async def do(self, key, function, *args, **kwargs):
+        value = self.cache.get(key)
+        if value is not MISSING:
+            return value
+
+        task = self._inflight.get(key)
+        if task is None:
+            self.calls += 1
+            task = asyncio.create_task(self._run(key, function, *args, **kwargs))
+            self._inflight[key] = task
+        else:
+            self.shared += 1
+        return await asyncio.shield(task)
+
+    async def _run(self, key, function, *args, **kwargs):
+        # Версия до вызова: forget() во время вызова отменяет запись в кэш
+        version = self.cache.version(key)
+        try:
+            value = await function(*args, **kwargs)
+        finally:
+            del self._inflight[key]
+        if self.cache_if is None or self.cache_if(value):
+            self.cache.set(key, value, version)
+        return value
+
+    def forget(self, key):
+        """Сбрасывает закэшированный результат (после отзыва или изменения)"""
+        self.cache.invalidate(key)
+
+    def stats(self):
+        return {**self.cache.stats(), 'calls': self.calls, 'shared': self.shared}
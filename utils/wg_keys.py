@@ -0,0 +1,49 @@
+import base64
+import os
+from cryptography.hazmat.primitives.asymmetric.x25519 import X25519PrivateKey, X25519PublicKey
+
+# u-координата базовой точки Curve25519 (RFC 7748)
+BASE_POINT = (9).to_bytes(32, 'little')
+
+
+def _clamp(scalar):
+    """Приведение закрытого ключа, как в RFC 7748 и `wg genkey`"""
+    scalar = bytearray(scalar)
+    scalar[0] &= 248
+    scalar[31] &= 127
+    scalar[31] |= 64
+    return bytes(scalar)
+
+
+def x25519(scalar, u):
+    """
+    Функция X25519 из RFC 7748: scalar (32 байта) умножается на точку
+    с u-координатой u (32 байта). Вычисление - в cryptography (OpenSSL),
+    за постоянное время.
+    """
+    private_key = X25519PrivateKey.from_private_bytes(scalar)
+    return private_key.exchange(X25519PublicKey.from_public_bytes(u))
+
+
+def generate_private_key():
+    """Закрытый ключ в base64, как `wg genkey`"""
+    scalar = X25519PrivateKey.generate().private_bytes_raw()
+    return base64.b64encode(_clamp(scalar)).decode()
+
+
+def public_key(private_key):
+    """Открытый ключ в base64 для закрытого ключа в base64, как `wg pubkey`"""
+    scalar = base64.b64decode(private_key)
+    public = X25519PrivateKey.from_private_bytes(scalar).public_key().public_bytes_raw()
+    return base64.b64encode(public).decode()
+
+
+def generate_preshared_key():
+    """Общий ключ в base64, как `wg genpsk`"""
+    return base64.b64encode(os.urandom(32)).decode()
+
+
+def generate_keypair():
+    """(закрытый, открытый) ключи в base64"""
+    private_key = generate_private_key()
+    return private_key, public_key(private_key)